@@ -0,0 +1,420 @@
+"""
+Benchmark de loopback dos caminhos de dados do túnel.
+
+Sobe server.py e client.py no mesmo processo, em 127.0.0.1, contra um serviço
+local de eco (TCP) e um servidor HTTP mínimo, e mede:
+
+- tcp:  conexões pela porta pública: latência de abertura até o primeiro eco
+        (percentis) e req/s;
+- http: requisições pelo proxy de HTTP_PORT, roteadas pelo cabeçalho Host;
+- bulk: vazão em massa por uma conexão (MB/s) e CPU por GB encaminhado;
+- idle: RSS por 1k conexões simultâneas abertas pelo túnel;
+- api:  rotatividade de túneis via /tunnels (criar, mapear domínio, deletar).
+
+CPU e RSS incluem servidor, cliente e gerador de carga, que rodam no mesmo
+processo: servem para comparar execuções entre si, não como custo absoluto.
+Use --json para guardar o resultado e compará-lo em verificações de regressão.
+--rss-budget faz da fase idle uma verificação: o benchmark termina com erro se
+o RSS por conexão passar do orçamento (ver RELAY_ENGINE=compact no README).
+
+Uso: python bench/loopback_bench.py [--mode classic|mux|pool] [--engine stream] [--json saida.json]
+         [--rss-budget KIB]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PHASES = ("tcp", "http", "bulk", "idle", "api")
+API_KEY = "bench"
+BULK_CHUNK = 256 * 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("classic", "mux", "pool"), default="classic", help="modo do cliente")
+    parser.add_argument("--engine", default="stream", help="RELAY_ENGINE do servidor e do cliente")
+    parser.add_argument("--pool", type=int, default=8, help="POOL_COUNT no modo pool")
+    parser.add_argument("--phases", default=",".join(PHASES), help="fases a executar, separadas por vírgula")
+    parser.add_argument("--connections", type=int, default=2000, help="conexões nas fases tcp e http")
+    parser.add_argument("--concurrency", type=int, default=50, help="conexões simultâneas nas fases tcp e http")
+    parser.add_argument("--bulk-mb", type=int, default=256, help="MB enviados (e ecoados) na fase bulk")
+    parser.add_argument("--idle", type=int, default=1000, help="conexões abertas simultâneas na fase idle")
+    parser.add_argument("--churn", type=int, default=500, help="ciclos criar/mapear/deletar na fase api")
+    parser.add_argument("--port-base", type=int, default=27000, help="primeira porta usada no loopback")
+    parser.add_argument("--rss-budget", type=float, metavar="KIB",
+                        help="falha se a fase idle passar deste RSS por conexão (KiB)")
+    parser.add_argument("--json", metavar="ARQUIVO", help="grava o resultado em JSON ('-' para stdout)")
+    parser.add_argument("--verbose", action="store_true", help="mostra os logs do servidor e do cliente")
+    return parser.parse_args()
+
+
+def configure_env(args):
+    """As configurações de server.py e client.py são lidas do ambiente na importação."""
+    base = args.port_base
+    os.environ.update({
+        "SERVER_IP": "127.0.0.1",
+        "FRP_PORT": str(base),
+        "SERVER_PORT": str(base),
+        "HTTP_PORT": str(base + 1),
+        "API_PORT": str(base + 4),
+        "PUBLIC_PORT_START": str(base + 100),
+        "PUBLIC_PORT_END": str(base + 199),
+        "BASE_DOMAIN": "bench.local",
+        "API_SECRET_KEY": API_KEY,
+        "RELAY_ENGINE": args.engine,
+    })
+    os.environ.pop("BOT_CALLBACK_URL", None)
+    for name in ("server", "client"):
+        sys.path.insert(0, os.path.join(HERE, "..", name))
+
+
+# --- Métricas ---
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    pick = lambda p: ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))]
+    return {
+        "p50_ms": pick(50) * 1000,
+        "p90_ms": pick(90) * 1000,
+        "p99_ms": pick(99) * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Sem /proc: pico de RSS (KiB no Linux, bytes no macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+async def run_pool(count, concurrency, job):
+    """Executa job(i) 'count' vezes com no máximo 'concurrency' em paralelo; retorna (latências, falhas, duração)."""
+    latencies, failures = [], 0
+    queue = iter(range(count))
+
+    async def worker():
+        nonlocal failures
+        for i in queue:
+            start = time.perf_counter()
+            try:
+                await job(i)
+            except (OSError, asyncio.IncompleteReadError, AssertionError):
+                failures += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, failures, time.perf_counter() - start
+
+
+# --- Serviços locais de teste ---
+
+async def echo_service(reader, writer):
+    try:
+        while True:
+            data = await reader.read(BULK_CHUNK)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+HTTP_BODY = b"ok" * 256
+HTTP_RESPONSE = (
+    b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nConnection: close\r\n"
+    b"Content-Length: " + str(len(HTTP_BODY)).encode() + b"\r\n\r\n" + HTTP_BODY
+)
+
+
+async def http_service(reader, writer):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(HTTP_RESPONSE)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+# --- Bancada ---
+
+class Bench:
+    def __init__(self, args, server, client):
+        self.args = args
+        self.server = server
+        self.client = client
+        self.api = None
+        base = args.port_base
+        self.echo_port = base + 2
+        self.http_service_port = base + 3
+
+    async def __aenter__(self):
+        import httpx
+
+        server = self.server
+        self._servers = [
+            await asyncio.start_server(server.handle_frp_client, server.SERVER_IP, server.FRP_PORT),
+            await asyncio.start_server(server.handle_http_connection, server.SERVER_IP, server.HTTP_PORT),
+            await asyncio.start_server(echo_service, "127.0.0.1", self.echo_port),
+            await asyncio.start_server(http_service, "127.0.0.1", self.http_service_port),
+        ]
+        self.api = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=server.api), base_url="http://bench", headers={"X-API-Key": API_KEY}
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.api.aclose()
+        for srv in self._servers:
+            srv.close()
+        # Deixa conexões em encerramento terminarem antes de asyncio.run cancelá-las.
+        pending = asyncio.all_tasks() - {asyncio.current_task()}
+        if pending:
+            await asyncio.wait(pending, timeout=2)
+
+    async def create_tunnel(self, local_port):
+        response = await self.api.post("/tunnels", params={"user_id": "bench", "local_port": local_port})
+        response.raise_for_status()
+        return response.json()
+
+    @contextlib.asynccontextmanager
+    async def tunnel_client(self, local_port, subdomain=None):
+        """Cria um túnel, conecta o cliente a ele e o remove ao final."""
+        created = await self.create_tunnel(local_port)
+        tunnel_id = created["tunnel_id"]
+        if subdomain:
+            response = await self.api.put(f"/tunnels/{tunnel_id}/domain", params={"subdomain": subdomain})
+            response.raise_for_status()
+
+        client = self.client
+        client.TUNNEL_ID = tunnel_id
+        client.targets.clear()  # run_client acumula os túneis em 'targets'; cada fase usa só o seu
+        client.LOCAL_PORT = local_port
+        client.MUX = self.args.mode == "mux"
+        client.POOL_COUNT = self.args.pool if self.args.mode == "pool" else 0
+        task = asyncio.create_task(client.run_client())
+        try:
+            for _ in range(100):
+                tunnel = self.server.registry.get(tunnel_id)
+                if tunnel and tunnel.connected:
+                    break
+                await asyncio.sleep(0.05)
+            else:
+                raise RuntimeError("cliente não conectou ao túnel")
+            await asyncio.sleep(0.2)  # Deixa o pool pré-aquecer
+            yield created
+        finally:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+            await self.api.delete(f"/tunnels/{tunnel_id}")
+
+    # --- Fases ---
+
+    async def phase_tcp(self):
+        async with self.tunnel_client(self.echo_port) as tunnel:
+            port = tunnel["public_port"]
+            payload = b"x" * 64
+
+            async def job(_):
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                try:
+                    writer.write(payload)
+                    assert await reader.readexactly(len(payload)) == payload
+                finally:
+                    writer.close()
+
+            latencies, failures, elapsed = await run_pool(self.args.connections, self.args.concurrency, job)
+        return {"requests": len(latencies), "failures": failures, "req_per_s": len(latencies) / elapsed,
+                "setup_latency": percentiles(latencies)}
+
+    async def phase_http(self):
+        async with self.tunnel_client(self.http_service_port, subdomain="bench"):
+            request = (
+                f"GET / HTTP/1.1\r\nHost: bench.{self.server.BASE_DOMAIN}\r\nConnection: close\r\n\r\n"
+            ).encode()
+
+            async def job(_):
+                reader, writer = await asyncio.open_connection("127.0.0.1", self.server.HTTP_PORT)
+                try:
+                    writer.write(request)
+                    response = await reader.read()
+                    assert response.startswith(b"HTTP/1.1 200") and response.endswith(HTTP_BODY)
+                finally:
+                    writer.close()
+
+            latencies, failures, elapsed = await run_pool(self.args.connections, self.args.concurrency, job)
+        return {"requests": len(latencies), "failures": failures, "req_per_s": len(latencies) / elapsed,
+                "latency": percentiles(latencies)}
+
+    async def phase_bulk(self):
+        total = self.args.bulk_mb * 1024 * 1024
+        chunk = os.urandom(BULK_CHUNK)
+        async with self.tunnel_client(self.echo_port) as tunnel:
+            reader, writer = await asyncio.open_connection("127.0.0.1", tunnel["public_port"])
+
+            async def send():
+                sent = 0
+                while sent < total:
+                    writer.write(chunk)
+                    await writer.drain()
+                    sent += len(chunk)
+
+            async def receive():
+                received = 0
+                while received < total:
+                    data = await reader.read(BULK_CHUNK)
+                    if not data:
+                        raise ConnectionError("conexão encerrada durante o bulk")
+                    received += len(data)
+
+            cpu_start, start = time.process_time(), time.perf_counter()
+            await asyncio.gather(send(), receive())
+            elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+            # Encerra pelo caminho normal (half-close até o eco e de volta) antes de remover o túnel.
+            writer.write_eof()
+            await asyncio.wait_for(reader.read(), 10)
+            writer.close()
+
+        # O payload atravessa o túnel duas vezes (ida até o eco e volta).
+        tunneled_gb = 2 * total / 1e9
+        return {"bytes": total, "seconds": elapsed, "mb_per_s": total / elapsed / 1e6,
+                "cpu_seconds": cpu, "cpu_s_per_gb": cpu / tunneled_gb}
+
+    async def phase_idle(self):
+        # Cada conexão pelo túnel ocupa até 6 descritores neste processo
+        # (visitante, público, canal de dados x2, local x2).
+        count = min(self.args.idle, max(1, (raise_fd_limit() - 256) // 6))
+        async with self.tunnel_client(self.echo_port) as tunnel:
+            port = tunnel["public_port"]
+            opened = []
+            baseline = rss_bytes()
+
+            async def job(_):
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                opened.append(writer)
+                writer.write(b"ping")
+                assert await reader.readexactly(4) == b"ping"
+
+            latencies, failures, _ = await run_pool(count, self.args.concurrency, job)
+            await asyncio.sleep(0.2)
+            grown = rss_bytes() - baseline
+            for writer in opened:
+                writer.close()
+        established = len(latencies)
+        return {"connections": established, "failures": failures, "rss_delta_bytes": grown,
+                "rss_per_1k_mb": grown / max(1, established) * 1000 / 1e6,
+                "rss_per_connection_kib": grown / max(1, established) / 1024}
+
+    async def phase_api(self):
+        async def job(i):
+            created = await self.create_tunnel(self.echo_port)
+            tunnel_id = created["tunnel_id"]
+            response = await self.api.put(f"/tunnels/{tunnel_id}/domain", params={"subdomain": f"churn{i}"})
+            assert response.status_code == 200
+            response = await self.api.delete(f"/tunnels/{tunnel_id}")
+            assert response.status_code == 204
+
+        latencies, failures, elapsed = await run_pool(self.args.churn, min(10, self.args.concurrency), job)
+        return {"cycles": len(latencies), "failures": failures, "ops_per_s": 3 * len(latencies) / elapsed,
+                "cycle_latency": percentiles(latencies)}
+
+
+async def run(args, server, client):
+    results = {"config": {
+        "mode": args.mode, "engine": args.engine, "connections": args.connections,
+        "concurrency": args.concurrency, "bulk_mb": args.bulk_mb, "idle": args.idle, "churn": args.churn,
+        "python": sys.version.split()[0], "platform": sys.platform,
+    }}
+    async with Bench(args, server, client) as bench:
+        for phase in args.phases.split(","):
+            results[phase] = await getattr(bench, f"phase_{phase}")()
+    return results
+
+
+def report(results):
+    config = results["config"]
+    print(f"--- Loopback: modo {config['mode']}, motor {config['engine']} ---")
+    if "tcp" in results:
+        r = results["tcp"]
+        lat = r["setup_latency"]
+        print(f"tcp   {r['req_per_s']:>10.0f} req/s   abertura p50 {lat['p50_ms']:.2f} ms  "
+              f"p99 {lat['p99_ms']:.2f} ms   falhas {r['failures']}")
+    if "http" in results:
+        r = results["http"]
+        lat = r["latency"]
+        print(f"http  {r['req_per_s']:>10.0f} req/s   p50 {lat['p50_ms']:.2f} ms  "
+              f"p99 {lat['p99_ms']:.2f} ms   falhas {r['failures']}")
+    if "bulk" in results:
+        r = results["bulk"]
+        print(f"bulk  {r['mb_per_s']:>10.1f} MB/s    CPU {r['cpu_s_per_gb']:.2f} s/GB")
+    if "idle" in results:
+        r = results["idle"]
+        print(f"idle  {r['rss_per_1k_mb']:>10.1f} MB RSS por 1k conexões ({r['connections']} abertas)")
+    if "api" in results:
+        r = results["api"]
+        lat = r["cycle_latency"]
+        print(f"api   {r['ops_per_s']:>10.0f} ops/s   ciclo p50 {lat['p50_ms']:.2f} ms  p99 {lat['p99_ms']:.2f} ms")
+
+
+def main():
+    args = parse_args()
+    unknown = set(args.phases.split(",")) - set(PHASES)
+    if unknown:
+        raise SystemExit(f"Fases desconhecidas: {', '.join(sorted(unknown))} (use {', '.join(PHASES)})")
+    configure_env(args)
+
+    import client  # noqa: E402
+    import server  # noqa: E402
+
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    with quiet:
+        results = asyncio.run(run(args, server, client))
+
+    report(results)
+    if args.json == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.rss_budget and "idle" in results:
+        idle = results["idle"]
+        if idle["failures"] or idle["rss_per_connection_kib"] > args.rss_budget:
+            raise SystemExit(
+                f"idle: {idle['rss_per_connection_kib']:.1f} KiB por conexão ({idle['failures']} falhas); "
+                f"orçamento de {args.rss_budget:g} KiB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Microbenchmark do custo de limpeza por conexão encerrada.
+
+Compara a varredura linear antiga (procurar o control_writer em todos os
+túneis) com a busca indexada do TunnelRegistry, de 10 a 100k túneis.
+O custo do registro deve permanecer constante.
+
+Uso: python bench/registry_bench.py [--closes N]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+from registry import Tunnel, TunnelRegistry  # noqa: E402
+
+SIZES = (10, 100, 1_000, 10_000, 100_000)
+
+
+class FakeWriter:
+    """Substituto de StreamWriter: só precisa ser hashável por identidade."""
+    __slots__ = ()
+
+
+def build(size):
+    registry = TunnelRegistry()
+    legacy = {}
+    writers = []
+    for i in range(size):
+        tunnel_id = f"t{i}"
+        writer = FakeWriter()
+        registry.attach_control(registry.add(Tunnel(tunnel_id, f"u{i % 97}", 8080, 30000 + i)), writer, None)
+        legacy[tunnel_id] = {"control_writer": writer}
+        writers.append(writer)
+    return registry, legacy, writers
+
+
+def per_close_registry(registry, writers, closes):
+    # Fechamento de conexões DATA (não pertencem a nenhum túnel): caso mais comum.
+    stray = FakeWriter()
+    start = time.perf_counter()
+    for _ in range(closes):
+        registry.detach_control(stray)
+    data_close = (time.perf_counter() - start) / closes
+
+    # Fechamento de conexões de controle: desassocia e reassocia o mesmo túnel.
+    sample = writers[: min(len(writers), closes)]
+    start = time.perf_counter()
+    for writer in sample:
+        tunnel = registry.detach_control(writer)
+        registry.attach_control(tunnel, writer, None)
+    control_close = (time.perf_counter() - start) / len(sample)
+    return data_close, control_close
+
+
+def per_close_legacy(legacy, closes):
+    stray = FakeWriter()
+    # Limita o número de repetições para tamanhos grandes, onde cada varredura é lenta.
+    closes = max(1, min(closes, 2_000_000 // max(1, len(legacy))))
+    start = time.perf_counter()
+    for _ in range(closes):
+        for tid, data in list(legacy.items()):
+            if data.get("control_writer") == stray:
+                break
+    return (time.perf_counter() - start) / closes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--closes", type=int, default=10_000, help="fechamentos medidos por tamanho")
+    args = parser.parse_args()
+
+    print(f"{'túneis':>8} | {'varredura (µs)':>15} | {'registro DATA (µs)':>18} | {'registro CONTROL (µs)':>21}")
+    for size in SIZES:
+        registry, legacy, writers = build(size)
+        data_close, control_close = per_close_registry(registry, writers, args.closes)
+        scan = per_close_legacy(legacy, args.closes)
+        print(f"{size:>8} | {scan * 1e6:>15.2f} | {data_close * 1e6:>18.3f} | {control_close * 1e6:>21.3f}")
+
+
+if __name__ == "__main__":
+    main()
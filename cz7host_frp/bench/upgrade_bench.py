@@ -0,0 +1,260 @@
+"""
+Benchmark de atualização sem interrupção (POST /admin/upgrade).
+
+Sobe server.py e client.py como processos, em 127.0.0.1, contra um serviço
+local de eco, e mantém visitantes abrindo conexões sem parar pela porta
+pública (tcp) e pelo proxy de HTTP_PORT (http) enquanto o servidor é trocado
+pela versão em disco. Mede, por caminho:
+
+- conexões recusadas (ECONNREFUSED) e a janela entre a primeira e a última;
+- falhas (conexão aceita mas sem resposta completa) e a pior latência;
+- tempo até o processo antigo sair.
+
+O objetivo é zero recusas; --max-refused transforma o resultado em
+verificação (o benchmark termina com erro acima do limite ou com falhas).
+
+Uso: python bench/upgrade_bench.py [--mode classic|mux|pool] [--duration 20] [--upgrade-at 5]
+         [--max-refused 0] [--json saida.json]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..")
+API_KEY = "bench"
+PATHS = ("tcp", "http")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("classic", "mux", "pool"), default="classic", help="modo do cliente")
+    parser.add_argument("--duration", type=float, default=20, help="segundos de carga")
+    parser.add_argument("--upgrade-at", type=float, default=5, help="segundos de carga antes da atualização")
+    parser.add_argument("--concurrency", type=int, default=8, help="visitantes simultâneos por caminho")
+    parser.add_argument("--port-base", type=int, default=28000, help="primeira porta usada no loopback")
+    parser.add_argument("--max-refused", type=int, metavar="N",
+                        help="falha se houver mais de N recusas (ou alguma falha)")
+    parser.add_argument("--json", metavar="ARQUIVO", help="grava o resultado em JSON ('-' para stdout)")
+    return parser.parse_args()
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        base = args.port_base
+        self.frp_port, self.http_port, self.local_port, self.api_port = base, base + 1, base + 2, base + 4
+        self.logs = tempfile.mkdtemp(prefix="upgrade_bench-")
+        self.env = dict(
+            os.environ, SERVER_IP="127.0.0.1", FRP_PORT=str(base), SERVER_PORT=str(base), HTTP_PORT=str(base + 1),
+            API_PORT=str(base + 4), PUBLIC_PORT_START=str(base + 100), PUBLIC_PORT_END=str(base + 199),
+            BASE_DOMAIN="bench.local", API_SECRET_KEY=API_KEY, STATE_DIR=os.path.join(self.logs, "state"),
+            CACHE_DIR="", PYTHONUNBUFFERED="1",
+        )
+        self.env.pop("BOT_CALLBACK_URL", None)
+        self.processes = []
+        self.successor = None  # pid do processo novo, que não é filho deste
+
+    def start(self, name, script, **env):
+        log = open(os.path.join(self.logs, f"{name}.log"), "w")
+        process = subprocess.Popen(
+            [sys.executable, script], env=dict(self.env, **env), cwd=os.path.dirname(script),
+            stdout=log, stderr=subprocess.STDOUT,
+        )
+        self.processes.append(process)
+        return process
+
+    def api(self, method, path):
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{self.api_port}{path}", method=method, headers={"X-API-Key": API_KEY}
+        )
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return json.loads(response.read() or b"null")
+
+    async def wait_api(self):
+        for _ in range(200):
+            try:
+                return await asyncio.to_thread(self.api, "GET", "/stats")
+            except (OSError, urllib.error.URLError):
+                await asyncio.sleep(0.1)
+        raise RuntimeError("a API do servidor não respondeu")
+
+    async def wait_connected(self, tunnel_id):
+        for _ in range(200):
+            tunnel = await asyncio.to_thread(self.api, "GET", f"/tunnels/{tunnel_id}")
+            if tunnel["connected"]:
+                return
+            await asyncio.sleep(0.1)
+        raise RuntimeError("cliente não conectou ao túnel")
+
+    def stop(self):
+        if self.successor:
+            with contextlib.suppress(OSError):
+                os.kill(self.successor, signal.SIGTERM)
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+async def local_service(reader, writer):
+    """Eco; requisições HTTP recebem uma resposta com a requisição no corpo (vale para HTTP_MODE=proxy)."""
+    try:
+        data = await reader.read(65536)
+        if data.startswith(b"GET "):
+            writer.write(b"HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: %d\r\n\r\n" % len(data) + data)
+            await writer.drain()
+            return
+        while data:
+            writer.write(data)
+            await writer.drain()
+            data = await reader.read(65536)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+class Visitors:
+    """Visitantes que se conectam sem parar por um caminho, contando recusas e falhas."""
+
+    def __init__(self, name, port, payload, expect):
+        self.name = name
+        self.port = port
+        self.payload = payload
+        self.expect = expect
+        self.attempts = 0
+        self.refused = []   # instantes (monotonic) das recusas
+        self.failures = 0
+        self.worst = 0.0
+
+    async def visit(self):
+        start = time.monotonic()
+        self.attempts += 1
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        except ConnectionRefusedError:
+            self.refused.append(start)
+            return
+        try:
+            writer.write(self.payload)
+            await writer.drain()
+            data = b""
+            while self.expect not in data:
+                chunk = await asyncio.wait_for(reader.read(65536), 10)
+                if not chunk:
+                    break
+                data += chunk
+            if self.expect not in data:
+                self.failures += 1
+        except (OSError, asyncio.TimeoutError):
+            self.failures += 1
+        finally:
+            writer.close()
+        self.worst = max(self.worst, time.monotonic() - start)
+
+    async def run(self, until):
+        while time.monotonic() < until:
+            await self.visit()
+
+    def result(self):
+        window = self.refused[-1] - self.refused[0] if self.refused else 0.0
+        return {
+            "attempts": self.attempts, "refused": len(self.refused), "refusal_window_ms": window * 1000,
+            "failures": self.failures, "worst_latency_ms": self.worst * 1000,
+        }
+
+
+async def run(args, bench):
+    local = await asyncio.start_server(local_service, "127.0.0.1", bench.local_port)
+    try:
+        return await measure(args, bench)
+    finally:
+        local.close()
+        await asyncio.to_thread(bench.stop)
+        await asyncio.sleep(0.2)  # Deixa as conexões do serviço local verem o fim do cliente
+
+
+async def measure(args, bench):
+    server = bench.start("server", os.path.join(ROOT, "server", "server.py"))
+    await bench.wait_api()
+    tunnel = await asyncio.to_thread(
+        bench.api, "POST", f"/tunnels?user_id=bench&local_port={bench.local_port}"
+    )
+    tunnel_id = tunnel["tunnel_id"]
+    await asyncio.to_thread(bench.api, "PUT", f"/tunnels/{tunnel_id}/domain?subdomain=up")
+    bench.start(
+        "client", os.path.join(ROOT, "client", "client.py"), TUNNEL_ID=tunnel_id, LOCAL_IP="127.0.0.1",
+        LOCAL_PORT=str(bench.local_port), MUX="1" if args.mode == "mux" else "0",
+        POOL_COUNT="8" if args.mode == "pool" else "0",
+    )
+    await bench.wait_connected(tunnel_id)
+
+    request = b"GET / HTTP/1.1\r\nHost: up.bench.local\r\nConnection: close\r\n\r\n"
+    paths = [
+        Visitors("tcp", tunnel["public_port"], b"ping", b"ping"),
+        Visitors("http", bench.http_port, request, b"Host: up.bench.local"),
+    ]
+    until = time.monotonic() + args.duration
+    load = [asyncio.create_task(v.run(until)) for v in paths for _ in range(args.concurrency)]
+
+    await asyncio.sleep(args.upgrade_at)
+    started = time.monotonic()
+    reply = await asyncio.to_thread(bench.api, "POST", "/admin/upgrade")
+    bench.successor = reply["pid"]
+    while server.poll() is None and time.monotonic() < until:
+        await asyncio.sleep(0.05)
+    retired = time.monotonic() - started if server.poll() is not None else None
+    await asyncio.gather(*load)
+    return {
+        "config": {"mode": args.mode, "duration": args.duration, "concurrency": args.concurrency},
+        "old_process_exit_s": retired,
+        **{v.name: v.result() for v in paths},
+    }
+
+
+def report(results):
+    print(f"--- Atualização: modo {results['config']['mode']} ---")
+    retired = results["old_process_exit_s"]
+    print("processo antigo saiu em " + (f"{retired:.2f}s" if retired is not None else "(não saiu)"))
+    for name in PATHS:
+        r = results[name]
+        print(f"{name:<5} {r['attempts']:>7} conexões   recusadas {r['refused']} "
+              f"(janela {r['refusal_window_ms']:.0f} ms)   falhas {r['failures']}   "
+              f"pior {r['worst_latency_ms']:.0f} ms")
+
+
+def main():
+    args = parse_args()
+    bench = Bench(args)
+    results = asyncio.run(run(args, bench))
+    report(results)
+    print(f"Logs em {bench.logs}")
+    if args.json == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.max_refused is not None:
+        refused = sum(results[name]["refused"] for name in PATHS)
+        failures = sum(results[name]["failures"] for name in PATHS)
+        if refused > args.max_refused or failures or results["old_process_exit_s"] is None:
+            raise SystemExit(f"{refused} recusas e {failures} falhas durante a atualização (limite: {args.max_refused})")
+
+
+if __name__ == "__main__":
+    main()
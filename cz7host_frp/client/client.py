@@ -1,7 +1,17 @@
 import asyncio
+import math
 import os
+import random
+import socket
+import time
 from dotenv import load_dotenv
 
+from accesslog import AccessLog
+from compression import CompressionStats, compressed_channel
+from datagram import DatagramSocket, FrameWriter, read_frames, udp_socket
+from mux import MuxSession, read_stream_header
+from relay import RELAY_ENGINES, RelayMeter, relay
+
 load_dotenv()
 
 # --- Configurações do Cliente ---
@@ -11,100 +21,620 @@ LOCAL_IP = os.getenv("LOCAL_IP", "127.0.0.1")
 LOCAL_PORT = int(os.getenv("LOCAL_PORT", 8080))
 # O TUNNEL_ID será fornecido pelo bot do Discord após criar o túnel via API.
 TUNNEL_ID = os.getenv("TUNNEL_ID")
+# Arquivo com vários túneis, um por linha: '<TUNNEL_ID> [IP_LOCAL:]PORTA_LOCAL'.
+# Todos usam uma única conexão de controle; substitui TUNNEL_ID/LOCAL_PORT.
+TUNNELS_FILE = os.getenv("TUNNELS_FILE")
+# Multiplexa todas as conexões sobre o canal de controle (requer servidor compatível).
+MUX = os.getenv("MUX", "0") == "1"
+# Pool de canais de dados pré-aquecidos: mínimo e máximo de conexões ociosas (0 desativa).
+POOL_COUNT = int(os.getenv("POOL_COUNT", 0))
+POOL_MAX = int(os.getenv("POOL_MAX", 32))
+# Comprime os canais de dados com zlib (negociado com o servidor; não se aplica ao modo mux).
+COMPRESSION = os.getenv("COMPRESSION", "0") == "1"
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", 6))
+# Reconecta automaticamente quando a conexão de controle cai, com espera
+# exponencial (em segundos) e aleatória para não sobrecarregar o servidor.
+RECONNECT = os.getenv("RECONNECT", "1") == "1"
+RECONNECT_MIN = float(os.getenv("RECONNECT_MIN", 1))
+RECONNECT_MAX = float(os.getenv("RECONNECT_MAX", 60))
+# Responde aos heartbeats do servidor e reconecta se ele passar HEARTBEAT_MISSES
+# intervalos sem enviar nenhum (servidor ou rede caídos sem fechar a conexão).
+HEARTBEAT = os.getenv("HEARTBEAT", "1") == "1"
+HEARTBEAT_MISSES = int(os.getenv("HEARTBEAT_MISSES", 3))
+# Motor de encaminhamento: stream (padrão), buffered, splice (Linux) ou auto.
+RELAY_ENGINE = os.getenv("RELAY_ENGINE", "stream")
+if RELAY_ENGINE not in RELAY_ENGINES:
+    raise SystemExit(f"RELAY_ENGINE inválido: {RELAY_ENGINE} (use {', '.join(RELAY_ENGINES)})")
+# Registro de acesso: uma linha JSON por conexão com o serviço local (túnel,
+# endereço local, bytes, duração e motivo do fechamento) em ACCESS_LOG (vazio
+# desativa), com rotação e amostragem como no servidor.
+ACCESS_LOG = os.getenv("ACCESS_LOG", "")
+ACCESS_LOG_MAX_MB = int(os.getenv("ACCESS_LOG_MAX_MB", 64))
+ACCESS_LOG_BACKUPS = int(os.getenv("ACCESS_LOG_BACKUPS", 5))
+ACCESS_LOG_RATE = int(os.getenv("ACCESS_LOG_RATE", 1000))
 
-# --- Lógica de Encaminhamento (Proxy) ---
+# Mensagens e registros de acesso saem por uma thread, sem bloquear o loop no stdout.
+access_log = AccessLog(ACCESS_LOG, ACCESS_LOG_MAX_MB * 1024 * 1024, ACCESS_LOG_BACKUPS, ACCESS_LOG_RATE)
+log = access_log.log
+# Tarefas em segundo plano. O loop só guarda referências fracas a elas, e
+# StreamReaders de open_connection também: sem isto, um canal de dados em
+# pleno relay pode ser coletado pelo GC.
+background_tasks = set()
+# Contadores da compressão; definido quando o servidor aceita 'zlib' no handshake.
+compression = None
+# Túneis servidos: {tunnel_id: (ip local, porta local)}.
+targets = {}
+# Túneis UDP, informados pelo servidor no handshake: seus canais levam datagramas em frames.
+udp_tunnels = set()
+# Endereços já resolvidos dos serviços locais: {(host, porta): (ip, porta)}; refeitos se a conexão falhar.
+resolved = {}
 
-async def forward_data(reader, writer, connection_name):
-    """Lê dados de um 'reader' e os escreve em um 'writer'."""
-    try:
-        while not reader.at_eof():
-            data = await reader.read(4096)
-            if not data:
-                break
-            writer.write(data)
-            await writer.drain()
-    except (ConnectionResetError, asyncio.IncompleteReadError, BrokenPipeError):
-        pass # Silencioso para não poluir o log
-    finally:
-        writer.close()
-        await writer.wait_closed()
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 # --- Gerenciamento do Canal de Dados ---
 
-async def create_data_channel(token):
+def load_tunnels():
+    """Túneis deste cliente: os de TUNNELS_FILE ou, sem ele, TUNNEL_ID -> LOCAL_IP:LOCAL_PORT."""
+    if not TUNNELS_FILE:
+        return {TUNNEL_ID: (LOCAL_IP, LOCAL_PORT)} if TUNNEL_ID else {}
+    tunnels = {}
+    with open(TUNNELS_FILE) as f:
+        for number, line in enumerate(f, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            try:
+                tunnel_id, target = line.split()
+                host, _, port = target.rpartition(":")
+                tunnels[tunnel_id] = (host or LOCAL_IP, int(port))
+            except ValueError:
+                raise SystemExit(f"{TUNNELS_FILE}:{number}: use '<TUNNEL_ID> [IP_LOCAL:]PORTA_LOCAL'")
+    return tunnels
+
+def local_address(tunnel_id):
+    host, port = targets[tunnel_id]
+    return f"{host}:{port}"
+
+async def open_local(tunnel_id):
+    """Conecta ao serviço local do túnel, resolvendo o nome dele uma única vez."""
+    target = targets[tunnel_id]
+    address = resolved.get(target)
+    if address is None:
+        infos = await asyncio.get_running_loop().getaddrinfo(*target, type=socket.SOCK_STREAM)
+        address = resolved[target] = infos[0][4][:2]
+    try:
+        return await asyncio.open_connection(*address)
+    except OSError:
+        resolved.pop(target, None)
+        raise
+
+async def create_data_channel(token, tunnel_id, control_writer):
     """
     Cria uma nova conexão com o servidor para servir como um canal de dados
-    e a conecta ao serviço local.
+    e a conecta ao serviço local do túnel. As duas conexões são abertas em
+    paralelo; se o serviço local não responder, o servidor recebe FAIL e
+    responde ao visitante sem esperar o prazo do token.
     """
+    # Túneis UDP não têm conexão local única: cada sessão abre o próprio socket.
+    local_dial = asyncio.sleep(0) if tunnel_id in udp_tunnels else open_local(tunnel_id)
+    server, local = await asyncio.gather(
+        asyncio.open_connection(SERVER_IP, SERVER_PORT), local_dial, return_exceptions=True
+    )
+    if isinstance(local, Exception):
+        log(f"[ERRO] Não foi possível conectar ao serviço local em {local_address(tunnel_id)}.")
+        access(tunnel_id, "local_unreachable")
+        if not control_writer.is_closing():
+            control_writer.write(f"FAIL:{token}\n".encode())
+        if not isinstance(server, Exception):
+            server[1].close()
+        return
     try:
-        server_reader, server_writer = await asyncio.open_connection(SERVER_IP, SERVER_PORT)
-        server_writer.write(f"DATA:{token}\n".encode())
+        if isinstance(server, Exception):
+            raise server
+        server_reader, server_writer = server
+        server_writer.write(f"DATA:{token}{channel_options()}\n".encode())
         await server_writer.drain()
 
-        local_reader, local_writer = await asyncio.open_connection(LOCAL_IP, LOCAL_PORT)
+        await relay_to_local(server_reader, server_writer, tunnel_id, local)
 
-        # Inicia o proxy bidirecional
-        await asyncio.gather(
-            forward_data(server_reader, local_writer, "serv->loc"),
-            forward_data(local_reader, server_writer, "loc->serv")
-        )
-
-    except ConnectionRefusedError:
-        print(f"[ERRO] Não foi possível conectar ao serviço local em {LOCAL_IP}:{LOCAL_PORT}.")
     except Exception as e:
-        print(f"[ERRO] Falha ao criar canal de dados para {token}: {e}")
+        if local:
+            local[1].close()
+        log(f"[ERRO] Falha ao criar canal de dados para {token}: {e}")
+
+def channel_options():
+    """Opções das linhas DATA:/POOL:, conforme o que o servidor aceitou."""
+    return " zlib=1" if compression else ""
+
+async def relay_to_local(server_reader, server_writer, tunnel_id, local=None):
+    """
+    Conecta um canal de dados já ativo ao serviço local do túnel (ou à
+    conexão local já aberta, 'local') e inicia o proxy bidirecional.
+    """
+    if compression:
+        server_reader, server_writer = compressed_channel(server_reader, server_writer, COMPRESSION_LEVEL, compression)
+    if tunnel_id in udp_tunnels:
+        await relay_datagrams(server_reader, server_writer, tunnel_id)
+        return
+    local_reader, local_writer = local or await open_local(tunnel_id)
+
+    await relay_local(tunnel_id, server_reader, server_writer, local_reader, local_writer)
+
+async def relay_local(tunnel_id, server_reader, server_writer, local_reader, local_writer):
+    """relay() entre o servidor e o serviço local, com o registro de acesso da conexão ao terminar."""
+    if not access_log.enabled:
+        await relay(server_reader, server_writer, local_reader, local_writer, RELAY_ENGINE)
+        return
+    meter = RelayMeter()  # a_to_b = servidor -> serviço local
+    started, reason = time.monotonic(), "closed"
+    try:
+        await relay(server_reader, server_writer, local_reader, local_writer, RELAY_ENGINE, meter)
+    except asyncio.CancelledError:
+        reason = "cancelled"
+        raise
+    except Exception:
+        reason = "error"
+        raise
+    finally:
+        access(tunnel_id, reason, started, meter)
+
+def access(tunnel_id, reason, started=None, meter=None):
+    """Registro de acesso (ACCESS_LOG) de uma conexão com o serviço local do túnel."""
+    if not access_log.enabled:
+        return
+    record = {"tunnel": tunnel_id, "local": local_address(tunnel_id) if tunnel_id in targets else None}
+    if meter is not None:
+        record["bytes_in"] = meter.a_to_b.bytes
+        record["bytes_out"] = meter.b_to_a.bytes
+    if started is not None:
+        record["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+    record["reason"] = reason
+    access_log.record(record)
+
+async def relay_datagrams(server_reader, server_writer, tunnel_id):
+    """
+    Canal de um túnel UDP: cada sessão (um visitante no servidor) ganha um
+    socket UDP conectado ao serviço local, e as respostas dele voltam em frames.
+    """
+    loop = asyncio.get_running_loop()
+    host, port = targets[tunnel_id]
+    family, _, _, _, address = (await loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM))[0]
+    frames = FrameWriter()
+    sessions = {}  # {sessão: DatagramSocket}
+
+    def from_local(session):
+        def forward(batch):
+            for data, _ in batch:
+                frames.send(session, data)
+        return forward
+
+    def to_local(batch):
+        for session, payload in batch:
+            local = sessions.get(session)
+            if payload is None:
+                # Sessão expirou no servidor
+                if local:
+                    del sessions[session]
+                    local.close()
+                continue
+            if local is None:
+                sock = udp_socket(family)
+                sock.connect(address)
+                local = sessions[session] = DatagramSocket(sock, from_local(session))
+            local.sendto(payload)
+
+    pump = spawn(frames.run(server_writer))
+    try:
+        await read_frames(server_reader, to_local)
+    finally:
+        pump.cancel()
+        for local in sessions.values():
+            local.close()
+        server_writer.close()
+
+# --- Pool de Canais de Dados ---
+
+class DataChannelPool:
+    """
+    Mantém conexões DATA ociosas e já autenticadas junto ao servidor, para que
+    um visitante seja atendido sem esperar um handshake TCP até o servidor.
+
+    O tamanho alvo acompanha a taxa de chegada observada: esperamos ter
+    conexões suficientes para cobrir as chegadas durante o tempo de reposição.
+    """
+
+    ADJUST_INTERVAL = 1.0
+
+    def __init__(self, tunnel_id, minimum, maximum, replica=None):
+        self.tunnel_id = tunnel_id
+        self.replica = replica  # Id da conexão de controle no servidor (o pool é de cada réplica)
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.target = minimum
+        self.hits = 0
+        self.misses = 0
+        self._open = 0  # Conexões ociosas ou em abertura
+        self._idle_writers = set()
+        self._rate = 0.0  # Chegadas por segundo (EWMA)
+        self._arrivals = 0
+        self._dial_time = 0.05  # Tempo para abrir um canal (EWMA, segundos)
+        self._tasks = set()
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._spawn(asyncio.create_task(self._adjust_loop()))
+        self._fill()
+
+    def stop(self):
+        self._running = False
+        for task in list(self._tasks):
+            task.cancel()
+        for writer in list(self._idle_writers):
+            writer.close()
+
+    def retire(self):
+        """Para de repor canais; os ociosos ficam com o servidor, que os entrega ou aposenta."""
+        self._running = False
+
+    def record_miss(self):
+        """O servidor precisou sinalizar NEW_CONNECTION porque o pool estava vazio."""
+        self.misses += 1
+        self._arrivals += 1
+        self.target = min(self.maximum, self.target + 1)
+        self._fill()
+
+    def _spawn(self, task):
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
+    def _fill(self):
+        while self._running and self._open < self.target:
+            self._open += 1
+            self._spawn(asyncio.create_task(self._pooled_channel()))
+
+    async def _adjust_loop(self):
+        while self._running:
+            await asyncio.sleep(self.ADJUST_INTERVAL)
+            observed = self._arrivals / self.ADJUST_INTERVAL
+            self._arrivals = 0
+            self._rate = 0.7 * self._rate + 0.3 * observed
+
+            target = self.minimum + math.ceil(2 * self._rate * self._dial_time)
+            target = min(self.maximum, max(self.minimum, target))
+            if target != self.target:
+                log(f"[POOL {self.tunnel_id[:8]}] Alvo {self.target} -> {target} (taxa {self._rate:.1f}/s, acertos {self.hits}, faltas {self.misses})")
+                self.target = target
+
+            # Quando o tráfego diminui o pool encolhe sozinho: canais usados não
+            # são repostos acima do alvo, e o servidor aposenta os ociosos
+            # (POOL_IDLE_TIMEOUT). Fechá-los daqui competiria com a entrega de
+            # um canal a um visitante no servidor.
+            self._fill()
+
+    async def _pooled_channel(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        server_writer = None
+        try:
+            server_reader, server_writer = await asyncio.open_connection(SERVER_IP, SERVER_PORT)
+            replica = f" replica={self.replica}" if self.replica else ""
+            server_writer.write(f"POOL:{self.tunnel_id}{channel_options()}{replica}\n".encode())
+            await server_writer.drain()
+            self._dial_time = 0.8 * self._dial_time + 0.2 * (loop.time() - started)
+
+            self._idle_writers.add(server_writer)
+            signal = await server_reader.readline()
+        except OSError:
+            signal = b""
+        finally:
+            self._open -= 1
+            self._idle_writers.discard(server_writer)
+
+        if signal.strip() != b"START":
+            # Pool cheio no servidor, túnel removido ou conexão perdida:
+            # a reposição fica para o próximo ajuste periódico.
+            if server_writer:
+                server_writer.close()
+            return
+
+        self.hits += 1
+        self._arrivals += 1
+        self._fill()
+        try:
+            await relay_to_local(server_reader, server_writer, self.tunnel_id)
+        except (OSError, KeyError):
+            log(f"[ERRO] Não foi possível conectar ao serviço local do túnel {self.tunnel_id}.")
+            access(self.tunnel_id, "local_unreachable")
+            server_writer.close()
+
+
+async def handle_mux_stream(stream, multi=False):
+    """Conecta um stream aberto pelo servidor na sessão mux ao serviço local do túnel."""
+    try:
+        # Com vários túneis na sessão, o stream começa com o túnel de destino.
+        tunnel_id = await read_stream_header(stream) if multi else next(iter(targets))
+        if tunnel_id in udp_tunnels:
+            await relay_datagrams(stream, stream, tunnel_id)
+            return
+        local_reader, local_writer = await open_local(tunnel_id)
+    except (OSError, KeyError, asyncio.IncompleteReadError):
+        log("[ERRO] Não foi possível conectar um stream ao serviço local.")
+        stream.abort()
+        return
+
+    await relay_local(tunnel_id, stream, stream, local_reader, local_writer)
 
 # --- Ponto de Entrada Principal do Cliente ---
 
+class TunnelRejected(Exception):
+    """
+    O servidor recusou o túnel: 'not_found' (removido) ou 'in_use' (o túnel já
+    tem o máximo de clientes conectados). Com vários túneis, 'rejected' traz o motivo de cada um.
+    """
+
+    def __init__(self, reason, rejected=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.rejected = rejected or {}
+
+def parse_rejected(words):
+    """Lê 'rejected=<túnel>:<motivo>,...' da resposta ao handshake multi=1."""
+    for word in words:
+        if word.startswith("rejected="):
+            return dict(item.rsplit(":", 1) for item in word.split("=", 1)[1].split(","))
+    return {}
+
+def parse_heartbeat(words):
+    """Intervalo em segundos anunciado pelo servidor ('heartbeat=<s>'), ou None."""
+    for word in words:
+        if word.startswith("heartbeat="):
+            return float(word.split("=", 1)[1])
+    return None
+
+def parse_udp(words):
+    """Túneis UDP entre os aceitos ('udp=<túnel>,...')."""
+    for word in words:
+        if word.startswith("udp="):
+            return set(word.split("=", 1)[1].split(","))
+    return set()
+
+def parse_replica(words):
+    """Id desta conexão no servidor ('replica=<id>'), enviado nos canais POOL; ou None."""
+    for word in words:
+        if word.startswith("replica="):
+            return word.split("=", 1)[1]
+    return None
+
+async def watch_mux_heartbeat(session, interval):
+    """Fecha a sessão mux se o servidor parar de enviar PINGs."""
+    seen = session.pings_received
+    while not session.closed:
+        await asyncio.sleep(interval * (HEARTBEAT_MISSES + 1))
+        if session.pings_received == seen:
+            log("[CONTROLE] Servidor sem heartbeat. Reconectando.")
+            session.close()
+            return
+        seen = session.pings_received
+
+async def open_control_channel(features):
+    """
+    Abre o canal de controle e faz o handshake. Retorna (reader, writer, aceitas, palavras da resposta).
+    Com opções solicitadas, aguarda a confirmação 'OK' do servidor; servidores
+    antigos não reconhecem as opções e encerram a conexão, e nesse caso retornamos None.
+    """
+    control_reader, control_writer = await asyncio.open_connection(SERVER_IP, SERVER_PORT)
+
+    # Identifica este cliente para os túneis pré-autorizados
+    options = "".join(f" {name}=1" for name in features)
+    control_writer.write(f"CONTROL:{','.join(targets)}{options}\n".encode())
+    await control_writer.drain()
+
+    if not features:
+        return control_reader, control_writer, set(), []
+
+    reply = await control_reader.readline()
+    words = reply.decode().split()
+    if not words:
+        control_writer.close()
+        return None
+    if words[0] == "ERR":
+        control_writer.close()
+        raise TunnelRejected(words[-1], parse_rejected(words))
+    accepted = {opt.split("=", 1)[0] for opt in words[1:] if opt.endswith("=1")}
+    return control_reader, control_writer, accepted, words
+
+def move_session(upgrade):
+    if not upgrade.is_set():
+        log("[CONTROLE] Servidor em atualização: abrindo uma sessão no processo novo.")
+        upgrade.set()
+
+def drop_tunnel(tunnel_id, pools):
+    """Deixa de servir um túnel removido no servidor."""
+    log(f"[CONTROLE] O túnel {tunnel_id} não existe mais no servidor e foi descartado.")
+    targets.pop(tunnel_id, None)
+    pool = pools.pop(tunnel_id, None)
+    if pool:
+        pool.stop()
+
 async def run_client():
     """
-    Estabelece o canal de controle com o servidor e escuta por comandos.
+    Mantém o túnel conectado: abre o canal de controle e, se ele cair,
+    reconecta ao mesmo TUNNEL_ID com espera exponencial e aleatória.
     """
-    if not TUNNEL_ID:
-        print("[ERRO] A variável de ambiente TUNNEL_ID não foi definida.")
-        print("Por favor, crie um túnel usando o bot do Discord e configure o TUNNEL_ID.")
+    targets.update(load_tunnels())
+    if not targets:
+        log("[ERRO] A variável de ambiente TUNNEL_ID (ou TUNNELS_FILE) não foi definida.")
+        log("Por favor, crie um túnel usando o bot do Discord e configure o TUNNEL_ID.")
         return
 
-    print("--- CZ7 Host FRP Client ---")
-    print(f"Conectando ao servidor em {SERVER_IP}:{SERVER_PORT}...")
-    print(f"Associando-se ao túnel: {TUNNEL_ID}")
-    print(f"Serviço local: http://{LOCAL_IP}:{LOCAL_PORT}")
+    log("--- CZ7 Host FRP Client ---")
+    log(f"Conectando ao servidor em {SERVER_IP}:{SERVER_PORT}...")
+    for tunnel_id in targets:
+        log(f"Associando-se ao túnel: {tunnel_id}")
+        log(f"Serviço local: http://{local_address(tunnel_id)}")
+
+    loop = asyncio.get_running_loop()
+    delay = RECONNECT_MIN
+    while True:
+        started = loop.time()
+        try:
+            if await run_session_until_upgrade():
+                # Servidor em atualização: a sessão nova vai ao processo novo, sem espera.
+                delay = RECONNECT_MIN
+                continue
+        except TunnelRejected as e:
+            for tunnel_id in [tid for tid, reason in e.rejected.items() if reason == "not_found"]:
+                targets.pop(tunnel_id, None)
+            if not targets or (e.reason != "in_use" and not e.rejected):
+                log("[ERRO] O servidor não conhece este túnel. Crie um novo com o bot do Discord.")
+                break
+            log("[CONTROLE] O túnel já tem o máximo de clientes conectados.")
+        except ConnectionRefusedError:
+            log(f"[ERRO] Conexão recusada. O servidor FRP está online em {SERVER_IP}:{SERVER_PORT}?")
+        except Exception as e:
+            log(f"[ERRO] Uma exceção inesperada ocorreu: {e}")
+
+        if not RECONNECT:
+            break
+        if loop.time() - started > RECONNECT_MAX:
+            delay = RECONNECT_MIN  # A sessão durou: a próxima queda recomeça do mínimo
+        wait = delay / 2 + random.uniform(0, delay / 2)
+        log(f"[CONTROLE] Reconectando em {wait:.1f}s...")
+        await asyncio.sleep(wait)
+        delay = min(RECONNECT_MAX, delay * 2)
 
+    log("Cliente encerrado.")
+
+async def run_session_until_upgrade():
+    """
+    Roda uma sessão até ela terminar ou o servidor pedir uma nova (UPGRADE ou
+    GO_AWAY, numa atualização). Retorna True no segundo caso: a sessão antiga
+    continua atendendo em segundo plano até o servidor antigo encerrá-la.
+    """
+    upgrade = asyncio.Event()
+    session = spawn(run_session(upgrade))
+    asked = spawn(upgrade.wait())
+    await asyncio.wait({session, asked}, return_when=asyncio.FIRST_COMPLETED)
+    asked.cancel()
+    if session.done():
+        session.result()
+        return False
+    session.add_done_callback(lambda task: task.cancelled() or task.exception())
+    return True
+
+async def run_session(upgrade):
+    """
+    Estabelece o canal de controle com o servidor e escuta por comandos até
+    a conexão cair. 'upgrade' é sinalizado quando o servidor pede uma sessão nova.
+    """
+    global compression
+    pools = {}
+    compression = None
     try:
         # Conecta ao servidor para estabelecer o canal de controle
-        control_reader, control_writer = await asyncio.open_connection(SERVER_IP, SERVER_PORT)
+        features = ["mux"] if MUX else (["pool"] if POOL_COUNT > 0 else [])
+        if COMPRESSION and not MUX:
+            features.append("zlib")
+        if TUNNELS_FILE:
+            features.append("multi")
+        if HEARTBEAT:
+            features.append("heartbeat")
+        features.append("udp")
+        channel = await open_control_channel(features)
+        if channel is None:
+            if TUNNELS_FILE:
+                raise ConnectionError("o servidor não aceita vários túneis por conexão (TUNNELS_FILE)")
+            log("[CONTROLE] Servidor não aceitou as opções do handshake. Usando o modo clássico.")
+            channel = await open_control_channel([])
+        control_reader, control_writer, accepted, words = channel
+        rejected, heartbeat, replica = parse_rejected(words), parse_heartbeat(words), parse_replica(words)
+        udp_tunnels.clear()
+        udp_tunnels.update(parse_udp(words))
+        for tunnel_id, reason in rejected.items():
+            if reason == "not_found":
+                drop_tunnel(tunnel_id, pools)
+            else:
+                log(f"[CONTROLE] O túnel {tunnel_id} já tem o máximo de clientes conectados; nova tentativa na reconexão.")
+        served = [tunnel_id for tunnel_id in targets if tunnel_id not in rejected]
+
+        log("\nConexão de controle estabelecida. Aguardando tráfego...")
+        log("(Pressione Ctrl+C para sair)")
+
+        if "mux" in accepted:
+            log("[CONTROLE] Modo multiplexado ativo.")
+            multi = "multi" in accepted
+            session = MuxSession(control_reader, control_writer, on_stream=lambda s: handle_mux_stream(s, multi), client=True)
+            session.on_go_away = lambda: move_session(upgrade)
+            if heartbeat:
+                spawn(watch_mux_heartbeat(session, heartbeat))
+            await session.run()
+            log("[CONTROLE] Servidor encerrou a conexão.")
+            return
 
-        # Identifica este cliente para o túnel pré-autorizado
-        control_writer.write(f"CONTROL:{TUNNEL_ID}\n".encode())
-        await control_writer.drain()
+        if "zlib" in accepted:
+            compression = CompressionStats()
+            log(f"[ZLIB] Canais de dados comprimidos (nível {COMPRESSION_LEVEL}).")
 
-        print("\nConexão de controle estabelecida. Aguardando tráfego...")
-        print("(Pressione Ctrl+C para sair)")
+        if "pool" in accepted:
+            for tunnel_id in served:
+                pools[tunnel_id] = DataChannelPool(tunnel_id, POOL_COUNT, POOL_MAX, replica)
+                pools[tunnel_id].start()
+            log(f"[POOL] Mantendo de {POOL_COUNT} a {POOL_MAX} canais de dados pré-aquecidos por túnel.")
 
         # Loop principal do canal de controle: escuta por comandos do servidor
+        # Com heartbeat, o servidor envia ao menos um PING por intervalo.
+        timeout = heartbeat * (HEARTBEAT_MISSES + 1) if heartbeat else None
         while True:
-            server_command = await control_reader.readline()
+            try:
+                server_command = await asyncio.wait_for(control_reader.readline(), timeout)
+            except asyncio.TimeoutError:
+                log("[CONTROLE] Servidor sem heartbeat. Reconectando.")
+                control_writer.close()
+                break
             if not server_command:
-                print("[CONTROLE] Servidor encerrou a conexão.")
+                log("[CONTROLE] Servidor encerrou a conexão.")
                 break
 
             command_str = server_command.decode().strip()
-            if command_str.startswith("NEW_CONNECTION:"):
-                token = command_str.split(":", 1)[1]
+            if command_str.startswith("PING:"):
+                control_writer.write(f"PONG:{command_str[5:]}\n".encode())
+            elif command_str.startswith("NEW_CONNECTION:"):
+                # Com vários túneis, o sinal traz também o túnel de destino.
+                token, *rest = command_str.split(":", 1)[1].split()
+                tunnel_id = rest[0] if rest else served[0]
+                if tunnel_id not in targets:
+                    continue
+                if tunnel_id in pools:
+                    pools[tunnel_id].record_miss()
                 # Inicia a criação do canal de dados em uma nova tarefa para não bloquear
-                asyncio.create_task(create_data_channel(token))
+                spawn(create_data_channel(token, tunnel_id, control_writer))
+            elif command_str == "UPGRADE":
+                # Os canais do pool passam a ser abertos pela sessão nova.
+                for pool in pools.values():
+                    pool.retire()
+                move_session(upgrade)
+            elif command_str.startswith("REMOVED:"):
+                drop_tunnel(command_str.split(":", 1)[1], pools)
+                if not targets:
+                    raise TunnelRejected("not_found")
+            elif command_str.startswith("ERR"):
+                # Clientes sem opções no handshake recebem a recusa aqui.
+                raise TunnelRejected(command_str.split()[-1])
 
-    except ConnectionRefusedError:
-        print(f"[ERRO] Conexão recusada. O servidor FRP está online em {SERVER_IP}:{SERVER_PORT}?")
-    except Exception as e:
-        print(f"[ERRO] Uma exceção inesperada ocorreu: {e}")
     finally:
-        print("Cliente encerrado.")
+        for pool in pools.values():
+            pool.stop()
+        if compression and compression.plain:
+            log(f"[ZLIB] {compression.plain} bytes trafegaram como {compression.wire} (taxa {compression.ratio:.2f}).")
 
 
 if __name__ == "__main__":
     try:
         asyncio.run(run_client())
     except KeyboardInterrupt:
-        print("\nDesligando o cliente...")
\ No newline at end of file
+        log("\nDesligando o cliente...")
\ No newline at end of file
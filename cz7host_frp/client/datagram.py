@@ -0,0 +1,183 @@
+"""
+Túneis UDP: os datagramas trafegam entre servidor e cliente por um canal de
+fluxo comum (DATA, POOL ou stream mux), em frames
+
+    sessão (4) | tamanho (2) | datagrama
+
+Cada endereço de origem de visitantes é uma sessão; o tamanho CLOSE
+(maior que qualquer datagrama UDP) encerra a sessão no outro lado.
+
+Para manter baixo o custo por pacote, os dois caminhos trabalham em lotes:
+DatagramSocket lê até BATCH datagramas a cada vez que o socket fica legível
+(como recvmmsg) e FrameWriter junta os frames gerados numa volta do loop em
+uma única escrita no canal (como sendmmsg). Datagramas que não cabem no
+buffer do canal são descartados, como numa rede congestionada.
+
+Este arquivo existe, idêntico, em server/ e client/.
+"""
+import asyncio
+import socket
+import struct
+
+FRAME = struct.Struct("!IH")
+MAX_DATAGRAM = 65507
+CLOSE = 0xFFFF
+BATCH = 64
+READ_CHUNK = 256 * 1024
+CHANNEL_BUFFER_MAX = 1024 * 1024
+# Buffers do kernel dos sockets UDP: absorvem rajadas enquanto o loop está
+# ocupado (o kernel limita ao net.core.rmem_max/wmem_max).
+SOCKET_BUFFER = 4 * 1024 * 1024
+
+
+class FrameWriter:
+    """Frames a enviar por um canal; send() só enfileira, run() escreve em lotes."""
+
+    def __init__(self, limit=CHANNEL_BUFFER_MAX):
+        self.limit = limit
+        self.buffer = bytearray()
+        self.closing = set()  # Sessões encerradas com o buffer cheio: um CLOSE cada, no próximo lote
+        self.dropped = 0
+        self.closed = False
+        self._wakeup = asyncio.Event()
+
+    def send(self, session, payload):
+        """Enfileira um datagrama; False se ele foi descartado (canal fechado ou buffer cheio)."""
+        if self.closed or len(self.buffer) >= self.limit:
+            self.dropped += 1
+            return False
+        self.buffer += FRAME.pack(session, len(payload))
+        self.buffer += payload
+        self._wakeup.set()
+        return True
+
+    def close_session(self, session):
+        """
+        Enfileira o CLOSE da sessão. Com o buffer no limite (canal parado), ele
+        não cresce: a sessão entra em 'closing' e o CLOSE sai depois dos frames já
+        enfileirados, então uma onda de expirações ocupa no máximo um item por sessão.
+        """
+        if self.closed:
+            return
+        if len(self.buffer) >= self.limit:
+            self.closing.add(session)
+        else:
+            self.buffer += FRAME.pack(session, CLOSE)
+        self._wakeup.set()
+
+    async def run(self, writer):
+        """Escreve o que estiver enfileirado até o canal fechar; enquanto drena, novos frames se acumulam."""
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                if not self.buffer and not self.closing:
+                    continue
+                data = bytes(self.buffer) + b"".join(FRAME.pack(session, CLOSE) for session in self.closing)
+                self.buffer.clear()
+                self.closing.clear()
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.closed = True
+            self.buffer.clear()
+            self.closing.clear()
+
+
+async def read_frames(reader, on_frames):
+    """
+    Lê frames do canal até EOF, entregando a on_frames uma lista de
+    (sessão, datagrama) por leitura; datagrama None encerra a sessão.
+    """
+    buffer = bytearray()
+    while data := await reader.read(READ_CHUNK):
+        buffer += data
+        frames, offset = [], 0
+        while len(buffer) - offset >= FRAME.size:
+            session, length = FRAME.unpack_from(buffer, offset)
+            start = offset + FRAME.size
+            if length == CLOSE:
+                frames.append((session, None))
+                offset = start
+                continue
+            if len(buffer) - start < length:
+                break
+            frames.append((session, bytes(buffer[start:start + length])))
+            offset = start + length
+        del buffer[:offset]
+        if frames:
+            on_frames(frames)
+
+
+class DatagramSocket:
+    """
+    Socket UDP não bloqueante lido direto pelo loop: cada vez que fica legível
+    são lidos até BATCH datagramas, entregues juntos a on_datagrams([(dados, endereço)]).
+    Expõe close() e wait_closed() como um asyncio.Server.
+    """
+
+    def __init__(self, sock, on_datagrams):
+        sock.setblocking(False)
+        self.sock = sock
+        self.on_datagrams = on_datagrams
+        self.dropped = 0
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(sock.fileno(), self._read_ready)
+
+    def _read_ready(self):
+        batch = []
+        for _ in range(BATCH):
+            try:
+                batch.append(self.sock.recvfrom(MAX_DATAGRAM))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # ICMP de porta inalcançável num socket conectado: o próximo datagrama segue normalmente.
+                continue
+        if batch:
+            self.on_datagrams(batch)
+
+    def sendto(self, data, addr=None):
+        """Envia sem esperar; com o buffer do kernel cheio o datagrama é descartado."""
+        try:
+            if addr is None:
+                self.sock.send(data)
+            else:
+                self.sock.sendto(data, addr)
+            return True
+        except OSError:
+            self.dropped += 1
+            return False
+
+    def close(self):
+        if self.sock.fileno() >= 0:
+            self._loop.remove_reader(self.sock.fileno())
+            self.sock.close()
+
+    async def wait_closed(self):
+        pass
+
+
+def udp_socket(family=socket.AF_INET):
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+        except OSError:
+            pass
+    return sock
+
+
+def bind_udp(host, port, reuse_port=False):
+    """Socket UDP ligado a (host, port), pronto para DatagramSocket."""
+    sock = udp_socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+    try:
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+    except OSError:
+        sock.close()
+        raise
+    return sock
@@ -0,0 +1,331 @@
+"""
+Multiplexação de streams sobre a conexão de controle (estilo yamux/smux).
+
+Cada frame tem um cabeçalho fixo de 12 bytes:
+    versão (1) | tipo (1) | flags (2) | id do stream (4) | tamanho (4)
+
+Em frames DATA o tamanho é o do payload que segue; em WINDOW_UPDATE é o
+incremento da janela; em PING é um valor opaco devolvido no ACK.
+GO_AWAY avisa que o par vai encerrar a sessão (o servidor, ao ser
+atualizado): os streams abertos continuam até o fim, mas o outro lado deve
+abrir uma sessão nova.
+O lado que abriu a conexão (cliente) usa ids ímpares e o servidor ids pares.
+
+Este arquivo existe, idêntico, em server/ e client/.
+"""
+import asyncio
+import struct
+
+VERSION = 0
+
+TYPE_DATA = 0
+TYPE_WINDOW_UPDATE = 1
+TYPE_PING = 2
+TYPE_GO_AWAY = 3
+
+FLAG_SYN = 0x1
+FLAG_ACK = 0x2
+FLAG_FIN = 0x4
+FLAG_RST = 0x8
+
+HEADER = struct.Struct("!BBHII")
+INITIAL_WINDOW = 256 * 1024
+MAX_FRAME = 64 * 1024
+
+
+def stream_header(tunnel_id):
+    """Prefixo dos streams abertos pelo servidor quando a sessão serve vários túneis."""
+    encoded = tunnel_id.encode()
+    return bytes([len(encoded)]) + encoded
+
+
+async def read_stream_header(stream):
+    length = (await stream.readexactly(1))[0]
+    return (await stream.readexactly(length)).decode()
+
+
+class MuxStream:
+    """
+    Um stream lógico dentro de uma MuxSession.
+
+    Expõe a mesma interface usada por forward_data em StreamReader/StreamWriter
+    (read, at_eof, write, drain, close, wait_closed), então pode ser ligado
+    diretamente a um socket público ou local. close() faz half-close (FIN):
+    o stream continua legível até o par também encerrar.
+    """
+
+    def __init__(self, session, stream_id):
+        self.session = session
+        self.id = stream_id
+        self._recv = bytearray()
+        self._recv_event = asyncio.Event()
+        self._recv_window = INITIAL_WINDOW
+        self._consumed = 0
+        self._send_window = INITIAL_WINDOW
+        self._send_event = asyncio.Event()
+        self._pending = bytearray()
+        self.remote_closed = False
+        self.local_closed = False
+        self.reset = False
+
+    # --- Leitura ---
+
+    async def read(self, n=-1):
+        while not self._recv and not self.remote_closed and not self.reset:
+            self._recv_event.clear()
+            await self._recv_event.wait()
+        if not self._recv:
+            if self.reset:
+                raise ConnectionResetError(f"stream {self.id} resetado")
+            return b""
+        if n < 0 or n >= len(self._recv):
+            data = bytes(self._recv)
+            self._recv.clear()
+        else:
+            data = bytes(self._recv[:n])
+            del self._recv[:n]
+        self._grant(len(data))
+        return data
+
+    async def readexactly(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = await self.read(n - len(data))
+            if not chunk:
+                raise asyncio.IncompleteReadError(data, n)
+            data += chunk
+        return data
+
+    def at_eof(self):
+        return (self.remote_closed or self.reset) and not self._recv
+
+    def _grant(self, consumed):
+        # Devolve crédito ao par apenas após metade da janela ser consumida,
+        # evitando um WINDOW_UPDATE por leitura.
+        self._consumed += consumed
+        if self._consumed >= INITIAL_WINDOW // 2 and not self.reset and not self.remote_closed and self.session.usable():
+            self._recv_window += self._consumed
+            self.session._send_frame(TYPE_WINDOW_UPDATE, 0, self.id, length=self._consumed)
+            self._consumed = 0
+
+    # --- Escrita ---
+
+    def write(self, data):
+        if self.local_closed or self.reset:
+            return
+        self._pending += data
+
+    async def drain(self):
+        while self._pending:
+            if self.reset:
+                raise ConnectionResetError(f"stream {self.id} resetado")
+            if self._send_window <= 0:
+                self._send_event.clear()
+                await self._send_event.wait()
+                continue
+            n = min(len(self._pending), self._send_window, MAX_FRAME)
+            chunk = bytes(self._pending[:n])
+            del self._pending[:n]
+            self._send_window -= n
+            self.session._send_frame(TYPE_DATA, 0, self.id, chunk)
+            await self.session.drain()
+
+    def is_closing(self):
+        return self.local_closed or self.reset
+
+    def close(self):
+        """Half-close: envia FIN depois de escoar o que estiver pendente."""
+        if self.local_closed or self.reset:
+            return
+        if self._pending:
+            asyncio.ensure_future(self._drain_and_close())
+            return
+        self._send_fin()
+
+    async def _drain_and_close(self):
+        try:
+            await self.drain()
+        except ConnectionResetError:
+            return
+        self._send_fin()
+
+    def _send_fin(self):
+        if self.local_closed or self.reset:
+            return
+        self.local_closed = True
+        if self.session.usable():
+            self.session._send_frame(TYPE_WINDOW_UPDATE, FLAG_FIN, self.id)
+        if self.remote_closed:
+            self.session._forget(self.id)
+
+    async def wait_closed(self):
+        return None
+
+    def abort(self):
+        """Encerra o stream nos dois sentidos com RST."""
+        if self.reset:
+            return
+        if self.session.usable():
+            self.session._send_frame(TYPE_WINDOW_UPDATE, FLAG_RST, self.id)
+        self._on_reset()
+
+    def get_extra_info(self, name, default=None):
+        if name == "stream_id":
+            return self.id
+        return self.session.writer.get_extra_info(name, default)
+
+    # --- Eventos vindos da sessão ---
+
+    def _on_data(self, data):
+        if len(data) > self._recv_window:
+            # O par ignorou o controle de fluxo.
+            self.abort()
+            return
+        self._recv_window -= len(data)
+        self._recv += data
+        self._recv_event.set()
+
+    def _on_window_update(self, delta):
+        self._send_window += delta
+        self._send_event.set()
+
+    def _on_fin(self):
+        self.remote_closed = True
+        self._recv_event.set()
+        if self.local_closed:
+            self.session._forget(self.id)
+
+    def _on_reset(self):
+        self.reset = True
+        self._pending.clear()
+        self._recv_event.set()
+        self._send_event.set()
+        self.session._forget(self.id)
+
+
+class MuxSession:
+    """
+    Sessão multiplexada sobre um par StreamReader/StreamWriter já conectado.
+
+    on_stream(stream) é chamado (como tarefa) para cada stream aberto pelo par;
+    sem on_stream, os streams abertos pelo par são recusados com RST.
+    run() processa frames até a conexão cair; nesse momento todos os streams
+    são resetados.
+    """
+
+    def __init__(self, reader, writer, on_stream=None, client=False):
+        self.reader = reader
+        self.writer = writer
+        self.on_stream = on_stream
+        self.streams = {}
+        self.closed = False
+        self._next_id = 1 if client else 2
+        self._tasks = set()  # O loop só guarda referências fracas às tarefas
+        self.on_pong = None  # on_pong(valor) ao receber o ACK de um ping()
+        self.on_go_away = None  # on_go_away() quando o par anuncia que vai encerrar a sessão
+        self.pings_received = 0
+
+    def open_stream(self):
+        stream_id = self._next_id
+        self._next_id += 2
+        stream = MuxStream(self, stream_id)
+        self.streams[stream_id] = stream
+        self._send_frame(TYPE_WINDOW_UPDATE, FLAG_SYN, stream_id)
+        return stream
+
+    def ping(self, value):
+        """Envia um PING com um valor opaco de 32 bits, devolvido pelo par no ACK."""
+        self._send_frame(TYPE_PING, FLAG_SYN, 0, length=value)
+
+    def go_away(self):
+        """Anuncia ao par que esta sessão vai acabar; ela segue funcionando até ser fechada."""
+        self._send_frame(TYPE_GO_AWAY, 0, 0)
+
+    def usable(self):
+        """
+        A conexão ainda aceita frames. Ela pode cair (erro no envio) antes de
+        run() perceber; nesse caso a sessão é encerrada aqui, e FIN, RST e
+        WINDOW_UPDATE dos streams deixam de ser escritos num transporte fechado.
+        """
+        if not self.closed and self.writer.is_closing():
+            self.close()
+        return not self.closed
+
+    def _send_frame(self, ftype, flags, stream_id, payload=b"", length=None):
+        if not self.usable():
+            raise ConnectionResetError("sessão mux encerrada")
+        if length is None:
+            length = len(payload)
+        # Cabeçalho e payload numa única escrita para não intercalar frames.
+        self.writer.write(HEADER.pack(VERSION, ftype, flags, stream_id, length) + payload)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def _forget(self, stream_id):
+        self.streams.pop(stream_id, None)
+
+    async def run(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(HEADER.size)
+                version, ftype, flags, stream_id, length = HEADER.unpack(header)
+                if version != VERSION:
+                    break
+
+                payload = b""
+                if ftype == TYPE_DATA and length > MAX_FRAME:
+                    break  # Nenhum par legítimo manda frames maiores; o tamanho não é confiável
+                if ftype == TYPE_DATA and length:
+                    payload = await self.reader.readexactly(length)
+
+                if ftype == TYPE_PING:
+                    if flags & FLAG_SYN:
+                        self.pings_received += 1
+                        self._send_frame(TYPE_PING, FLAG_ACK, 0, length=length)
+                    elif flags & FLAG_ACK and self.on_pong:
+                        self.on_pong(length)
+                    continue
+                if ftype == TYPE_GO_AWAY:
+                    if self.on_go_away:
+                        self.on_go_away()
+                    continue
+
+                stream = self.streams.get(stream_id)
+                if stream is None:
+                    if not flags & FLAG_SYN:
+                        continue  # Frame atrasado de um stream já encerrado
+                    if self.on_stream is None:
+                        # Este lado não aceita streams do par: recusa sem guardar estado.
+                        self._send_frame(TYPE_WINDOW_UPDATE, FLAG_RST, stream_id)
+                        continue
+                    stream = MuxStream(self, stream_id)
+                    self.streams[stream_id] = stream
+                    task = asyncio.create_task(self.on_stream(stream))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+
+                if flags & FLAG_RST:
+                    stream._on_reset()
+                    continue
+                if ftype == TYPE_DATA:
+                    stream._on_data(payload)
+                elif ftype == TYPE_WINDOW_UPDATE and length:
+                    stream._on_window_update(length)
+                if flags & FLAG_FIN:
+                    stream._on_fin()
+        except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for stream in list(self.streams.values()):
+            stream.reset = True
+            stream._recv_event.set()
+            stream._send_event.set()
+        self.streams.clear()
+        self.writer.close()
@@ -1,8 +1,9 @@
 import os
+import time
+import collections
 import discord
 import httpx
 import asyncio
-import threading
 import uvicorn
 from discord.ext import commands
 from dotenv import load_dotenv
@@ -10,6 +11,8 @@ from fastapi import FastAPI, Request, Depends, HTTPException, status
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel
 
+from notifications import DmDispatcher
+
 # --- Configurações ---
 load_dotenv()
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
@@ -19,18 +22,73 @@ BASE_DOMAIN = os.getenv("BASE_DOMAIN", "tunnel.cz7host.local")
 BOT_API_HOST = os.getenv("BOT_API_HOST", "127.0.0.1")
 BOT_API_PORT = int(os.getenv("BOT_API_PORT", 8081))
 FRP_SERVER_IP = os.getenv("FRP_SERVER_IP") # IP público do servidor FRP para os clientes usarem
+# Envio das DMs de eventos: requisições/s ao Discord (o limite global é 50),
+# envios simultâneos, intervalo mínimo (s) entre DMs ao mesmo usuário, canais
+# de DM mantidos em cache e máximo de usuários com avisos na fila.
+DM_REQUEST_RATE = float(os.getenv("DM_REQUEST_RATE", 40))
+DM_WORKERS = int(os.getenv("DM_WORKERS", 4))
+DM_CHANNEL_INTERVAL = float(os.getenv("DM_CHANNEL_INTERVAL", 1.0))
+DM_USER_CACHE = int(os.getenv("DM_USER_CACHE", 10000))
+DM_QUEUE_MAX = int(os.getenv("DM_QUEUE_MAX", 50000))
+# Cache das consultas à API (segundos; 0 desativa) e máximo de respostas guardadas.
+API_CACHE_TTL = float(os.getenv("API_CACHE_TTL", 10))
+API_CACHE_SIZE = int(os.getenv("API_CACHE_SIZE", 1000))
+# Túneis por página em !tunel listar (o Discord aceita até 25 campos por embed).
+LIST_PAGE_SIZE = 10
 
 # --- Cliente da API ---
+class ResponseCache:
+    """Respostas de GET por alguns segundos (TTL), com no máximo 'size' entradas (LRU)."""
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.entries = collections.OrderedDict()  # {chave: (expira em, resposta)}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, value):
+        if self.ttl <= 0:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
 class FrpApiClient:
     def __init__(self, base_url, api_key):
         self.base_url = base_url
         self.headers = {"X-API-Key": api_key}
         self.client = httpx.AsyncClient(base_url=base_url, headers=self.headers)
+        self.cache = ResponseCache(API_CACHE_TTL, API_CACHE_SIZE)
+
+    async def _get(self, url, params=None):
+        """GET com cache; qualquer alteração feita por este cliente limpa o cache."""
+        key = (url, tuple(sorted((params or {}).items())))
+        data = self.cache.get(key)
+        if data is None:
+            response = await self.client.get(url, params=params)
+            response.raise_for_status()
+            data = response.json()
+            self.cache.put(key, data)
+        return data
 
     async def create_tunnel(self, user_id, local_port):
         try:
             params = {"user_id": str(user_id), "local_port": local_port}
             response = await self.client.post("/tunnels", params=params)
+            self.cache.clear()
             response.raise_for_status()
             return response.json()
         except httpx.HTTPStatusError as e:
@@ -40,9 +98,18 @@ class FrpApiClient:
 
     async def get_tunnel(self, tunnel_id):
         try:
-            response = await self.client.get(f"/tunnels/{tunnel_id}")
-            response.raise_for_status()
-            return response.json()
+            return await self._get(f"/tunnels/{tunnel_id}")
+        except httpx.HTTPStatusError as e:
+            return {"error": f"Erro na API: {e.response.status_code}", "details": e.response.json()}
+        except httpx.RequestError as e:
+            return {"error": f"Erro de conexão com a API: {e}"}
+
+    async def list_tunnels(self, user_id, cursor=None, limit=LIST_PAGE_SIZE):
+        try:
+            params = {"user_id": str(user_id), "limit": limit}
+            if cursor:
+                params["cursor"] = cursor
+            return await self._get("/tunnels", params)
         except httpx.HTTPStatusError as e:
             return {"error": f"Erro na API: {e.response.status_code}", "details": e.response.json()}
         except httpx.RequestError as e:
@@ -51,6 +118,7 @@ class FrpApiClient:
     async def delete_tunnel(self, tunnel_id):
         try:
             response = await self.client.delete(f"/tunnels/{tunnel_id}")
+            self.cache.clear()
             response.raise_for_status()
             return {"success": True, "status_code": response.status_code}
         except httpx.HTTPStatusError as e:
@@ -62,6 +130,7 @@ class FrpApiClient:
         try:
             url = f"/tunnels/{tunnel_id}/domain"
             response = await self.client.put(url, params={"subdomain": subdomain})
+            self.cache.clear()
             response.raise_for_status()
             return response.json()
         except httpx.HTTPStatusError as e:
@@ -78,6 +147,9 @@ class TunnelEvent(BaseModel):
     user_id: str
     event: str
 
+class TunnelEventBatch(BaseModel):
+    events: list[TunnelEvent]
+
 async def get_api_key(key: str = Depends(api_key_header)):
     if key != API_SECRET_KEY:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API Key")
@@ -87,38 +159,75 @@ async def get_api_key(key: str = Depends(api_key_header)):
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True # Necessário para buscar usuários
-bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
+# Esperas por limite do Discord acima de 30s viram discord.RateLimited, tratadas pelo dispatcher.
+bot = commands.Bot(command_prefix="!", intents=intents, help_command=None, max_ratelimit_timeout=30)
 api_client = FrpApiClient(API_URL, API_SECRET_KEY)
 
+# Mensagens enviadas por DM para cada evento: (título, descrição, rodapé, cor).
+EVENT_MESSAGES = {
+    "connected": (
+        "🚀 Seu Túnel está Online!", "O cliente para o túnel `{short_id}...` foi conectado com sucesso.",
+        "Seu serviço agora deve estar acessível.", discord.Color.brand_green(),
+    ),
+    "disconnected": (
+        "🔌 Seu Túnel está Offline", "O cliente para o túnel `{short_id}...` se desconectou.",
+        "O túnel continua reservado; ele volta assim que o cliente reconectar.", discord.Color.red(),
+    ),
+}
+
+# Campos por DM (o Discord aceita até 25 por embed).
+MAX_EVENT_FIELDS = 20
+
+def render_events(events):
+    """Embed da DM com os eventos pendentes de um usuário ({tunnel_id: evento})."""
+    if len(events) == 1:
+        (tunnel_id, event), = events.items()
+        title, description, footer, color = EVENT_MESSAGES[event]
+        embed = discord.Embed(title=title, description=description.format(short_id=tunnel_id[:8]), color=color)
+        embed.set_footer(text=footer)
+        return embed
+
+    online = sum(event == "connected" for event in events.values())
+    embed = discord.Embed(
+        title="🔄 Seus Túneis Mudaram de Estado",
+        description=f"{online} túnel(is) online e {len(events) - online} offline.",
+        color=discord.Color.brand_green() if online == len(events) else discord.Color.orange()
+    )
+    for tunnel_id, event in list(events.items())[:MAX_EVENT_FIELDS]:
+        embed.add_field(name=f"`{tunnel_id[:8]}...`", value="🟢 Online" if event == "connected" else "🔴 Offline")
+    if len(events) > MAX_EVENT_FIELDS:
+        embed.set_footer(text=f"E mais {len(events) - MAX_EVENT_FIELDS} túnel(is). Use !tunel status para detalhes.")
+    return embed
+
+dispatcher = DmDispatcher(
+    bot, render_events, DM_REQUEST_RATE, DM_WORKERS, DM_CHANNEL_INTERVAL, DM_USER_CACHE, DM_QUEUE_MAX
+)
+
+def queue_event(event: TunnelEvent):
+    """Enfileira a DM do evento; retorna False se o evento foi ignorado."""
+    if event.event not in EVENT_MESSAGES or not event.user_id.isdigit():
+        return False
+    dispatcher.put(event.user_id, event.tunnel_id, event.event)
+    return True
+
 @bot_api.post("/callback", dependencies=[Depends(get_api_key)])
 async def handle_callback(event: TunnelEvent):
-    if event.event == "connected":
-        print(f"Recebido callback: Túnel {event.tunnel_id} conectado para o usuário {event.user_id}")
-
-        user = bot.get_user(int(event.user_id))
-        if not user:
-            # Tenta buscar o usuário se não estiver no cache
-            try:
-                user = await bot.fetch_user(int(event.user_id))
-            except discord.NotFound:
-                print(f"Usuário {event.user_id} não encontrado.")
-                return {"status": "error", "message": "User not found"}
-
-        if user:
-            embed = discord.Embed(
-                title="🚀 Seu Túnel está Online!",
-                description=f"O cliente para o túnel `{event.tunnel_id[:8]}...` foi conectado com sucesso.",
-                color=discord.Color.brand_green()
-            )
-            embed.set_footer(text="Seu serviço agora deve estar acessível.")
-            try:
-                await user.send(embed=embed)
-                return {"status": "ok", "message": "DM sent"}
-            except discord.Forbidden:
-                print(f"Não foi possível enviar DM para o usuário {user.id}. Ele pode ter DMs desativadas.")
-                return {"status": "error", "message": "DM forbidden"}
-
-    return {"status": "ok", "message": "Event received"}
+    api_client.cache.clear()  # O status dos túneis mudou
+    print(f"Recebido callback: Túnel {event.tunnel_id} {event.event} para o usuário {event.user_id}")
+    queued = queue_event(event)
+    return {"status": "ok", "message": "DM queued" if queued else "Event received"}
+
+@bot_api.post("/callback/batch", dependencies=[Depends(get_api_key)])
+async def handle_callback_batch(batch: TunnelEventBatch):
+    """Lote de eventos enviado pela fila de callbacks do servidor."""
+    api_client.cache.clear()  # O status dos túneis mudou
+    queued = sum(queue_event(event) for event in batch.events)
+    print(f"Recebido lote de callbacks: {len(batch.events)} eventos, {queued} DMs enfileiradas")
+    return {"status": "ok", "received": len(batch.events), "queued": queued}
+
+@bot_api.get("/stats", dependencies=[Depends(get_api_key)])
+async def get_stats():
+    return dispatcher.stats()
 
 @bot.event
 async def on_ready():
@@ -134,6 +243,7 @@ async def help_command(ctx):
     )
     embed.add_field(name="`!tunel criar <porta_local>`", value="Cria um novo túnel FRP para a porta especificada (ex: 8080).", inline=False)
     embed.add_field(name="`!tunel status <ID_DO_TUNEL>`", value="Verifica o status de conexão de um túnel.", inline=False)
+    embed.add_field(name="`!tunel listar`", value="Lista os seus túneis e o status de cada um.", inline=False)
     embed.add_field(name="`!tunel deletar <ID_DO_TUNEL>`", value="Deleta um túnel existente.", inline=False)
     embed.add_field(name="`!dominio apontar <ID_DO_TUNEL> <subdominio>`", value=f"Aponta um subdomínio para seu túnel (ex: `meu-site`). Resultado: `meu-site.{BASE_DOMAIN}`.", inline=False)
     await ctx.send(embed=embed)
@@ -184,6 +294,27 @@ async def tunnel(ctx, action: str, *, args: str = None):
         else:
             await ctx.reply(f"✅ Túnel `{tunnel_id}` deletado com sucesso.")
 
+    elif action == "listar":
+        # O argumento opcional é o cursor da próxima página, mostrado no rodapé.
+        result = await api_client.list_tunnels(ctx.author.id, cursor=args.strip() if args else None)
+        if "error" in result:
+            await ctx.reply(f"❌ Falha ao listar túneis: {result.get('details', result['error'])}")
+            return
+        if not result["tunnels"]:
+            await ctx.reply("Você não tem túneis. Crie um com `!tunel criar <porta_local>`.")
+            return
+
+        embed = discord.Embed(title="Seus Túneis", color=discord.Color.blue())
+        for item in result["tunnels"]:
+            status_text = "🟢 Conectado" if item["connected"] else "🔴 Desconectado"
+            value = f"{status_text}\nPorta local `{item['local_port']}` → `{FRP_SERVER_IP}:{item['public_port']}`"
+            if item.get("domain"):
+                value += f"\nhttp://{item['domain']}"
+            embed.add_field(name=f"`{item['tunnel_id']}`", value=value, inline=False)
+        if result.get("next_cursor"):
+            embed.set_footer(text=f"Próxima página: !tunel listar {result['next_cursor']}")
+        await ctx.reply(embed=embed)
+
     elif action == "status":
         if not args:
             await ctx.reply("Uso correto: `!tunel status <ID_DO_TUNEL>`")
@@ -243,19 +374,21 @@ async def domain(ctx, action: str, tunnel_id: str, subdomain: str = None):
 
 # --- Validação e Execução ---
 
-def run_api():
-    """Roda a API do bot em um thread separado para não bloquear o loop do Discord."""
-    uvicorn.run(bot_api, host=BOT_API_HOST, port=BOT_API_PORT)
+async def main():
+    """Bot e API de callback no mesmo loop: os handlers da API podem usar os objetos do discord.py."""
+    config = uvicorn.Config(bot_api, host=BOT_API_HOST, port=BOT_API_PORT, log_level="info")
+    api_server = uvicorn.Server(config)
+    async with bot:
+        dispatcher.start()
+        print(f"API de callback do bot escutando em http://{BOT_API_HOST}:{BOT_API_PORT}")
+        await asyncio.gather(bot.start(DISCORD_TOKEN), api_server.serve())
 
 if not all([DISCORD_TOKEN, API_URL, API_SECRET_KEY]):
     print("ERRO: Variáveis de ambiente ausentes!")
     print("Certifique-se de que DISCORD_TOKEN, API_URL, API_SECRET_KEY e BOT_API_PORT estão definidos.")
 else:
-    # Inicia a API de callback em um thread
-    api_thread = threading.Thread(target=run_api)
-    api_thread.daemon = True
-    api_thread.start()
-    print(f"API de callback do bot escutando em http://{BOT_API_HOST}:{BOT_API_PORT}")
-
-    # Inicia o bot do Discord
-    bot.run(DISCORD_TOKEN)
\ No newline at end of file
+    discord.utils.setup_logging()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("\nBot desligando.")
@@ -0,0 +1,140 @@
+"""
+Envio, por DM, dos eventos de túneis recebidos no callback, no loop do bot.
+
+Os eventos entram em uma fila por usuário: um usuário com vários eventos
+pendentes recebe uma única DM com todos, um evento repetido substitui o
+anterior e eventos opostos ainda não enviados (connected + disconnected) se
+anulam. Assim uma onda de reconexões vira no máximo uma DM por usuário.
+
+As requisições ao Discord são espaçadas antes de sair (ritmo global e
+intervalo mínimo por canal de DM), para não esbarrar nos limites (429). Se o
+Discord ainda assim pedir uma espera longa (discord.RateLimited), só a rota
+limitada é pausada e os eventos voltam para a fila. Os canais de DM já
+abertos ficam em um cache LRU, poupando a busca do usuário e a abertura do
+canal a cada aviso.
+"""
+import asyncio
+import collections
+import time
+
+import discord
+
+
+class RouteLimiter:
+    """Próximo horário livre de cada rota ('global', 'dm_open', 'channel:<id>')."""
+
+    def __init__(self, max_routes=10000):
+        self.next_at = {}
+        self.max_routes = max_routes
+
+    async def wait(self, route, interval=0.0):
+        """Espera a vez na rota e reserva 'interval' segundos para a próxima requisição."""
+        now = time.monotonic()
+        at = max(now, self.next_at.get(route, 0.0))
+        self.next_at[route] = at + interval
+        if len(self.next_at) > self.max_routes:
+            self.next_at = {key: value for key, value in self.next_at.items() if value > now}
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    def defer(self, route, delay):
+        self.next_at[route] = max(self.next_at.get(route, 0.0), time.monotonic() + delay)
+
+
+class DmDispatcher:
+    def __init__(self, bot, render, request_rate=40.0, workers=4, channel_interval=1.0,
+                 cache_size=10000, max_users=50000):
+        self.bot = bot
+        self.render = render  # render({tunnel_id: evento}) -> discord.Embed
+        self.request_rate = request_rate
+        self.workers = workers
+        self.channel_interval = channel_interval
+        self.cache_size = cache_size
+        self.max_users = max_users
+        self.pending = collections.OrderedDict()   # {user_id: {tunnel_id: evento}}
+        self.channels = collections.OrderedDict()  # LRU {user_id: DMChannel}
+        self.limiter = RouteLimiter(cache_size)
+        self.counts = collections.Counter()
+        self._ready = asyncio.Event()
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def put(self, user_id, tunnel_id, event):
+        self._merge(int(user_id), {tunnel_id: event})
+
+    def _merge(self, user_id, events):
+        queued = self.pending.pop(user_id, None)
+        if queued is None and len(self.pending) >= self.max_users:
+            self.pending.popitem(last=False)
+            self.counts["dropped"] += 1
+        queued = queued or {}
+        for tunnel_id, event in events.items():
+            previous = queued.pop(tunnel_id, None)
+            if previous is not None:
+                self.counts["collapsed"] += 1
+                if previous != event:
+                    continue  # Opostos se anulam
+            queued[tunnel_id] = event
+        if queued:
+            self.pending[user_id] = queued
+            self._ready.set()
+
+    async def _worker(self):
+        await self.bot.wait_until_ready()
+        while True:
+            while not self.pending:
+                self._ready.clear()
+                await self._ready.wait()
+            user_id, events = self.pending.popitem(last=False)
+            await self._deliver(user_id, events)
+
+    async def _deliver(self, user_id, events):
+        route = "dm_open"
+        try:
+            channel = await self._channel(user_id)
+            route = f"channel:{channel.id}"
+            await self.limiter.wait(route, self.channel_interval)
+            await self.limiter.wait("global", 1 / self.request_rate)
+            await channel.send(embed=self.render(events))
+            self.counts["sent"] += 1
+        except discord.RateLimited as e:
+            print(f"Limite do Discord na rota {route}: aguardando {e.retry_after:.1f}s")
+            self.limiter.defer(route, e.retry_after)
+            self.counts["rate_limited"] += 1
+            self._merge(user_id, events)
+        except discord.NotFound:
+            print(f"Usuário {user_id} não encontrado.")
+            self.counts["not_found"] += 1
+        except discord.Forbidden:
+            print(f"Não foi possível enviar DM para o usuário {user_id}. Ele pode ter DMs desativadas.")
+            self.channels.pop(user_id, None)
+            self.counts["forbidden"] += 1
+        except discord.HTTPException as e:
+            print(f"Falha ao enviar DM para o usuário {user_id}: {e}")
+            self.counts["failed"] += 1
+
+    async def _channel(self, user_id):
+        """Canal de DM do usuário, pelo cache LRU ou buscando o usuário e abrindo o canal."""
+        channel = self.channels.get(user_id)
+        if channel is not None:
+            self.channels.move_to_end(user_id)
+            self.counts["cache_hits"] += 1
+            return channel
+        user = self.bot.get_user(user_id)
+        if user is None:
+            await self.limiter.wait("global", 1 / self.request_rate)
+            user = await self.bot.fetch_user(user_id)
+        channel = user.dm_channel
+        if channel is None:
+            await self.limiter.wait("dm_open")
+            await self.limiter.wait("global", 1 / self.request_rate)
+            channel = await user.create_dm()
+        self.channels[user_id] = channel
+        if len(self.channels) > self.cache_size:
+            self.channels.popitem(last=False)
+        return channel
+
+    def stats(self):
+        return {"pending_users": len(self.pending), "cached_channels": len(self.channels), **self.counts}
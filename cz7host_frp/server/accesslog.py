@@ -0,0 +1,185 @@
+"""
+Log fora do event loop: mensagens e registros de acesso.
+
+print() no loop bloqueia quando o stdout é um pipe lento (journald, docker
+logs). log() e AccessLog.record() só colocam o item num buffer circular em
+memória; uma thread escritora o esvazia em lotes. Mensagens vão para o
+stdout; registros de acesso (uma linha JSON por conexão: túnel, host, bytes,
+duração e motivo do fechamento) vão para um arquivo com rotação por tamanho.
+handler() leva para o mesmo caminho o logging de bibliotecas (uvicorn): com
+a thread presa num stdout lento, uma escrita direta do loop esperaria por ela.
+
+Acima de 'rate' registros por segundo os registros são amostrados: cada linha
+gravada leva "sample": N, o número de conexões que ela representa. Com o
+buffer cheio, os itens mais antigos são descartados e contados.
+
+Este arquivo existe, idêntico, em server/ e client/.
+"""
+import atexit
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+BATCH = 256  # Registros no buffer que acordam a thread antes do intervalo
+
+
+class AccessLog:
+    """
+    Buffer circular de até 'capacity' itens e a thread que o grava. 'path'
+    vazio desativa os registros de acesso (log() continua valendo); o arquivo
+    roda ao passar de 'max_bytes', mantendo 'backups' cópias (.1 a .N).
+    """
+
+    def __init__(self, path=None, max_bytes=64 * 1024 * 1024, backups=5, rate=0, capacity=65536, interval=1.0):
+        self.path = path or None
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.rate = rate
+        self.interval = interval
+        self.counts = collections.Counter()  # accepted, sampled_out, dropped, written, errors
+        self._buffer = collections.deque(maxlen=capacity)
+        self._wake = threading.Event()
+        self._thread = None
+        self._closing = False
+        self._file = None
+        self._size = 0
+        # Amostragem: 1 em cada 'sample' registros, recalculado a cada segundo.
+        self.sample = 1
+        self._window = 0
+        self._arrived = 0
+        self._skip = 0
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def log(self, message):
+        """Mensagem para o stdout, no lugar de print()."""
+        self._push(("log", message))
+        self._wake.set()
+
+    def record(self, fields):
+        """Registro de acesso (dict serializável em JSON); pode ser descartado pela amostragem."""
+        if self.path is None:
+            return
+        if self.rate > 0 and not self._sampled():
+            self.counts["sampled_out"] += 1
+            return
+        fields["ts"] = round(time.time(), 3)
+        if self.sample > 1:
+            fields["sample"] = self.sample
+        self.counts["accepted"] += 1
+        self._push(("access", fields))
+        if len(self._buffer) >= BATCH:
+            self._wake.set()
+
+    def _sampled(self):
+        window = int(time.monotonic())
+        if window != self._window:
+            # A taxa do segundo anterior decide quantos registros cada linha representa.
+            self.sample = max(1, -(-self._arrived // self.rate)) if window == self._window + 1 else 1
+            self._window, self._arrived, self._skip = window, 0, 0
+        self._arrived += 1
+        if self._arrived > self.rate * self.sample:
+            self.sample *= 2  # Pico dentro do segundo: amostra mais, sem esperar a virada
+        if self._skip:
+            self._skip -= 1
+            return False
+        self._skip = self.sample - 1
+        return True
+
+    def _push(self, item):
+        if len(self._buffer) == self._buffer.maxlen:
+            self.counts["dropped"] += 1
+        self._buffer.append(item)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="accesslog", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def handler(self):
+        """logging.Handler que entrega os registros formatados a log()."""
+        return _LogHandler(self)
+
+    def stats(self):
+        return {**self.counts, "queued": len(self._buffer), "sample": self.sample}
+
+    def close(self):
+        """Grava o que restou no buffer e encerra a thread."""
+        if self._thread is None or self._closing:
+            return
+        self._closing = True
+        self._wake.set()
+        self._thread.join(5)
+
+    # --- Thread escritora ---
+
+    def _run(self):
+        while not self._closing:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self._flush()
+        self._flush()
+        if self._file:
+            self._file.close()
+
+    def _flush(self):
+        messages, records = [], []
+        buffer = self._buffer
+        while buffer:
+            kind, item = buffer.popleft()
+            if kind == "log":
+                messages.append(item)
+            else:
+                records.append(json.dumps(item, separators=(",", ":")))
+        if messages:
+            try:
+                sys.stdout.write("\n".join(messages) + "\n")
+                sys.stdout.flush()
+            except (OSError, ValueError):
+                self.counts["errors"] += 1
+        if records:
+            data = ("\n".join(records) + "\n").encode()
+            try:
+                self._write(data)
+                self.counts["written"] += len(records)
+            except OSError:
+                self.counts["errors"] += 1
+
+    def _write(self, data):
+        if self._file and self._size + len(data) > self.max_bytes and self._size:
+            self._file.close()
+            self._file = None
+            self._rotate()
+        if self._file is None:
+            self._file = open(self.path, "ab")
+            self._size = self._file.tell()
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+
+    def _rotate(self):
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+
+class _LogHandler(logging.Handler):
+    def __init__(self, access_log):
+        super().__init__()
+        self.access_log = access_log
+
+    def emit(self, record):
+        try:
+            self.access_log.log(self.format(record))
+        except Exception:
+            self.handleError(record)
@@ -0,0 +1,364 @@
+"""
+Cache de borda do proxy HTTP (HTTP_MODE=proxy), ativado por túnel.
+
+Guarda respostas a GET que o serviço local permite guardar (Cache-Control,
+Expires, ETag/Last-Modified, Vary), para que visitantes repetidos não cruzem
+o uplink do cliente. Objetos pequenos ficam em memória; os maiores que
+object_max vão para arquivos em 'directory'. Cada um dos dois tem um
+orçamento em bytes e descarta as entradas usadas há mais tempo (LRU).
+
+Uma entrada vencida com validador (ETag ou Last-Modified) não é descartada:
+a próxima requisição vai ao serviço local com If-None-Match/If-Modified-Since
+e um 304 renova a entrada sem retransmitir o corpo.
+
+O cache não sobrevive a reinícios; no modo multi-processo cada worker tem o seu.
+"""
+import collections
+import email.utils
+import os
+import time
+import uuid
+
+READ_CHUNK = 64 * 1024
+
+# Status que podem ser guardados quando a resposta traz prazo ou validador.
+CACHEABLE_STATUS = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+
+# Cabeçalhos que não são guardados: os hop-by-hop e os que são refeitos ao servir.
+UNSTORED = {
+    "connection", "keep-alive", "proxy-connection", "te", "upgrade", "trailer",
+    "transfer-encoding", "content-length", "age", "x-cache",
+}
+
+# Cabeçalhos que acompanham um 304 (RFC 9110, 15.4.5).
+NOT_MODIFIED_HEADERS = {"cache-control", "content-location", "date", "etag", "expires", "vary", "last-modified"}
+
+
+def directives(head):
+    """Diretivas de Cache-Control: {nome: valor ou None}."""
+    parsed = {}
+    for value in head.get_all("cache-control"):
+        for item in value.split(","):
+            name, _, arg = item.strip().partition("=")
+            if name:
+                parsed[name.lower()] = arg.strip('"') or None
+    return parsed
+
+
+def http_date(value):
+    """Segundos desde a época de uma data HTTP, ou None se inválida."""
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def seconds(value):
+    return int(value) if value and value.isdigit() else 0
+
+
+class Entry:
+    """Resposta guardada: cabeçalhos em memória e corpo em memória ou em arquivo."""
+
+    __slots__ = (
+        "key", "status", "reason", "headers", "vary", "body", "path", "size",
+        "stored", "ttl", "age", "etag", "last_modified",
+    )
+
+    def __init__(self, key, response, vary, ttl):
+        self.key = key
+        self.status = response.status
+        self.reason = response.first[2]
+        self.headers = [(name, value) for name, value in response.headers if name.lower() not in UNSTORED]
+        self.vary = vary    # {cabeçalho da requisição: valor} que escolheu esta variante
+        self.body = None    # bytes, em memória
+        self.path = None    # Arquivo do corpo, no disco
+        self.size = 0
+        self.stored = time.monotonic()
+        self.ttl = ttl
+        self.age = seconds(response.get("age"))
+        self.etag = response.get("etag")
+        self.last_modified = response.get("last-modified")
+
+    def fresh(self):
+        return time.monotonic() < self.stored + self.ttl
+
+    def matches(self, request):
+        return all(vary_value(request, name) == value for name, value in self.vary.items())
+
+    def validators(self):
+        """Cabeçalhos da requisição condicional que revalida a entrada."""
+        extra = []
+        if self.etag:
+            extra.append(("If-None-Match", self.etag))
+        if self.last_modified:
+            extra.append(("If-Modified-Since", self.last_modified))
+        return extra
+
+    def not_modified(self, request):
+        """A requisição do visitante é condicional e a cópia que ele tem é esta."""
+        tags = request.get_all("if-none-match")
+        if tags:
+            if not self.etag:
+                return False
+            wanted = {tag.strip().removeprefix("W/") for value in tags for tag in value.split(",")}
+            return "*" in wanted or self.etag.removeprefix("W/") in wanted
+        since = request.get("if-modified-since")
+        if since and self.last_modified:
+            since, modified = http_date(since), http_date(self.last_modified)
+            return since is not None and modified is not None and modified <= since
+        return False
+
+    def head(self, request, result, keep_alive):
+        """Cabeçalho da resposta ao visitante, completo ou 304."""
+        age = int(self.age + time.monotonic() - self.stored)
+        if self.not_modified(request):
+            lines = ["HTTP/1.1 304 Not Modified"]
+            lines += [f"{name}: {value}" for name, value in self.headers if name.lower() in NOT_MODIFIED_HEADERS]
+        else:
+            lines = [f"HTTP/1.1 {self.status} {self.reason}".rstrip()]
+            lines += [f"{name}: {value}" for name, value in self.headers]
+            lines.append(f"Content-Length: {self.size}")
+        lines += [f"Age: {age}", f"X-Cache: {result.upper()}"]
+        if not keep_alive:
+            lines.append("Connection: close")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def vary_value(request, name):
+    return ", ".join(request.get_all(name))
+
+
+class Capture:
+    """Copia o corpo de uma resposta enquanto ela segue ao visitante; commit() guarda a entrada."""
+
+    __slots__ = ("cache", "entry", "parts", "file", "failed")
+
+    def __init__(self, cache, entry):
+        self.cache = cache
+        self.entry = entry
+        self.parts = []
+        self.file = None
+        self.failed = False
+
+    def write(self, data):
+        if self.failed:
+            return
+        entry, cache = self.entry, self.cache
+        entry.size += len(data)
+        if self.file is None:
+            if entry.size <= cache.object_max:
+                self.parts.append(data)
+                return
+            if entry.size > cache.disk_max:
+                self.abort()
+                return
+            # Passou do limite de memória: o que já veio e o resto vão para o disco.
+            entry.path = os.path.join(cache.directory, uuid.uuid4().hex + ".body")
+            self.file = open(entry.path, "wb")
+            self.file.writelines(self.parts)
+            self.parts = []
+        elif entry.size > cache.disk_max:
+            self.abort()
+            return
+        self.file.write(data)
+
+    def commit(self):
+        if self.failed:
+            return
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        else:
+            self.entry.body = b"".join(self.parts)
+            self.parts = []
+        self.cache.insert(self.entry)
+
+    def abort(self):
+        self.failed = True
+        self.parts = []
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            _unlink(self.entry.path)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class EdgeCache:
+    def __init__(self, memory_max, object_max, directory=None, disk_max=0):
+        self.memory_max = memory_max
+        self.object_max = min(object_max, memory_max)
+        self.directory = directory
+        self.disk_max = disk_max if directory else 0
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self._memory = collections.OrderedDict()  # {chave: Entry} em memória, do menos ao mais recente
+        self._disk = collections.OrderedDict()    # {chave: Entry} com o corpo em arquivo
+        self._tunnels = {}  # {tunnel_id: {alvo: {variante: Entry}}}
+        self.counts = {}    # {tunnel_id: Counter(hit, revalidated, miss, bypass)}
+        if self.disk_max:
+            os.makedirs(directory, exist_ok=True)
+            # Corpos de uma execução anterior não têm mais entrada que os aponte.
+            for name in os.listdir(directory):
+                if name.endswith(".body"):
+                    _unlink(os.path.join(directory, name))
+
+    def __len__(self):
+        return len(self._memory) + len(self._disk)
+
+    def count(self, tunnel_id, result):
+        counts = self.counts.get(tunnel_id)
+        if counts is None:
+            counts = self.counts[tunnel_id] = collections.Counter()
+        counts[result] += 1
+
+    @staticmethod
+    def cacheable_request(request):
+        """GET/HEAD sem credenciais nem 'no-store' podem ser atendidos pelo cache."""
+        return (
+            request.first[0] in ("GET", "HEAD")
+            and request.get("authorization") is None
+            and "no-store" not in directives(request)
+            and not request.is_upgrade()
+        )
+
+    @staticmethod
+    def wants_revalidation(request):
+        """O visitante pediu uma resposta conferida com a origem (no-cache, max-age=0)."""
+        cc = directives(request)
+        return "no-cache" in cc or cc.get("max-age") == "0" or "no-cache" in request.tokens("pragma")
+
+    def lookup(self, tunnel_id, request):
+        """Entrada (talvez vencida) para a requisição, ou None."""
+        variants = self._tunnels.get(tunnel_id, {}).get(request.first[1])
+        if not variants:
+            return None
+        for entry in variants.values():
+            if entry.matches(request):
+                (self._memory if entry.path is None else self._disk).move_to_end(entry.key)
+                return entry
+        return None
+
+    def capture(self, tunnel_id, request, response):
+        """Capture para guardar a resposta a um GET, ou None se ela não puder ser guardada."""
+        if request.first[0] != "GET" or response.status not in CACHEABLE_STATUS:
+            return None
+        cc = directives(response)
+        if "no-store" in cc or "private" in cc or response.get("set-cookie") is not None:
+            return None
+        names = sorted(response.tokens("vary") - {""})
+        if "*" in names:
+            return None
+        ttl = self.freshness(response, cc)
+        if ttl <= 0 and not (response.get("etag") or response.get("last-modified")):
+            return None
+        vary = {name: vary_value(request, name) for name in names}
+        key = (tunnel_id, request.first[1], tuple(vary.values()))
+        return Capture(self, Entry(key, response, vary, ttl))
+
+    @staticmethod
+    def freshness(response, cc):
+        """Segundos em que a resposta pode ser servida sem revalidar."""
+        if "no-cache" in cc:
+            return 0
+        if "s-maxage" in cc or "max-age" in cc:
+            ttl = seconds(cc.get("s-maxage") or cc.get("max-age"))
+        else:
+            expires = http_date(response.get("expires"))
+            if expires is None:
+                return 0
+            ttl = expires - (http_date(response.get("date")) or time.time())
+        return max(0, ttl - seconds(response.get("age")))
+
+    def refresh(self, entry, response):
+        """Um 304 da origem renova a entrada e os cabeçalhos que ele traz."""
+        updated = {name.lower(): (name, value) for name, value in response.headers if name.lower() not in UNSTORED}
+        headers = [updated.pop(name.lower(), (name, value)) for name, value in entry.headers]
+        entry.headers = headers + list(updated.values())
+        entry.ttl = self.freshness(response, directives(response))
+        entry.age = seconds(response.get("age"))
+        entry.stored = time.monotonic()
+        entry.etag = response.get("etag") or entry.etag
+        entry.last_modified = response.get("last-modified") or entry.last_modified
+
+    def insert(self, entry):
+        tunnel_id, target, variant = entry.key
+        old = self._tunnels.get(tunnel_id, {}).get(target, {}).get(variant)
+        if old is not None:
+            self._remove(old)
+        if entry.path is None:
+            lru, budget = self._memory, self.memory_max
+            self.memory_bytes += entry.size
+        else:
+            lru, budget = self._disk, self.disk_max
+            self.disk_bytes += entry.size
+        lru[entry.key] = entry
+        self._tunnels.setdefault(tunnel_id, {}).setdefault(target, {})[variant] = entry
+        while (self.memory_bytes if lru is self._memory else self.disk_bytes) > budget:
+            self._remove(next(iter(lru.values())))
+
+    async def send_body(self, entry, writer):
+        if entry.path is None:
+            writer.write(entry.body)
+            await writer.drain()
+            return
+        # O arquivo aberto continua legível mesmo se a entrada for removida no meio.
+        try:
+            f = open(entry.path, "rb")
+        except FileNotFoundError:
+            # Removida durante a revalidação: o cabeçalho já saiu, só resta fechar.
+            raise ConnectionError("entrada removida do cache")
+        with f:
+            while data := f.read(READ_CHUNK):
+                writer.write(data)
+                await writer.drain()
+
+    def purge(self, tunnel_id=None, path=None):
+        """Remove as entradas de um túnel (só as do caminho 'path', se dado) ou de todos. Retorna quantas."""
+        if tunnel_id is None:
+            entries = list(self._memory.values()) + list(self._disk.values())
+        else:
+            targets = self._tunnels.get(tunnel_id, {})
+            entries = [
+                entry for target, variants in targets.items()
+                if path is None or target.partition("?")[0] == path
+                for entry in variants.values()
+            ]
+        for entry in entries:
+            self._remove(entry)
+        return len(entries)
+
+    def forget(self, tunnel_id):
+        """Túnel removido: descarta as entradas e os contadores."""
+        self.purge(tunnel_id)
+        self.counts.pop(tunnel_id, None)
+
+    def _remove(self, entry):
+        tunnel_id, target, variant = entry.key
+        if entry.path is None:
+            del self._memory[entry.key]
+            self.memory_bytes -= entry.size
+        else:
+            del self._disk[entry.key]
+            self.disk_bytes -= entry.size
+            _unlink(entry.path)
+        targets = self._tunnels[tunnel_id]
+        del targets[target][variant]
+        if not targets[target]:
+            del targets[target]
+            if not targets:
+                del self._tunnels[tunnel_id]
+
+    def stats(self):
+        return {
+            "entries": len(self),
+            "memory_bytes": self.memory_bytes,
+            "disk_bytes": self.disk_bytes,
+            "tunnels": {tunnel_id: dict(counts) for tunnel_id, counts in self.counts.items()},
+        }
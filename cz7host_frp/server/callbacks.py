@@ -0,0 +1,89 @@
+"""
+Callbacks de eventos dos túneis para o bot (connected, disconnected).
+
+Os eventos entram em uma fila em memória e saem em lotes por POST em
+'<BOT_CALLBACK_URL>/batch', por um único cliente HTTP com keep-alive. Na fila
+fica no máximo um evento por túnel: um evento oposto ao que ainda espera
+envio anula os dois (o bot continua vendo o estado certo), então uma onda de
+reconexões após um restart vira poucos lotes em vez de milhares de POSTs.
+
+Um lote que falha (erro de conexão, 429 ou 5xx) é reenviado com backoff
+exponencial até 'retries' vezes e depois descartado. Com a fila cheia, o
+evento mais antigo é descartado. Tudo é contado em 'counts'.
+"""
+import asyncio
+import collections
+import itertools
+import random
+
+import httpx
+
+BACKOFF_BASE = 0.5  # Espera antes da primeira repetição, em segundos (dobra a cada tentativa)
+BACKOFF_MAX = 30.0
+
+
+class CallbackQueue:
+    def __init__(self, url, api_key, max_events=10000, batch_size=100, retries=5, delay=0.5, timeout=30.0, log=print):
+        self.url = url.rstrip("/") + "/batch"
+        self.api_key = api_key
+        self.max_events = max_events
+        self.batch_size = batch_size
+        self.retries = retries
+        self.delay = delay  # Espera após o primeiro evento, para juntar os próximos no mesmo lote
+        self.timeout = timeout
+        self.log = log
+        self.pending = {}  # {tunnel_id: evento}, do mais antigo ao mais novo
+        self.counts = collections.Counter()  # {resultado: eventos}
+        self._ready = asyncio.Event()
+        self._task = None
+
+    def put(self, event):
+        tunnel_id = event["tunnel_id"]
+        queued = self.pending.pop(tunnel_id, None)
+        if queued is not None and queued["event"] != event["event"]:
+            # connected + disconnected (ou o inverso) ainda não enviados: nada mudou para o bot.
+            self.counts["coalesced"] += 2
+            return
+        if queued is not None:
+            self.counts["coalesced"] += 1
+        elif len(self.pending) >= self.max_events:
+            del self.pending[next(iter(self.pending))]
+            self.counts["dropped"] += 1
+        self.pending[tunnel_id] = event
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        self._ready.set()
+
+    async def _run(self):
+        limits = httpx.Limits(max_connections=1, max_keepalive_connections=1)
+        async with httpx.AsyncClient(headers={"X-API-Key": self.api_key}, timeout=self.timeout, limits=limits) as client:
+            while True:
+                await self._ready.wait()
+                await asyncio.sleep(self.delay)
+                self._ready.clear()
+                while self.pending:
+                    batch = [self.pending.pop(key) for key in list(itertools.islice(self.pending, self.batch_size))]
+                    await self._deliver(client, batch)
+
+    async def _deliver(self, client, batch):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.counts["retries"] += 1
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            try:
+                response = await client.post(self.url, json={"events": batch})
+            except httpx.HTTPError as e:
+                error = f"{type(e).__name__}: {e}"
+                continue
+            if response.status_code < 300:
+                self.counts["sent"] += len(batch)
+                return
+            error = f"HTTP {response.status_code} {response.text[:200]}"
+            if response.status_code < 500 and response.status_code != 429:
+                break  # Erro do pedido (chave, formato): repetir não adianta
+        self.log(f"[CALLBACK] {len(batch)} eventos descartados após {attempt + 1} tentativas: {error}")
+        self.counts["failed"] += len(batch)
+
+    def stats(self):
+        return {"pending": len(self.pending), **self.counts}
@@ -0,0 +1,167 @@
+"""
+Compressão zlib opcional dos canais de dados (DATA e POOL).
+
+Negociada no handshake: o cliente pede 'zlib=1' na linha CONTROL e, se o
+servidor aceitar, abre seus canais com 'DATA:<token> zlib=1' ou
+'POOL:<túnel> zlib=1'. Depois do handshake, o canal transporta quadros
+'tipo (1 byte) | tamanho (4 bytes) | dados' nos dois sentidos:
+
+- RAW:  dados sem compressão;
+- ZLIB: continuação de um único stream deflate, com Z_SYNC_FLUSH a cada
+        escrita para que o outro lado possa entregar os dados na hora.
+
+Cada lado decide por escrita. Se a taxa medida em uma janela for ruim (dados
+já comprimidos, TLS), o escritor passa a enviar RAW por um tempo e depois
+mede de novo. Quadros RAW não passam pelo stream deflate, então os dois
+lados continuam sincronizados.
+
+Este arquivo existe, idêntico, em server/ e client/.
+"""
+import asyncio
+import struct
+import zlib
+
+FRAME_RAW = 0
+FRAME_ZLIB = 1
+HEADER = struct.Struct("!BI")
+MAX_FRAME = 4 * 1024 * 1024       # Maior quadro aceito (comprimido ou não)
+MAX_OUTPUT = 4 * 1024 * 1024      # Maior bloco descomprimido entregue por leitura
+PROBE_BYTES = 256 * 1024          # Janela de medição da taxa
+BYPASS_RATIO = 0.9                # Acima disto (saída/entrada), comprimir não compensa
+BYPASS_BYTES = 8 * 1024 * 1024    # Volume enviado em RAW antes de medir de novo
+
+
+class CompressionStats:
+    """Bytes antes (plain) e depois (wire) da compressão, nos dois sentidos de um túnel."""
+
+    __slots__ = ("plain", "wire", "bypasses")
+
+    def __init__(self, plain=0, wire=0, bypasses=0):
+        self.plain = plain
+        self.wire = wire
+        self.bypasses = bypasses  # Vezes em que um escritor desistiu de comprimir
+
+    @property
+    def ratio(self):
+        return self.wire / self.plain if self.plain else 1.0
+
+    def to_dict(self):
+        return {
+            "plain_bytes": self.plain,
+            "wire_bytes": self.wire,
+            "ratio": round(self.ratio, 3),
+            "bypasses": self.bypasses,
+        }
+
+
+class CompressedWriter:
+    """Interface de StreamWriter usada pelo relay (motor stream), comprimindo o que é escrito."""
+
+    def __init__(self, writer, level=6, stats=None):
+        self._writer = writer
+        self._compressor = zlib.compressobj(level)
+        self._stats = stats
+        self._probe_plain = 0
+        self._probe_wire = 0
+        self._bypass = 0  # Bytes que ainda vão em RAW
+
+    def write(self, data):
+        if not data:
+            return
+        if self._bypass > 0:
+            self._bypass -= len(data)
+            kind, payload = FRAME_RAW, data
+        else:
+            kind = FRAME_ZLIB
+            payload = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._probe_plain += len(data)
+            self._probe_wire += len(payload)
+            if self._probe_plain >= PROBE_BYTES:
+                if self._probe_wire > self._probe_plain * BYPASS_RATIO:
+                    self._bypass = BYPASS_BYTES
+                    if self._stats:
+                        self._stats.bypasses += 1
+                self._probe_plain = self._probe_wire = 0
+        if self._stats:
+            self._stats.plain += len(data)
+            self._stats.wire += len(payload)
+        self._writer.write(HEADER.pack(kind, len(payload)))
+        self._writer.write(payload)
+
+    async def drain(self):
+        await self._writer.drain()
+
+    def can_write_eof(self):
+        return self._writer.can_write_eof()
+
+    def write_eof(self):
+        self._writer.write_eof()
+
+    def is_closing(self):
+        return self._writer.is_closing()
+
+    def close(self):
+        self._writer.close()
+
+    async def wait_closed(self):
+        await self._writer.wait_closed()
+
+    def abort(self):
+        self._writer.transport.abort()
+
+    def get_extra_info(self, name, default=None):
+        return self._writer.get_extra_info(name, default)
+
+
+class CompressedReader:
+    """Interface de StreamReader usada pelo relay, descomprimindo os quadros recebidos."""
+
+    def __init__(self, reader, stats=None):
+        self._reader = reader
+        self._decompressor = zlib.decompressobj()
+        self._stats = stats
+        self._eof = False
+
+    def at_eof(self):
+        return self._eof and not self._decompressor.unconsumed_tail
+
+    async def read(self, n=-1):
+        # 'n' é ignorado: cada chamada entrega um quadro (até MAX_OUTPUT bytes).
+        while True:
+            tail = self._decompressor.unconsumed_tail
+            if tail:
+                data = self._decompressor.decompress(tail, MAX_OUTPUT)
+                if self._stats:
+                    self._stats.plain += len(data)
+                return data
+            if self._eof:
+                return b""
+            try:
+                kind, length = HEADER.unpack(await self._reader.readexactly(HEADER.size))
+                payload = await self._reader.readexactly(length) if length <= MAX_FRAME else None
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    raise
+                self._eof = True
+                return b""
+            if payload is None:
+                raise ConnectionResetError(f"quadro comprimido grande demais ({length} bytes)")
+            if kind == FRAME_RAW:
+                data = payload
+            elif kind == FRAME_ZLIB:
+                try:
+                    data = self._decompressor.decompress(payload, MAX_OUTPUT)
+                except zlib.error as e:
+                    raise ConnectionResetError(f"stream zlib inválido: {e}") from None
+            else:
+                raise ConnectionResetError(f"tipo de quadro desconhecido: {kind}")
+            if self._stats:
+                self._stats.wire += len(payload)
+                self._stats.plain += len(data)
+            if data:
+                return data
+
+
+def compressed_channel(reader, writer, level=6, stats=None):
+    """Envolve um canal de dados já negociado com zlib=1. Retorna (reader, writer)."""
+    return CompressedReader(reader, stats), CompressedWriter(writer, level, stats)
@@ -0,0 +1,268 @@
+"""
+Protocolo HTTP/1.1 do proxy reverso (HTTP_MODE=proxy).
+
+No modo pipe o servidor lê só os cabeçalhos da primeira requisição e liga o
+socket do visitante a um túnel. No modo proxy cada requisição é interpretada:
+o Host escolhe o túnel a cada requisição e os canais com o cliente ficam
+abertos entre requisições. Este módulo cuida só do protocolo; o roteamento e
+os canais ficam em server.py.
+
+Os cabeçalhos são lidos de forma incremental, com limite de tamanho e de
+quantidade. Os corpos (Content-Length, chunked ou até o fim da conexão) são
+encaminhados em streaming, bloco a bloco, sem nunca ficarem inteiros em
+memória. A codificação chunked é repassada como veio, mas interpretada para
+saber onde a mensagem termina.
+"""
+READ_CHUNK = 64 * 1024
+CHUNK_LINE_MAX = 4096
+
+# Tamanho do corpo: >= 0 é Content-Length.
+CHUNKED = -1
+UNTIL_CLOSE = -2
+
+# Cabeçalhos da conexão entre dois pontos, que o proxy não repassa.
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-connection", "te", "upgrade"}
+
+REASONS = {
+    400: "Bad Request",
+    404: "Not Found",
+    431: "Request Header Fields Too Large",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+}
+
+
+class HttpError(Exception):
+    """Erro de protocolo; 'status' é a resposta devida ao visitante."""
+
+    def __init__(self, status, detail):
+        super().__init__(detail)
+        self.status = status
+
+
+def error_response(status, detail):
+    body = f"CZ7 Host: {detail}".encode()
+    return (
+        f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: text/plain\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+    ).encode() + body
+
+
+class HttpReader:
+    """Leitor com buffer sobre qualquer objeto com 'async read(n)' (StreamReader, MuxStream, CompressedReader)."""
+
+    def __init__(self, source, initial=b""):
+        self.source = source
+        self.buffer = bytearray(initial)
+
+    def at_eof(self):
+        return not self.buffer and self.source.at_eof()
+
+    async def _fill(self):
+        data = await self.source.read(READ_CHUNK)
+        self.buffer += data
+        return bool(data)
+
+    async def read_head(self, limit):
+        """Cabeçalho até a linha em branco (inclusive), ou None se a conexão fechar antes do primeiro byte."""
+        scanned = 0
+        while True:
+            # Linhas vazias antes da linha inicial são ignoradas (RFC 9112, 2.2).
+            while self.buffer[:2] == b"\r\n":
+                del self.buffer[:2]
+            end = self.buffer.find(b"\r\n\r\n", max(0, scanned - 3))
+            if end >= 0:
+                if end + 4 > limit:
+                    raise HttpError(431, "Header Too Large")
+                head = bytes(self.buffer[:end + 4])
+                del self.buffer[:end + 4]
+                return head
+            if len(self.buffer) > limit:
+                raise HttpError(431, "Header Too Large")
+            scanned = len(self.buffer)
+            if not await self._fill():
+                if self.buffer:
+                    raise HttpError(400, "Incomplete Header")
+                return None
+
+    async def readline(self, limit):
+        scanned = 0
+        while True:
+            end = self.buffer.find(b"\r\n", max(0, scanned - 1))
+            if end >= 0:
+                line = bytes(self.buffer[:end + 2])
+                del self.buffer[:end + 2]
+                return line
+            if len(self.buffer) > limit:
+                raise HttpError(400, "Line Too Long")
+            scanned = len(self.buffer)
+            if not await self._fill():
+                raise HttpError(400, "Incomplete Body")
+
+    async def read_some(self, n):
+        """Até n bytes: primeiro o que já está no buffer. b'' no fim da conexão."""
+        if not self.buffer and not await self._fill():
+            return b""
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+
+class HttpHead:
+    """Linha inicial e cabeçalhos (na ordem original) de uma requisição ou resposta."""
+
+    __slots__ = ("first", "headers")
+
+    def __init__(self, first, headers):
+        self.first = first      # (método, alvo, versão) ou (versão, status, motivo)
+        self.headers = headers  # [(nome, valor)]
+
+    @classmethod
+    def parse(cls, raw, max_headers):
+        lines = raw[:-4].decode("latin-1").split("\r\n")
+        first = lines[0].split(" ", 2)
+        if len(first) == 2 and first[0].startswith("HTTP/1."):
+            first.append("")  # Resposta sem frase de motivo
+        if len(first) != 3 or not (first[0].startswith("HTTP/1.") or first[2].startswith("HTTP/1.")):
+            raise HttpError(400, "Bad Request Line")
+        if len(lines) - 1 > max_headers:
+            raise HttpError(431, "Too Many Headers")
+        headers = []
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            # Sem ':', com espaço antes dele ou continuação de linha (obs-fold): inválido.
+            if not sep or not name or name != name.strip() or line[0] in " \t":
+                raise HttpError(400, "Bad Header")
+            headers.append((name, value.strip()))
+        return cls(tuple(first), headers)
+
+    @property
+    def version(self):
+        return self.first[2] if self.first[2].startswith("HTTP/") else self.first[0]
+
+    @property
+    def status(self):
+        return int(self.first[1]) if self.first[1].isdigit() else 0
+
+    def get_all(self, name):
+        return [value for key, value in self.headers if key.lower() == name]
+
+    def get(self, name):
+        values = self.get_all(name)
+        return values[-1] if values else None
+
+    def tokens(self, name):
+        return {token.strip().lower() for value in self.get_all(name) for token in value.split(",")}
+
+    def keep_alive(self):
+        """A conexão segue aberta após esta mensagem (HTTP/1.1 sem 'Connection: close')."""
+        return self.version == "HTTP/1.1" and "close" not in self.tokens("connection")
+
+    def is_upgrade(self):
+        return "upgrade" in self.tokens("connection") and self.get("upgrade") is not None
+
+    def body_length(self, request_method=None):
+        """
+        Tamanho do corpo: Content-Length, CHUNKED ou UNTIL_CLOSE (só respostas).
+        Para requisições, request_method é None.
+        """
+        if request_method is not None:
+            status = self.status
+            if request_method == "HEAD" or status < 200 or status in (204, 304):
+                return 0
+        encodings = [
+            token.strip().lower() for value in self.get_all("transfer-encoding") for token in value.split(",") if token.strip()
+        ]
+        lengths = {value.strip() for value in self.get_all("content-length")}
+        if encodings:
+            # Em requisições, Transfer-Encoding junto de Content-Length (ou sem
+            # chunked no fim) é a receita de request smuggling.
+            if request_method is None and (lengths or encodings[-1] != "chunked"):
+                raise HttpError(400, "Bad Transfer-Encoding")
+            return CHUNKED if encodings[-1] == "chunked" else UNTIL_CLOSE
+        if lengths:
+            if len(lengths) > 1 or not next(iter(lengths)).isdigit():
+                raise HttpError(400, "Bad Content-Length")
+            return int(next(iter(lengths)))
+        return 0 if request_method is None else UNTIL_CLOSE
+
+    def serialize(self, extra=()):
+        """Cabeçalho pronto para repassar, sem os hop-by-hop (Connection e Upgrade ficam em upgrades)."""
+        if self.is_upgrade():
+            dropped = {"keep-alive", "proxy-connection", "te"}
+        else:
+            dropped = HOP_BY_HOP | self.tokens("connection")
+        lines = [" ".join(self.first).rstrip()]
+        lines += [f"{name}: {value}" for name, value in self.headers if name.lower() not in dropped]
+        lines += [f"{name}: {value}" for name, value in extra]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def _forward(data, writer, counter):
+    writer.write(data)
+    if counter is not None:
+        counter.bytes += len(data)
+        if counter.shaper:
+            await counter.shaper.throttle(len(data))
+    await writer.drain()
+
+
+async def copy_body(reader, writer, length, counter=None, sink=None):
+    """
+    Encaminha um corpo de 'reader' (HttpReader) para 'writer', em streaming.
+    'sink', se dado, recebe também o conteúdo já sem a codificação chunked.
+    """
+    if length == UNTIL_CLOSE:
+        while data := await reader.read_some(READ_CHUNK):
+            await _forward(data, writer, counter)
+            if sink:
+                sink(data)
+        return
+    if length == CHUNKED:
+        while True:
+            line = await reader.readline(CHUNK_LINE_MAX)
+            size = line.split(b";", 1)[0].strip()
+            try:
+                size = int(size, 16)
+            except ValueError:
+                raise HttpError(400, "Bad Chunk")
+            await _forward(line, writer, counter)
+            if size == 0:
+                # Trailers opcionais até a linha vazia.
+                while line != b"\r\n":
+                    line = await reader.readline(CHUNK_LINE_MAX)
+                    await _forward(line, writer, counter)
+                return
+            await copy_body(reader, writer, size, counter, sink)
+            if await reader.readline(2) != b"\r\n":
+                raise HttpError(400, "Bad Chunk")
+            await _forward(b"\r\n", writer, counter)
+    while length > 0:
+        data = await reader.read_some(min(length, READ_CHUNK))
+        if not data:
+            raise HttpError(400, "Incomplete Body")
+        length -= len(data)
+        await _forward(data, writer, counter)
+        if sink:
+            sink(data)
+
+
+class Upstream:
+    """Canal com o serviço local de um túnel, usado por uma requisição por vez e reaproveitado entre elas."""
+
+    __slots__ = ("reader", "writer", "replica", "timer")
+
+    def __init__(self, reader, writer, replica=None):
+        self.reader = HttpReader(reader)
+        self.writer = writer
+        self.replica = replica  # Réplica do cliente que atende o canal (None se ela está em outro worker)
+        self.timer = None  # Prazo enquanto ocioso
+
+    def closed(self):
+        return self.reader.at_eof() or self.writer.is_closing()
+
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.writer.close()
@@ -0,0 +1,50 @@
+"""
+Teto de memória do processo: com o RSS acima do limite, o servidor recusa
+visitantes novos (em vez de crescer até o kernel matá-lo) e volta a aceitar
+quando as conexões existentes terminam e a memória baixa.
+
+O RSS vem de /proc/self/statm (Linux); sem /proc, process_rss() retorna None
+e o teto não é aplicado.
+"""
+import os
+import time
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def process_rss():
+    """Memória residente do processo em bytes, ou None se não for possível medir."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MemoryGuard:
+    """
+    Compara o RSS com 'limit' (bytes). A leitura de /proc é refeita no máximo
+    a cada 'interval' segundos, para caber no caminho de cada conexão nova.
+    """
+
+    __slots__ = ("limit", "interval", "rss", "_checked")
+
+    def __init__(self, limit, interval=0.1):
+        self.limit = limit
+        self.interval = interval
+        self.rss = process_rss()
+        self._checked = time.monotonic()
+
+    @property
+    def available(self):
+        return self.rss is not None
+
+    def exceeded(self):
+        now = time.monotonic()
+        if now - self._checked >= self.interval:
+            self._checked = now
+            self.rss = process_rss()
+        return self.rss is not None and self.rss > self.limit
+
+    def to_dict(self):
+        return {"rss_bytes": self.rss, "limit_bytes": self.limit}
@@ -0,0 +1,88 @@
+"""
+Métricas no formato texto do Prometheus, sem dependências externas.
+
+Histogram acumula observações em buckets cumulativos; MetricsWriter monta a
+resposta de /metrics (cabeçalhos HELP/TYPE, rótulos escapados).
+"""
+import bisect
+import math
+
+# Latências curtas (pareamento, cabeçalhos HTTP, atraso do loop), em segundos.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ("name", "help", "buckets", "counts", "sum", "count")
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # O último é +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def state(self):
+        """Estado serializável, para somar histogramas de vários processos."""
+        return {"counts": self.counts, "sum": self.sum, "count": self.count}
+
+    def merged(self, states):
+        """Cópia deste histograma somada aos estados recebidos."""
+        total = Histogram(self.name, self.help, self.buckets)
+        for state in [self.state(), *states]:
+            total.counts = [a + b for a, b in zip(total.counts, state["counts"])]
+            total.sum += state["sum"]
+            total.count += state["count"]
+        return total
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _number(value):
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class MetricsWriter:
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._lines = []
+
+    def family(self, name, kind, help):
+        self._lines.append(f"# HELP {name} {help}")
+        self._lines.append(f"# TYPE {name} {kind}")
+
+    def sample(self, name, value, labels=None):
+        self._lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+    def metric(self, name, kind, help, value, labels=None):
+        self.family(name, kind, help)
+        self.sample(name, value, labels)
+
+    def histogram(self, histogram):
+        name = histogram.name
+        self.family(name, "histogram", histogram.help)
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (math.inf,), histogram.counts):
+            cumulative += count
+            self.sample(f"{name}_bucket", cumulative, {"le": _number(float(bound))})
+        self.sample(f"{name}_sum", histogram.sum)
+        self.sample(f"{name}_count", histogram.count)
+
+    def render(self):
+        return "\n".join(self._lines) + "\n"
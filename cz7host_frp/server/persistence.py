@@ -0,0 +1,134 @@
+"""
+Estado persistente da tabela de túneis: snapshot compacto + journal.
+
+Cada alteração (túnel criado ou removido, domínio, limites) vira uma linha
+JSON no journal, só com acréscimos. De tempos em tempos a tabela inteira é
+gravada em um snapshot e o journal recomeça. Na partida, carrega-se o
+snapshot e reaplica-se o journal por cima.
+
+As linhas guardam o estado final de cada alteração (nunca incrementos), então
+reaplicar uma linha já contida no snapshot não muda nada. Isso permite
+compactar sem parar as escritas: o journal atual é renomeado para
+'journal.prev', novas linhas vão para um journal vazio e o snapshot é gravado
+em uma thread; se o processo cair no meio, a carga lê os três arquivos.
+
+O snapshot guarda os registros em colunas ("fields" uma vez, depois uma lista
+por túnel): o arquivo fica com menos da metade do tamanho e a carga não monta
+um dict por linha no parser JSON. Snapshots antigos ("records") ainda são lidos.
+"""
+import asyncio
+import json
+import os
+
+SNAPSHOT_FILE = "snapshot.json"
+JOURNAL_FILE = "journal.jsonl"
+PREVIOUS_JOURNAL_FILE = "journal.prev"
+
+
+class StateStore:
+    def __init__(self, directory, log=print):
+        self.directory = directory
+        self.log = log
+        self.entries = 0  # Linhas no journal desde o último snapshot
+        self._journal = None
+        self._buffer = []
+        self._flush_handle = None
+        self._compacting = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load(self):
+        """Registros salvos, em ordem: os do snapshot seguidos dos journals."""
+        os.makedirs(self.directory, exist_ok=True)
+        records = []
+        try:
+            with open(self._path(SNAPSHOT_FILE), "rb") as f:
+                snapshot = json.loads(f.read())
+            if "rows" in snapshot:
+                fields = snapshot["fields"]
+                records.extend(dict(zip(fields, row)) for row in snapshot["rows"])
+            else:
+                records.extend(snapshot["records"])
+        except FileNotFoundError:
+            pass
+        for name in (PREVIOUS_JOURNAL_FILE, JOURNAL_FILE):
+            try:
+                with open(self._path(name), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            complete = data[:data.rfind(b"\n") + 1]
+            if len(complete) != len(data):
+                # Última linha cortada por uma queda no meio da escrita: é
+                # descartada para que as próximas não se colem a ela.
+                with open(self._path(name), "r+b") as f:
+                    f.truncate(len(complete))
+            lines = complete.splitlines()
+            for line in lines:
+                records.append(json.loads(line))
+            if name == JOURNAL_FILE:
+                self.entries = len(lines)
+        self._journal = open(self._path(JOURNAL_FILE), "ab")
+        return records
+
+    def append(self, record):
+        """Acrescenta um registro ao journal. As escritas de uma mesma volta do loop saem juntas."""
+        self._buffer.append(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+        self.entries += 1
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self._flush_handle = None
+        if self._buffer:
+            self._journal.write(b"".join(self._buffer))
+            self._journal.flush()
+            self._buffer.clear()
+
+    @property
+    def compacting(self):
+        return self._compacting is not None and not self._compacting.done()
+
+    def compact(self, records):
+        """
+        Começa a gravar 'records' (a tabela atual) como snapshot, em uma thread,
+        e descarta o journal já coberto por ele. Retorna o Future da gravação.
+        """
+        self.flush()
+        self._journal.close()
+        journal, previous = self._path(JOURNAL_FILE), self._path(PREVIOUS_JOURNAL_FILE)
+        if os.path.exists(previous):
+            # Uma compactação anterior foi interrompida: o journal antigo ainda vale.
+            with open(previous, "ab") as dst, open(journal, "rb") as src:
+                dst.write(src.read())
+            os.remove(journal)
+        else:
+            os.replace(journal, previous)
+        self._journal = open(self._path(JOURNAL_FILE), "ab")
+        self.entries = 0
+        self._compacting = asyncio.ensure_future(asyncio.to_thread(self._write_snapshot, records))
+        self._compacting.add_done_callback(self._compacted)
+        return self._compacting
+
+    def _compacted(self, future):
+        if not future.cancelled() and future.exception():
+            self.log(f"[ESTADO] Falha ao gravar o snapshot: {future.exception()}")
+
+    def _write_snapshot(self, records):
+        # Os registros do snapshot são todos mensagens 'tunnel', com as mesmas chaves.
+        fields = list(records[0]) if records else []
+        rows = [[record[field] for field in fields] for record in records]
+        tmp = self._path(SNAPSHOT_FILE + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(json.dumps({"fields": fields, "rows": rows}, separators=(",", ":")).encode())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path(SNAPSHOT_FILE))
+        os.remove(self._path(PREVIOUS_JOURNAL_FILE))
+
+    def close(self):
+        if self._journal:
+            self.flush()
+            self._journal.close()
+            self._journal = None
@@ -0,0 +1,94 @@
+"""
+Alocador de portas públicas em O(1), com reuso determinístico.
+
+O estado de cada porta do intervalo fica em um bytearray (1 byte por porta).
+Portas já liberadas saem de uma pilha (LIFO): a última liberada é a primeira
+reusada. Sem nenhuma na pilha, usa-se a próxima porta nunca alocada, em ordem
+crescente a partir de PUBLIC_PORT_START.
+
+Uma porta liberada passa antes por uma quarentena (segundos), para que
+visitantes e clientes antigos que ainda tentem aquela porta não caiam no túnel
+de outra pessoa. Se não houver outra porta livre, a quarentena mais antiga é
+encurtada. Uma porta que não abriu (ocupada por outro processo) também vai
+para a quarentena, por pelo menos BUSY_RETRY segundos, para que as próximas
+alocações tentem outras portas antes dela.
+
+A pilha pode conter entradas obsoletas (porta reservada por reserve() depois
+de empilhada); elas são descartadas ao sair da pilha.
+"""
+import collections
+import time
+
+FREE = 0
+USED = 1
+QUARANTINED = 2
+
+BUSY_RETRY = 60.0
+
+
+class PortAllocator:
+    def __init__(self, start, end, quarantine=0.0):
+        self.start = start
+        self.end = end
+        self.quarantine = quarantine
+        self._state = bytearray(max(0, end - start + 1))
+        self._free = []                                # Pilha de portas liberadas (topo no fim)
+        self._next = start                             # Portas a partir daqui nunca foram alocadas
+        self._quarantined = collections.deque()       # (libera em, porta), em ordem de liberação
+        self._available = len(self._state)             # Portas livres ou em quarentena
+
+    def __len__(self):
+        return self._available
+
+    def __contains__(self, port):
+        return self.start <= port <= self.end
+
+    def allocate(self):
+        """Próxima porta livre (ou None se o intervalo estiver esgotado)."""
+        self._expire(time.monotonic())
+        while self._free:
+            port = self._free.pop()
+            if self._state[port - self.start] == FREE:
+                return self._take(port)
+        while self._next <= self.end:
+            port = self._next
+            self._next += 1
+            if self._state[port - self.start] == FREE:
+                return self._take(port)
+        while self._quarantined:
+            _, port = self._quarantined.popleft()
+            if self._state[port - self.start] == QUARANTINED:
+                return self._take(port)
+        return None
+
+    def reserve(self, port):
+        """Marca uma porta específica como usada (túneis restaurados). False se fora do intervalo ou já usada."""
+        if port not in self or self._state[port - self.start] == USED:
+            return False
+        self._take(port)
+        return True
+
+    def release(self, port, busy=False):
+        """'busy': a porta não pôde ser aberta; fica na quarentena mesmo sem PORT_QUARANTINE."""
+        if port not in self or self._state[port - self.start] != USED:
+            return
+        self._available += 1
+        quarantine = max(self.quarantine, BUSY_RETRY) if busy else self.quarantine
+        if quarantine > 0:
+            self._state[port - self.start] = QUARANTINED
+            self._quarantined.append((time.monotonic() + quarantine, port))
+        else:
+            self._state[port - self.start] = FREE
+            self._free.append(port)
+
+    def _take(self, port):
+        self._state[port - self.start] = USED
+        self._available -= 1
+        return port
+
+    def _expire(self, now):
+        while self._quarantined and self._quarantined[0][0] <= now:
+            _, port = self._quarantined.popleft()
+            if self._state[port - self.start] == QUARANTINED:
+                self._state[port - self.start] = FREE
+                self._free.append(port)
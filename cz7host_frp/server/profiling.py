@@ -0,0 +1,152 @@
+"""
+Perfis do event loop sob demanda (POST /admin/profile), por uma janela limitada.
+
+- sample: uma thread lê a pilha da thread do loop (sys._current_frames) a
+          cada 'interval' segundos e conta onde o loop estava. Não toca no
+          código observado; o custo é o de copiar uma pilha por amostra.
+- slow:   liga o modo debug do asyncio com slow_callback_duration =
+          'threshold' e recolhe os avisos "Executing ... took", agrupados
+          por callback. O modo debug pesa no loop inteiro enquanto dura.
+"""
+import asyncio
+import collections
+import logging
+import os
+import re
+import sys
+import threading
+
+# Pilha do loop parado esperando eventos (não conta como tempo ocupado).
+IDLE_FRAMES = {("selectors.py", "select"), ("selectors.py", "poll")}
+STACK_DEPTH = 64
+
+
+def _frame_key(frame):
+    code = frame.f_code
+    return os.path.basename(code.co_filename), code.co_name
+
+
+class StackSampler:
+    """Amostras da pilha de uma thread, tiradas por outra thread a cada 'interval' segundos."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.idle = 0
+        self.own = collections.Counter()     # Frame do topo: 'arquivo:linha função'
+        self.total = collections.Counter()   # Funções presentes na pilha
+        self.stacks = collections.Counter()  # Pilhas completas, da raiz para o topo
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            filename, name = _frame_key(frame)
+            if (filename, name) in IDLE_FRAMES:
+                self.idle += 1
+                continue
+            self.own[f"{filename}:{frame.f_lineno} {name}"] += 1
+            names = []
+            while frame is not None and len(names) < STACK_DEPTH:
+                names.append("%s:%s" % _frame_key(frame))
+                frame = frame.f_back
+            for name in set(names):
+                self.total[name] += 1
+            self.stacks[";".join(reversed(names))] += 1
+
+    def result(self, top):
+        def ranked(counter):
+            return [
+                {"frame": frame, "samples": count, "ratio": round(count / self.samples, 4)}
+                for frame, count in counter.most_common(top)
+            ]
+
+        return {
+            "samples": self.samples,
+            "busy_ratio": round((self.samples - self.idle) / self.samples, 4) if self.samples else 0.0,
+            "top_self": ranked(self.own),
+            "top_total": ranked(self.total),
+            "stacks": [{"stack": stack, "samples": count} for stack, count in self.stacks.most_common(top)],
+        }
+
+
+async def sample_stacks(seconds, interval=0.005, top=20):
+    """Amostra a pilha do loop atual por 'seconds' segundos."""
+    sampler = StackSampler(threading.get_ident(), interval)
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        await asyncio.to_thread(sampler.stop)
+    return {"mode": "sample", "seconds": seconds, "interval_ms": interval * 1000, **sampler.result(top)}
+
+
+class _SlowCallbacks(logging.Handler):
+    """Recolhe os avisos de callback lento do logger do asyncio; os demais seguem para 'forward'."""
+
+    CORO = re.compile(r"coro=<(\S+?)\(\) \w+ at ([^>]+)>")
+    ADDRESS = re.compile(r" at 0x[0-9a-f]+")
+
+    def __init__(self, forward):
+        super().__init__(logging.WARNING)
+        self.forward = forward
+        self.callbacks = {}  # {callback: [vezes, segundos, pior]}
+
+    def emit(self, record):
+        if record.msg.startswith("Executing ") and len(record.args) == 2:
+            callback, seconds = record.args
+            entry = self.callbacks.setdefault(self.normalize(callback), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+        elif self.forward:
+            self.forward(f"[ASYNCIO] {record.getMessage()}")
+
+    def normalize(self, callback):
+        """Tarefas viram 'corrotina() arquivo:linha'; endereços de objetos são removidos."""
+        match = self.CORO.search(callback)
+        if match:
+            return f"{match.group(1)}() {os.path.basename(match.group(2))}"
+        return self.ADDRESS.sub("", callback)[:200]
+
+
+async def slow_callbacks(seconds, threshold=0.05, top=20, forward=None):
+    """Callbacks do loop que passaram de 'threshold' segundos durante 'seconds' segundos."""
+    loop = asyncio.get_running_loop()
+    logger = logging.getLogger("asyncio")
+    handler = _SlowCallbacks(forward)
+    debug, duration, propagate = loop.get_debug(), loop.slow_callback_duration, logger.propagate
+    logger.addHandler(handler)
+    logger.propagate = False
+    loop.slow_callback_duration = threshold
+    loop.set_debug(True)
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        loop.set_debug(debug)
+        loop.slow_callback_duration = duration
+        logger.propagate = propagate
+        logger.removeHandler(handler)
+    ranked = sorted(handler.callbacks.items(), key=lambda item: item[1][1], reverse=True)
+    return {
+        "mode": "slow",
+        "seconds": seconds,
+        "threshold_ms": threshold * 1000,
+        "slow_callbacks": sum(count for count, _, _ in handler.callbacks.values()),
+        "callbacks": [
+            {"callback": callback, "count": count, "total_ms": round(total * 1000, 1), "max_ms": round(worst * 1000, 1)}
+            for callback, (count, total, worst) in ranked[:top]
+        ],
+    }
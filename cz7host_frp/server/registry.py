@@ -0,0 +1,347 @@
+"""
+Registro de túneis com índices secundários O(1).
+
+Substitui os dicionários globais tunnels/domain_map/pending_connections:
+toda consulta ou limpeza (por conexão de controle, usuário, domínio ou porta
+pública) é uma busca em dicionário, independente do número de túneis.
+A listagem paginada usa uma lista ordenada de tunnel_ids, criada na primeira
+listagem e mantida a partir daí.
+"""
+import bisect
+import time
+
+# Peso de cada nova medida na latência média (EWMA) de uma réplica.
+LATENCY_ALPHA = 0.2
+
+
+class Replica:
+    """
+    Uma conexão de controle servindo um túnel. Um túnel aceita várias (o mesmo
+    serviço em várias máquinas); cada visitante vai para a réplica escolhida
+    por Tunnel.pick_replica(). No coordenador do modo multi-processo as
+    réplicas só espelham os contadores do worker dono (control_writer None).
+    """
+
+    __slots__ = (
+        "id", "tunnel_id", "control_writer", "client_addr", "mux", "mux_session", "multi", "pool",
+        "rtt", "active", "latency",
+    )
+
+    def __init__(self, id, tunnel_id, control_writer, client_addr, mux=False, mux_session=None, multi=False, pool=None):
+        self.id = id           # O mesmo para todos os túneis de uma conexão (POOL:<id> replica=<id>)
+        self.tunnel_id = tunnel_id
+        self.control_writer = control_writer
+        self.client_addr = client_addr
+        self.mux = mux
+        self.mux_session = mux_session
+        self.multi = multi     # A conexão de controle serve vários túneis (handshake multi=1)
+        self.pool = pool       # deque de canais pré-aquecidos, se o cliente pediu pool=1
+        self.rtt = None        # Segundos, medido pelo heartbeat do canal de controle
+        self.active = 0        # Visitantes sendo atendidos por esta réplica
+        self.latency = None    # EWMA (s) do RTT do heartbeat e do tempo de pareamento
+
+    def observe_latency(self, seconds):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_ALPHA * (seconds - self.latency)
+
+    def to_dict(self):
+        data = {"id": self.id, "client_addr": self.client_addr, "mux": self.mux, "active": self.active}
+        if self.latency is not None:
+            data["latency_ms"] = round(self.latency * 1000, 2)
+        if self.rtt is not None:
+            data["rtt_ms"] = round(self.rtt * 1000, 2)
+        return data
+
+    @classmethod
+    def from_dict(cls, tunnel_id, data):
+        """Espelho de uma réplica relatada por um worker."""
+        client_addr = tuple(data["client_addr"]) if data["client_addr"] else None
+        replica = cls(data["id"], tunnel_id, None, client_addr, data["mux"])
+        replica.active = data["active"]
+        replica.latency = data["latency_ms"] / 1000 if "latency_ms" in data else None
+        replica.rtt = data["rtt_ms"] / 1000 if "rtt_ms" in data else None
+        return replica
+
+
+class Tunnel:
+    """Estado de um túnel. Campos fixos (__slots__) para reduzir memória por túnel."""
+
+    __slots__ = (
+        "tunnel_id", "user_id", "local_port", "public_port", "public_server", "protocol",
+        "domain", "replicas", "rotation", "pool_hits", "pool_misses",
+        "worker", "handoff", "limits", "compression", "expiry", "listener_idle", "http_idle", "cache",
+        "bytes_in", "bytes_out", "connections_active", "connections_total", "meters",
+    )
+
+    def __init__(self, tunnel_id, user_id, local_port, public_port, public_server=None, protocol="tcp"):
+        self.tunnel_id = tunnel_id
+        self.user_id = user_id
+        self.local_port = local_port
+        self.public_port = public_port
+        self.public_server = public_server  # asyncio.Server (TCP) ou UdpRelay (UDP), se aberta neste processo
+        self.protocol = protocol  # tcp ou udp
+        self.domain = None
+        self.replicas = []     # [Replica], uma por conexão de controle do cliente
+        self.rotation = 0      # Onde começa a busca da próxima réplica (empates em rodízio)
+        self.pool_hits = 0
+        self.pool_misses = 0
+        self.worker = None     # Modo multi-processo: worker dono da conexão de controle
+        self.handoff = False   # Visitantes precisam ser entregues ao worker dono (mux/pool)
+        self.limits = None     # shaping.Limits, se o túnel tiver limites de banda/conexões
+        self.compression = None  # compression.CompressionStats, após o primeiro canal zlib
+        self.expiry = None     # Timer que remove o túnel se o cliente não reconectar
+        self.listener_idle = None  # Timer que fecha a porta pública ociosa (modo lazy)
+        self.http_idle = None  # Modo proxy HTTP: [httpproxy.Upstream] ociosos, criado no primeiro uso
+        self.cache = False     # Respostas do domínio passam pelo cache de borda (modo proxy)
+        # Tráfego: in = visitante -> cliente, out = cliente -> visitante.
+        # bytes_* somam as conexões já encerradas; as ativas ficam em 'meters'.
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections_active = 0
+        self.connections_total = 0
+        self.meters = set()
+
+    @property
+    def connected(self):
+        return bool(self.replicas)
+
+    @property
+    def mux(self):
+        return any(replica.mux for replica in self.replicas)
+
+    @property
+    def client_addr(self):
+        return self.replicas[0].client_addr if self.replicas else None
+
+    @property
+    def rtt(self):
+        """Menor RTT entre as réplicas, ou None."""
+        return min((replica.rtt for replica in self.replicas if replica.rtt is not None), default=None)
+
+    def pick_replica(self, by_latency=False, signalable=False):
+        """
+        Réplica para o próximo visitante: a com menos visitantes ativos ou, com
+        by_latency, a de menor latência média multiplicada pela carga (réplica
+        ainda sem medida é experimentada primeiro). Empates se revezam.
+        Com signalable, só réplicas que recebem NEW_CONNECTION (sem mux).
+        """
+        replicas = [r for r in self.replicas if not r.mux] if signalable else self.replicas
+        if not replicas:
+            return None
+        self.rotation = (self.rotation + 1) % len(replicas)
+        ordered = replicas[self.rotation:] + replicas[:self.rotation]
+        if by_latency:
+            return min(ordered, key=lambda r: (r.latency or 0.0) * (r.active + 1))
+        return min(ordered, key=lambda r: r.active)
+
+    def replica(self, replica_id):
+        return next((replica for replica in self.replicas if replica.id == replica_id), None)
+
+    def open_meter(self, meter):
+        """Registra o RelayMeter de uma conexão que começou a ser encaminhada."""
+        self.meters.add(meter)
+        self.connections_active += 1
+        self.connections_total += 1
+
+    def close_meter(self, meter):
+        self.meters.discard(meter)
+        self.connections_active -= 1
+        self.bytes_in += meter.a_to_b.bytes
+        self.bytes_out += meter.b_to_a.bytes
+
+    def traffic(self):
+        """Contadores ao vivo, incluindo o que as conexões ativas já encaminharam."""
+        bytes_in, bytes_out = self.bytes_in, self.bytes_out
+        for meter in self.meters:
+            bytes_in += meter.a_to_b.bytes
+            bytes_out += meter.b_to_a.bytes
+        return {
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "connections_active": self.connections_active,
+            "connections_total": self.connections_total,
+        }
+
+    def to_dict(self):
+        """Representação serializável em JSON para a API."""
+        data = {
+            "user_id": self.user_id,
+            "local_port": self.local_port,
+            "public_port": self.public_port,
+            "protocol": self.protocol,
+            "connected": self.connected,
+            "domain": self.domain,
+            "client_addr": self.client_addr,
+            "mux": self.mux,
+            "cache": self.cache,
+            "pool_hits": self.pool_hits,
+            "pool_misses": self.pool_misses,
+            **self.traffic(),
+        }
+        pools = [replica.pool for replica in self.replicas if replica.pool is not None]
+        if pools:
+            data["pool_idle"] = sum(len(pool) for pool in pools)
+        if self.worker is not None:
+            data["worker"] = self.worker
+        if self.limits is not None:
+            data["limits"] = self.limits.to_dict()
+        if self.compression is not None:
+            data["compression"] = self.compression.to_dict()
+        if self.rtt is not None:
+            data["rtt_ms"] = round(self.rtt * 1000, 2)
+        if self.replicas:
+            data["replicas"] = [replica.to_dict() for replica in self.replicas]
+        return data
+
+
+class PendingConnection:
+    """
+    Conexão pública aguardando o canal DATA do cliente. No proxy HTTP não há
+    conexão pública: 'channel' é um Future que recebe (reader, writer) do canal.
+    """
+
+    __slots__ = ("tunnel_id", "public_reader", "public_writer", "initial_data", "channel", "replica", "timer", "created")
+
+    def __init__(self, tunnel_id, public_reader, public_writer, initial_data=None, channel=None, replica=None):
+        self.tunnel_id = tunnel_id
+        self.public_reader = public_reader
+        self.public_writer = public_writer
+        self.initial_data = initial_data
+        self.channel = channel
+        self.replica = replica  # Réplica sinalizada com NEW_CONNECTION (None se foi em outro worker)
+        self.timer = None  # Prazo para o cliente abrir o canal DATA
+        self.created = time.monotonic()
+
+
+class TunnelRegistry:
+    def __init__(self):
+        self._tunnels = {}     # {tunnel_id: Tunnel}
+        self._by_control = {}  # {control_writer: [Tunnel]} (vários com o handshake multi=1)
+        self._by_user = {}     # {user_id: {tunnel_id: Tunnel}}
+        self._by_domain = {}   # {hostname: Tunnel}
+        self._by_port = {}     # {public_port: Tunnel}
+        self._pending = {}     # {token: PendingConnection}
+        self._order = None     # tunnel_ids ordenados (paginação); None até a primeira listagem
+
+    def __len__(self):
+        return len(self._tunnels)
+
+    def __contains__(self, tunnel_id):
+        return tunnel_id in self._tunnels
+
+    def __iter__(self):
+        return iter(list(self._tunnels.values()))
+
+    # --- Túneis ---
+
+    def add(self, tunnel):
+        if self._order is not None and tunnel.tunnel_id not in self._tunnels:
+            bisect.insort(self._order, tunnel.tunnel_id)
+        self._tunnels[tunnel.tunnel_id] = tunnel
+        self._by_user.setdefault(tunnel.user_id, {})[tunnel.tunnel_id] = tunnel
+        if tunnel.public_port is not None:
+            self._by_port[tunnel.public_port] = tunnel
+        return tunnel
+
+    def get(self, tunnel_id):
+        return self._tunnels.get(tunnel_id)
+
+    def remove(self, tunnel_id):
+        """Remove o túnel de todos os índices e o retorna (ou None)."""
+        tunnel = self._tunnels.pop(tunnel_id, None)
+        if tunnel is None:
+            return None
+        if self._order is not None:
+            del self._order[bisect.bisect_left(self._order, tunnel_id)]
+        user_tunnels = self._by_user.get(tunnel.user_id)
+        if user_tunnels is not None:
+            user_tunnels.pop(tunnel_id, None)
+            if not user_tunnels:
+                del self._by_user[tunnel.user_id]
+        if self._by_port.get(tunnel.public_port) is tunnel:
+            del self._by_port[tunnel.public_port]
+        self.set_domain(tunnel, None)
+        for replica in tunnel.replicas:
+            served = self._by_control.get(replica.control_writer)
+            if served and tunnel in served:
+                served.remove(tunnel)
+                if not served:
+                    del self._by_control[replica.control_writer]
+        return tunnel
+
+    def page(self, cursor=None, limit=100, user_id=None, connected=None):
+        """
+        Até 'limit' túneis em ordem de tunnel_id, começando após 'cursor'
+        (o último tunnel_id da página anterior). Retorna (túneis, próximo cursor ou None).
+        """
+        if user_id is not None:
+            ids = sorted(self._by_user.get(user_id, ()))
+        else:
+            if self._order is None:
+                self._order = sorted(self._tunnels)
+            ids = self._order
+        tunnels = []
+        start = bisect.bisect_right(ids, cursor) if cursor else 0
+        for index in range(start, len(ids)):
+            tunnel = self._tunnels[ids[index]]
+            if connected is None or tunnel.connected == connected:
+                tunnels.append(tunnel)
+                if len(tunnels) == limit:
+                    return tunnels, tunnel.tunnel_id if index + 1 < len(ids) else None
+        return tunnels, None
+
+    # --- Índices secundários ---
+
+    def by_control(self, control_writer):
+        return list(self._by_control.get(control_writer, ()))
+
+    def by_user(self, user_id):
+        return list(self._by_user.get(user_id, {}).values())
+
+    def by_domain(self, hostname):
+        return self._by_domain.get(hostname)
+
+    def by_port(self, public_port):
+        return self._by_port.get(public_port)
+
+    def set_domain(self, tunnel, hostname):
+        """Aponta hostname para o túnel (None remove o mapeamento atual)."""
+        if tunnel.domain and self._by_domain.get(tunnel.domain) is tunnel:
+            del self._by_domain[tunnel.domain]
+        tunnel.domain = hostname
+        if hostname:
+            self._by_domain[hostname] = tunnel
+
+    def attach_control(self, tunnel, replica):
+        tunnel.replicas.append(replica)
+        self._by_control.setdefault(replica.control_writer, []).append(tunnel)
+
+    def detach_control(self, control_writer):
+        """
+        Desassocia a conexão de controle; retorna [(túnel, réplica)] que ela
+        servia (talvez nenhum). Túneis com outras réplicas seguem conectados.
+        """
+        detached = []
+        for tunnel in self._by_control.pop(control_writer, []):
+            replica = next(r for r in tunnel.replicas if r.control_writer is control_writer)
+            tunnel.replicas.remove(replica)
+            detached.append((tunnel, replica))
+        return detached
+
+    # --- Conexões pendentes ---
+
+    def add_pending(self, token, pending):
+        self._pending[token] = pending
+
+    def pop_pending(self, token):
+        return self._pending.pop(token, None)
+
+    @property
+    def pending_count(self):
+        return len(self._pending)
+
+    def pending_for(self, replica):
+        """[(token, pendente)] sinalizados à réplica e ainda sem canal DATA (busca linear; só quando ela cai)."""
+        return [(token, pending) for token, pending in self._pending.items() if pending.replica is replica]
@@ -0,0 +1,407 @@
+"""
+Motores de encaminhamento (relay) entre duas conexões.
+
+- stream:   laço read/write/drain sobre StreamReader/StreamWriter (comportamento original).
+- buffered: troca o protocolo dos dois transportes por um BufferedProtocol que lê
+            direto em buffers pré-alocados e reutilizados, com backpressure via
+            pause_reading/resume_reading.
+- splice:   Linux; move os bytes socket -> pipe -> socket com os.splice, sem
+            copiar para o espaço do usuário.
+- compact:  como o buffered, mas sem buffer por conexão: todas leem num único
+            buffer de rascunho e entregam os bytes na hora ao par. Uma conexão
+            ociosa não guarda buffer algum; é o motor para muitas conexões
+            paradas (WebSockets, jogos) com pouca memória.
+- auto:     splice quando disponível, senão buffered, senão stream.
+
+Os motores buffered, splice e compact exigem que as duas pontas sejam sockets TCP simples
+(sem TLS); caso contrário, como em streams mux, o relay usa o motor stream.
+
+Este arquivo existe, idêntico, em server/ e client/.
+"""
+import asyncio
+import os
+import socket
+
+try:
+    import fcntl
+except ImportError:  # Windows (clientes)
+    fcntl = None
+
+RELAY_ENGINES = ("stream", "buffered", "splice", "compact", "auto")
+
+STREAM_CHUNK = 4096
+SPLICE_CHUNK = 1024 * 1024
+SHAPED_CHUNK = 64 * 1024  # Teto de leitura por vez quando o sentido tem limite de banda
+COMPACT_CHUNK = 64 * 1024
+SPLICE_AVAILABLE = hasattr(os, "splice")
+
+
+class ByteCounter:
+    """
+    Bytes encaminhados em um sentido. Atualizado uma vez por bloco lido, nunca por byte.
+
+    'shaper', se definido, limita a banda do sentido: shaper.charge(n, resume)
+    retorna True quando a leitura deve parar até resume() ser chamado, e
+    shaper.throttle(n) é a versão com await.
+    """
+
+    __slots__ = ("bytes", "shaper")
+
+    def __init__(self):
+        self.bytes = 0
+        self.shaper = None
+
+
+class RelayMeter:
+    """Contadores de um relay nos dois sentidos (A->B e B->A)."""
+
+    __slots__ = ("a_to_b", "b_to_a")
+
+    def __init__(self):
+        self.a_to_b = ByteCounter()
+        self.b_to_a = ByteCounter()
+
+    @property
+    def total(self):
+        return self.a_to_b.bytes + self.b_to_a.bytes
+
+
+async def forward_data(reader, writer, name, counter=None):
+    """Lê dados de um 'reader' e os escreve em um 'writer'."""
+    try:
+        while not reader.at_eof():
+            data = await reader.read(STREAM_CHUNK)
+            if not data:
+                break
+            if counter:
+                counter.bytes += len(data)
+            writer.write(data)
+            await writer.drain()
+            if counter and counter.shaper:
+                await counter.shaper.throttle(len(data))
+    except (ConnectionResetError, asyncio.IncompleteReadError, BrokenPipeError):
+        pass # Silencioso para não poluir o log
+    finally:
+        writer.close()
+
+
+async def relay(a_reader, a_writer, b_reader, b_writer, engine="stream", meter=None):
+    """Encaminha dados nos dois sentidos entre A e B até as duas pontas encerrarem."""
+    a_to_b, b_to_a = (meter.a_to_b, meter.b_to_a) if meter else (None, None)
+    engine = select_engine(engine, a_writer, b_writer)
+    if engine == "splice":
+        await _relay_splice(a_reader, a_writer, b_reader, b_writer, a_to_b, b_to_a)
+    elif engine == "buffered":
+        await _relay_buffered(a_reader, a_writer, b_reader, b_writer, a_to_b, b_to_a)
+    elif engine == "compact":
+        await _relay_buffered(a_reader, a_writer, b_reader, b_writer, a_to_b, b_to_a, _CompactProtocol)
+    else:
+        await asyncio.gather(
+            forward_data(a_reader, b_writer, "a->b", a_to_b),
+            forward_data(b_reader, a_writer, "b->a", b_to_a)
+        )
+
+
+def abort_relay(*writers):
+    """Derruba as pontas de um relay em andamento, qualquer que seja o motor."""
+    for writer in writers:
+        transport = getattr(writer, "transport", None)
+        if transport is None:
+            writer.abort()  # Stream mux
+            continue
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            # shutdown atinge também os descritores duplicados do motor splice.
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        transport.abort()
+
+
+def select_engine(engine, a_writer, b_writer):
+    if engine == "stream" or not (_plain_socket(a_writer) and _plain_socket(b_writer)):
+        return "stream"
+    if engine in ("splice", "auto") and SPLICE_AVAILABLE:
+        return "splice"
+    return "compact" if engine == "compact" else "buffered"
+
+
+def _plain_socket(writer):
+    transport = getattr(writer, "transport", None)
+    return (
+        isinstance(transport, asyncio.Transport)
+        and not transport.is_closing()
+        and transport.get_extra_info("socket") is not None
+        and transport.get_extra_info("sslcontext") is None
+    )
+
+
+def take_buffered(reader):
+    # StreamReader não expõe o buffer interno; os bytes que ele já leu do
+    # socket precisam ser repassados antes de tirarmos o transporte dele.
+    data = bytes(reader._buffer)
+    reader._buffer.clear()
+    return data
+
+
+# --- Motor buffered (BufferedProtocol) ---
+
+class _RelayProtocol(asyncio.BufferedProtocol):
+    """Lado de um par de relay: o que chega neste transporte é escrito no do par."""
+
+    MIN_BUFFER = 16 * 1024
+    MAX_BUFFER = 1024 * 1024
+
+    def __init__(self, transport, done, counter):
+        self.transport = transport
+        self.peer = None
+        self.done = done
+        self.counter = counter
+        self.eof = False
+        self.closed = False
+        self._holds = set()  # Motivos para a leitura estar pausada
+        self._max_buffer = SHAPED_CHUNK if counter and counter.shaper else self.MAX_BUFFER
+        self._buffer = bytearray(self.MIN_BUFFER)
+
+    def get_buffer(self, sizehint):
+        return self._buffer
+
+    def buffer_updated(self, nbytes):
+        size = len(self._buffer)
+        peer_transport = self.peer.transport
+        peer_transport.write(memoryview(self._buffer)[:nbytes])
+        if self.counter:
+            self.counter.bytes += nbytes
+            if self.counter.shaper and self.counter.shaper.charge(nbytes, self._shaper_resume):
+                self._hold("shaper")
+
+        if nbytes == size and size < self._max_buffer:
+            size *= 2  # Leituras cheias: vale ler mais por chamada
+        elif nbytes < size // 8 and size > self.MIN_BUFFER:
+            size //= 2
+        if peer_transport.get_write_buffer_size() or size != len(self._buffer):
+            # O transporte do par pode manter referência ao buffer enquanto não
+            # o envia por completo; nesse caso o buffer não pode ser reutilizado.
+            self._buffer = bytearray(size)
+
+    def _hold(self, reason):
+        if not self._holds:
+            self.transport.pause_reading()
+        self._holds.add(reason)
+
+    def _release(self, reason):
+        self._holds.discard(reason)
+        if not self._holds and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def _shaper_resume(self):
+        self._release("shaper")
+
+    def pause_writing(self):
+        # Nosso buffer de escrita encheu: parar de ler do outro lado.
+        self.peer._hold("flow")
+
+    def resume_writing(self):
+        self.peer._release("flow")
+
+    def eof_received(self):
+        self.eof = True
+        peer_transport = self.peer.transport
+        if self.peer.eof or not peer_transport.can_write_eof():
+            self.transport.close()
+            peer_transport.close()
+            return False
+        peer_transport.write_eof()
+        return True  # Mantém o outro sentido aberto (half-close)
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.peer.transport.close()
+        if self.peer.closed and not self.done.done():
+            self.done.set_result(None)
+
+
+# --- Motor compact (buffer de rascunho compartilhado) ---
+
+# Buffer em que todas as conexões do motor compact leem. Cada leitura é
+# entregue ao par na mesma chamada, então ele nunca é disputado; só é trocado
+# quando o transporte do par fica com uma referência a ele (envio parcial).
+_scratch = None
+
+HOLD_FLOW = 1
+HOLD_SHAPER = 2
+
+
+class _CompactProtocol(asyncio.BufferedProtocol):
+    """
+    Lado de um par no motor compact: mesmas regras do _RelayProtocol, com
+    __slots__, sem buffer próprio e com os motivos de pausa num inteiro.
+    """
+
+    __slots__ = ("transport", "peer", "done", "counter", "eof", "closed", "holds")
+
+    def __init__(self, transport, done, counter):
+        self.transport = transport
+        self.peer = None
+        self.done = done
+        self.counter = counter
+        self.eof = False
+        self.closed = False
+        self.holds = 0
+
+    def get_buffer(self, sizehint):
+        global _scratch
+        if _scratch is None:
+            _scratch = bytearray(COMPACT_CHUNK)  # Alocado na primeira leitura
+        if self.counter and self.counter.shaper:
+            return memoryview(_scratch)[:SHAPED_CHUNK]
+        return _scratch
+
+    def buffer_updated(self, nbytes):
+        global _scratch
+        peer_transport = self.peer.transport
+        peer_transport.write(memoryview(_scratch)[:nbytes])
+        if peer_transport.get_write_buffer_size():
+            _scratch = None
+        if self.counter:
+            self.counter.bytes += nbytes
+            if self.counter.shaper and self.counter.shaper.charge(nbytes, self._shaper_resume):
+                self._hold(HOLD_SHAPER)
+
+    def _hold(self, reason):
+        if not self.holds:
+            self.transport.pause_reading()
+        self.holds |= reason
+
+    def _release(self, reason):
+        self.holds &= ~reason
+        if not self.holds and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def _shaper_resume(self):
+        self._release(HOLD_SHAPER)
+
+    def pause_writing(self):
+        self.peer._hold(HOLD_FLOW)
+
+    def resume_writing(self):
+        self.peer._release(HOLD_FLOW)
+
+    eof_received = _RelayProtocol.eof_received
+    connection_lost = _RelayProtocol.connection_lost
+
+
+async def _relay_buffered(a_reader, a_writer, b_reader, b_writer, a_to_b=None, b_to_a=None, protocol=_RelayProtocol):
+    done = asyncio.get_running_loop().create_future()
+    side_a = protocol(a_writer.transport, done, a_to_b)
+    side_b = protocol(b_writer.transport, done, b_to_a)
+    side_a.peer, side_b.peer = side_b, side_a
+
+    for side, reader in ((side_a, a_reader), (side_b, b_reader)):
+        pending = take_buffered(reader)
+        if pending:
+            if side.counter:
+                side.counter.bytes += len(pending)
+            side.peer.transport.write(pending)
+    for side in (side_a, side_b):
+        side.transport.set_protocol(side)
+        side.transport.resume_reading()
+    for side, reader in ((side_a, a_reader), (side_b, b_reader)):
+        if reader.at_eof() and not side.eof:
+            side.eof_received()
+
+    try:
+        await done
+    finally:
+        side_a.transport.close()
+        side_b.transport.close()
+
+
+# --- Motor splice (Linux, zero-copy) ---
+
+async def _wait_fd(add, remove, fd):
+    future = asyncio.get_running_loop().create_future()
+    add(fd, lambda: future.done() or future.set_result(None))
+    try:
+        await future
+    finally:
+        remove(fd)
+
+
+async def _splice_pump(src, dst, dst_writer, counter):
+    loop = asyncio.get_running_loop()
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    shaper = counter.shaper if counter else None
+    chunk = SHAPED_CHUNK if shaper else SPLICE_CHUNK
+    pipe_r, pipe_w = os.pipe()
+    try:
+        # Pipe maior = menos chamadas de splice por MB (limitado por pipe-max-size).
+        fcntl.fcntl(pipe_w, fcntl.F_SETPIPE_SZ, SPLICE_CHUNK)
+    except (AttributeError, OSError):
+        pass
+    try:
+        while True:
+            try:
+                n = os.splice(src, pipe_w, chunk, flags=flags)
+            except BlockingIOError:
+                await _wait_fd(loop.add_reader, loop.remove_reader, src)
+                continue
+            if n == 0:
+                break
+            if counter:
+                counter.bytes += n
+            moved = n
+            while n:
+                try:
+                    n -= os.splice(pipe_r, dst, n, flags=flags)
+                except BlockingIOError:
+                    await _wait_fd(loop.add_writer, loop.remove_writer, dst)
+            if shaper:
+                await shaper.throttle(moved)
+        if dst_writer.can_write_eof():
+            dst_writer.write_eof()
+    except OSError:
+        pass
+    finally:
+        os.close(pipe_r)
+        os.close(pipe_w)
+
+
+async def _relay_splice(a_reader, a_writer, b_reader, b_writer, a_to_b=None, b_to_a=None):
+    # A partir daqui os transportes não leem mais; os sockets são operados
+    # por descritores duplicados, já que o loop não aceita add_reader no fd
+    # que pertence a um transporte.
+    a_writer.transport.pause_reading()
+    b_writer.transport.pause_reading()
+    a_fd = b_fd = None
+    try:
+        for reader, writer, counter in ((a_reader, b_writer, a_to_b), (b_reader, a_writer, b_to_a)):
+            pending = take_buffered(reader)
+            if pending:
+                if counter:
+                    counter.bytes += len(pending)
+                writer.write(pending)
+        await a_writer.drain()
+        await b_writer.drain()
+
+        a_fd = os.dup(a_writer.get_extra_info("socket").fileno())
+        b_fd = os.dup(b_writer.get_extra_info("socket").fileno())
+        pumps = []
+        for reader, src, dst, writer, counter in (
+            (a_reader, a_fd, b_fd, b_writer, a_to_b), (b_reader, b_fd, a_fd, a_writer, b_to_a)
+        ):
+            if reader.at_eof():
+                if writer.can_write_eof():
+                    writer.write_eof()
+            else:
+                pumps.append(_splice_pump(src, dst, writer, counter))
+        await asyncio.gather(*pumps)
+    except (ConnectionResetError, BrokenPipeError):
+        pass
+    finally:
+        for fd in (a_fd, b_fd):
+            if fd is not None:
+                os.close(fd)
+        a_writer.close()
+        b_writer.close()
@@ -1,11 +1,39 @@
+import argparse
 import asyncio
+import collections
+import gc
+import logging
 import os
+import secrets
+import signal
+import socket
+import struct
+import time
 import uuid
+from typing import Literal, Optional
 import uvicorn
-import httpx
 from dotenv import load_dotenv
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Response, status
 from fastapi.security import APIKeyHeader
+from pydantic import BaseModel
+
+from accesslog import AccessLog
+from cache import EdgeCache
+from callbacks import CallbackQueue
+from compression import CompressionStats, compressed_channel
+from datagram import DatagramSocket, FrameWriter, bind_udp, read_frames
+from httpproxy import UNTIL_CLOSE, HttpError, HttpHead, HttpReader, Upstream, copy_body, error_response
+from memory import MemoryGuard, process_rss
+from metrics import Histogram, MetricsWriter
+from mux import MuxSession, stream_header
+from persistence import StateStore
+from ports import PortAllocator
+from profiling import sample_stacks, slow_callbacks
+from registry import PendingConnection, Replica, Tunnel, TunnelRegistry
+from relay import RELAY_ENGINES, RelayMeter, abort_relay, relay, take_buffered
+from shaping import Flow, Limits
+from timerwheel import TimerWheel
+from workers import IpcChannel, attach_connection, detach_connection, spawn_successor, spawn_worker
 
 load_dotenv()
 
@@ -14,21 +42,167 @@ SERVER_IP = os.getenv("SERVER_IP", "0.0.0.0")
 FRP_PORT = int(os.getenv("FRP_PORT", 7000))
 API_PORT = int(os.getenv("API_PORT", 8000))
 HTTP_PORT = int(os.getenv("HTTP_PORT", 80))
+# Proxy HTTP: pipe (lê o primeiro cabeçalho e liga a conexão ao túnel) ou proxy
+# (HTTP/1.1 completo: cada requisição é roteada pelo Host e os canais com o
+# cliente são reaproveitados entre requisições).
+HTTP_MODE = os.getenv("HTTP_MODE", "pipe")
+if HTTP_MODE not in ("pipe", "proxy"):
+    raise SystemExit(f"HTTP_MODE inválido: {HTTP_MODE} (use pipe ou proxy)")
+# Limites do cabeçalho de uma requisição (bytes e quantidade de campos).
+HTTP_MAX_HEADER_SIZE = int(os.getenv("HTTP_MAX_HEADER_SIZE", 16384))
+HTTP_MAX_HEADERS = int(os.getenv("HTTP_MAX_HEADERS", 100))
+# Modo proxy: espera pela próxima requisição numa conexão keep-alive e canais
+# ociosos com o cliente mantidos por túnel (máximo e tempo de vida ocioso).
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 30))
+HTTP_UPSTREAM_IDLE_MAX = int(os.getenv("HTTP_UPSTREAM_IDLE_MAX", 16))
+HTTP_UPSTREAM_IDLE_TIMEOUT = float(os.getenv("HTTP_UPSTREAM_IDLE_TIMEOUT", 30))
+# Cache de borda do modo proxy, ativado por túnel (PUT /tunnels/{id}/cache):
+# orçamento em memória (0 desativa o cache), maior objeto guardado em memória
+# e, para os maiores, diretório e orçamento no disco (0 desativa o disco).
+CACHE_MEMORY_MAX = int(os.getenv("CACHE_MEMORY_MAX", 64 * 1024 * 1024))
+CACHE_OBJECT_MAX = int(os.getenv("CACHE_OBJECT_MAX", 1024 * 1024))
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+CACHE_DISK_MAX = int(os.getenv("CACHE_DISK_MAX", 1024 * 1024 * 1024))
 BASE_DOMAIN = os.getenv("BASE_DOMAIN", "tunnel.cz7host.local")
 API_SECRET_KEY = os.getenv("API_SECRET_KEY", "supersecretkey_for_discord_bot")
 BOT_CALLBACK_URL = os.getenv("BOT_CALLBACK_URL")
+# Fila de eventos para o bot: máximo de eventos em espera, eventos por lote,
+# repetições de um lote que falhou e espera (s) para juntar eventos em um lote.
+CALLBACK_QUEUE_MAX = int(os.getenv("CALLBACK_QUEUE_MAX", 10000))
+CALLBACK_BATCH_MAX = int(os.getenv("CALLBACK_BATCH_MAX", 100))
+CALLBACK_RETRIES = int(os.getenv("CALLBACK_RETRIES", 5))
+CALLBACK_BATCH_DELAY = float(os.getenv("CALLBACK_BATCH_DELAY", 0.5))
 PUBLIC_PORT_START = int(os.getenv("PUBLIC_PORT_START", 30000))
 PUBLIC_PORT_END = int(os.getenv("PUBLIC_PORT_END", 30100))
+# Uma porta pública liberada só volta a ser alocada após este prazo em segundos.
+PORT_QUARANTINE = float(os.getenv("PORT_QUARANTINE", 60))
+# Portas públicas: lazy (abre quando o cliente conecta e fecha após
+# PUBLIC_LISTENER_IDLE segundos sem cliente), eager (abre ao criar o túnel) ou
+# single (um único socket em PUBLIC_LISTENER_PORT recebe o intervalo inteiro,
+# redirecionado pelo nftables/TPROXY).
+PUBLIC_LISTENER_MODE = os.getenv("PUBLIC_LISTENER_MODE", "lazy")
+if PUBLIC_LISTENER_MODE not in ("lazy", "eager", "single"):
+    raise SystemExit(f"PUBLIC_LISTENER_MODE inválido: {PUBLIC_LISTENER_MODE} (use lazy, eager ou single)")
+PUBLIC_LISTENER_IDLE = float(os.getenv("PUBLIC_LISTENER_IDLE", 300))
+PUBLIC_LISTENER_PORT = int(os.getenv("PUBLIC_LISTENER_PORT", 0))
+if PUBLIC_LISTENER_MODE == "single" and not PUBLIC_LISTENER_PORT:
+    raise SystemExit("PUBLIC_LISTENER_MODE=single exige PUBLIC_LISTENER_PORT")
+# Aceita o modo multiplexado quando o cliente o solicita no handshake CONTROL.
+MUX_ENABLED = os.getenv("MUX_ENABLED", "1") == "1"
+# Máximo de canais de dados ociosos (pool pré-aquecido) mantidos por túnel. 0 desativa.
+POOL_MAX_PER_TUNNEL = int(os.getenv("POOL_MAX_PER_TUNNEL", 64))
+# Máximo de túneis que um cliente registra em uma única conexão de controle (multi=1).
+CONTROL_MAX_TUNNELS = int(os.getenv("CONTROL_MAX_TUNNELS", 64))
+# Conexões de controle (réplicas do cliente) aceitas por túnel; 1 recusa uma
+# segunda conexão como antes. Cada visitante vai para a réplica com menos
+# conexões ativas (least_conn) ou com a menor latência ponderada pela carga (latency).
+CONTROL_MAX_REPLICAS = int(os.getenv("CONTROL_MAX_REPLICAS", 8))
+LOAD_BALANCING = os.getenv("LOAD_BALANCING", "least_conn")
+if LOAD_BALANCING not in ("least_conn", "latency"):
+    raise SystemExit(f"LOAD_BALANCING inválido: {LOAD_BALANCING} (use least_conn ou latency)")
+# Motor de encaminhamento: stream (padrão), buffered, splice (Linux) ou auto.
+RELAY_ENGINE = os.getenv("RELAY_ENGINE", "stream")
+if RELAY_ENGINE not in RELAY_ENGINES:
+    raise SystemExit(f"RELAY_ENGINE inválido: {RELAY_ENGINE} (use {', '.join(RELAY_ENGINES)})")
+# Teto de memória residente por processo, em MB (0 desativa). Acima dele,
+# visitantes novos são recusados (HTTP recebe 503) até a memória baixar.
+# Para muitas conexões paradas, combine com RELAY_ENGINE=compact.
+MEMORY_LIMIT_MB = int(os.getenv("MEMORY_LIMIT_MB", 0))
+# Bytes que o visitante pode enviar antes de o canal com o cliente existir: ficam
+# no buffer da conexão pública (acima disso a leitura pausa) e seguem ao cliente
+# numa única escrita no pareamento.
+EARLY_DATA_MAX = int(os.getenv("EARLY_DATA_MAX", 64 * 1024))
+# Prazos em segundos (0 desativa).
+PENDING_TOKEN_TTL = float(os.getenv("PENDING_TOKEN_TTL", 15))
+HTTP_HEADER_TIMEOUT = float(os.getenv("HTTP_HEADER_TIMEOUT", 10))
+HANDSHAKE_TIMEOUT = float(os.getenv("HANDSHAKE_TIMEOUT", 10))
+RELAY_IDLE_TIMEOUT = float(os.getenv("RELAY_IDLE_TIMEOUT", 0))
+POOL_IDLE_TIMEOUT = float(os.getenv("POOL_IDLE_TIMEOUT", 60))
+# Túneis UDP: uma sessão (endereço de origem) sem datagramas por este prazo é encerrada.
+UDP_SESSION_IDLE = float(os.getenv("UDP_SESSION_IDLE", 60))
+# Heartbeat do canal de controle: PING a cada HEARTBEAT_INTERVAL segundos (0 desativa);
+# após HEARTBEAT_MISSES PINGs sem resposta o cliente é dado como desconectado.
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", 15))
+HEARTBEAT_MISSES = int(os.getenv("HEARTBEAT_MISSES", 3))
+# Aceita canais de dados comprimidos com zlib quando o cliente pede (COMPRESSION=1 no cliente).
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "1") == "1"
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", 6))
+# Diretório do estado persistente (snapshot + journal da tabela de túneis). Vazio (padrão) desativa.
+STATE_DIR = os.getenv("STATE_DIR", "")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", 300))
+SNAPSHOT_JOURNAL_MAX = int(os.getenv("SNAPSHOT_JOURNAL_MAX", 10000))
+# Túnel sem cliente conectado é removido após este prazo em segundos (0 = nunca).
+DISCONNECTED_TUNNEL_TTL = float(os.getenv("DISCONNECTED_TUNNEL_TTL", 86400))
+# Número de processos worker (também via --workers). 1 = processo único.
+WORKERS = int(os.getenv("WORKERS", 1))
+# Atualização sem interrupção (SIGUSR2 ou POST /admin/upgrade, só no processo
+# único): prazo para os clientes migrarem ao processo novo antes de ele assumir
+# as portas públicas e HTTP, e prazo para o antigo terminar os relays em andamento.
+UPGRADE_MIGRATE_TIMEOUT = float(os.getenv("UPGRADE_MIGRATE_TIMEOUT", 10))
+UPGRADE_DRAIN_TIMEOUT = float(os.getenv("UPGRADE_DRAIN_TIMEOUT", 60))
+# Registro de acesso: uma linha JSON por conexão encaminhada (túnel, host,
+# bytes, duração e motivo do fechamento), gravada em lotes por uma thread em
+# ACCESS_LOG (vazio desativa; com --workers cada worker grava em
+# ACCESS_LOG.<índice>), com rotação em ACCESS_LOG_MAX_MB e ACCESS_LOG_BACKUPS
+# cópias. Acima de ACCESS_LOG_RATE registros/s (0 = todos) eles são amostrados.
+ACCESS_LOG = os.getenv("ACCESS_LOG", "")
+ACCESS_LOG_MAX_MB = int(os.getenv("ACCESS_LOG_MAX_MB", 64))
+ACCESS_LOG_BACKUPS = int(os.getenv("ACCESS_LOG_BACKUPS", 5))
+ACCESS_LOG_RATE = int(os.getenv("ACCESS_LOG_RATE", 1000))
+# Janela máxima, em segundos, de um perfil do event loop (POST /admin/profile).
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 60))
+# Limites padrão de túneis novos e de cada usuário: banda em bytes/s e
+# conexões novas por segundo (0 = sem limite). Podem ser alterados pela API.
+TUNNEL_BANDWIDTH_LIMIT = int(os.getenv("TUNNEL_BANDWIDTH_LIMIT", 0))
+TUNNEL_CONNECTION_LIMIT = float(os.getenv("TUNNEL_CONNECTION_LIMIT", 0))
+USER_BANDWIDTH_LIMIT = int(os.getenv("USER_BANDWIDTH_LIMIT", 0))
+USER_CONNECTION_LIMIT = float(os.getenv("USER_CONNECTION_LIMIT", 0))
 
 # --- API (FastAPI) ---
 api = FastAPI(title="CZ7 Host FRP Management API")
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
 
 # --- Estado do Servidor ---
-tunnels = {}  # {tunnel_id: {config}}
-pending_connections = {}  # {token: {public_reader, public_writer, initial_data}}
-domain_map = {}  # {hostname: tunnel_id}
-available_ports = set(range(PUBLIC_PORT_START, PUBLIC_PORT_END + 1))
+registry = TunnelRegistry()
+access_log = AccessLog(ACCESS_LOG, ACCESS_LOG_MAX_MB * 1024 * 1024, ACCESS_LOG_BACKUPS, ACCESS_LOG_RATE)
+log = access_log.log  # No lugar de print(): o stdout é escrito pela thread do access_log
+timers = TimerWheel(log=log)
+profile_running = False  # Um perfil do event loop em andamento (POST /admin/profile)
+expired_counts = collections.Counter()  # {tipo de prazo: expirações}
+http_counts = collections.Counter()  # Modo proxy: requisições, canais reaproveitados/abertos e erros
+rejected_counts = collections.Counter()  # {motivo: visitantes recusados}
+udp_counts = collections.Counter()  # Túneis UDP: datagramas, sessões e descartes
+user_limits = {}  # {user_id: Limits} compartilhados por todos os túneis do usuário
+pairing_latency = Histogram("frp_pairing_latency_seconds", "Tempo entre o sinal NEW_CONNECTION e a chegada do canal DATA")
+http_header_time = Histogram("frp_http_header_seconds", "Tempo para ler e interpretar os cabeçalhos HTTP de um visitante")
+loop_lag = Histogram("frp_event_loop_lag_seconds", "Atraso do event loop ao acordar uma tarefa agendada")
+control_rtt = Histogram("frp_control_rtt_seconds", "Tempo de ida e volta do heartbeat na conexão de controle")
+HISTOGRAMS = (pairing_latency, http_header_time, loop_lag, control_rtt)
+LOOP_LAG_INTERVAL = 0.5
+ports = PortAllocator(PUBLIC_PORT_START, PUBLIC_PORT_END, PORT_QUARANTINE)
+binding_listeners = set()  # tunnel_ids com a porta pública sendo aberta neste processo
+cluster = None  # Coordinator ou WorkerNode no modo multi-processo
+edge_cache = None  # EdgeCache, nos processos que atendem HTTP no modo proxy
+store = None    # StateStore, no processo que mantém a tabela (único ou coordenador)
+servers = {}    # Processo único: {"frp" | "http" | "redirect": asyncio.Server}
+api_server = None  # uvicorn.Server, e o socket em que ele escuta
+api_socket = None
+upgrade = None  # Predecessor ou Successor durante uma atualização sem interrupção
+adopted_listeners = {}  # {tunnel_id: socket} portas públicas recebidas do processo antigo
+retiring = False  # Processo antigo de uma atualização: os túneis continuam no novo
+# Eventos para o bot; no modo multi-processo só o coordenador os envia.
+callbacks = CallbackQueue(
+    BOT_CALLBACK_URL, API_SECRET_KEY, CALLBACK_QUEUE_MAX, CALLBACK_BATCH_MAX, CALLBACK_RETRIES, CALLBACK_BATCH_DELAY,
+    log=log,
+) if BOT_CALLBACK_URL else None
+background_tasks = set()  # O loop só guarda referências fracas às tarefas
+memory_guard = MemoryGuard(MEMORY_LIMIT_MB * 1024 * 1024) if MEMORY_LIMIT_MB > 0 else None
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 # --- Segurança da API ---
 async def get_api_key(key: str = Depends(api_key_header)):
@@ -38,66 +212,466 @@ async def get_api_key(key: str = Depends(api_key_header)):
 
 # --- Lógica do Servidor TCP e HTTP ---
 
-async def notify_bot_of_connection(tunnel_id: str):
-    """Envia um callback para o bot informando que um túnel foi conectado."""
-    if not BOT_CALLBACK_URL:
-        return
+def notify_bot(tunnel, event):
+    """Enfileira um evento do túnel (connected, disconnected) para o callback do bot."""
+    if callbacks:
+        callbacks.put({"tunnel_id": tunnel.tunnel_id, "user_id": tunnel.user_id, "event": event})
+
+
+# --- Prazos (roda de timers) ---
+
+def schedule_deadline(timeout, writer, kind):
+    """Fecha 'writer' se o prazo vencer antes de o timer ser cancelado; None se desativado."""
+    if timeout <= 0:
+        return None
+    return timers.schedule(timeout, expire_connection, writer, kind)
+
+def expire_connection(writer, kind):
+    expired_counts[kind] += 1
+    writer.close()
+
+def expire_pooled_channel(writer, claimed):
+    # Só o servidor aposenta canais do pool: a verificação e a entrega a um
+    # visitante acontecem no mesmo loop, então um canal nunca é fechado já em uso.
+    if not claimed.done():
+        expired_counts["pool_idle"] += 1
+        claimed.cancel()
+        writer.close()
+
+class ControlHeartbeat:
+    """
+    PING periódico na conexão de controle: linha 'PING:<n>' (o cliente responde
+    'PONG:<n>') ou, no modo mux, frame PING. Após HEARTBEAT_MISSES PINGs sem
+    resposta a conexão é fechada e os túneis seguem o caminho da desconexão.
+    """
+
+    def __init__(self, writer, replicas, session=None):
+        self.writer = writer
+        self.replicas = replicas
+        self.session = session
+        self.seq = 0
+        self.sent_at = 0.0
+        self.missed = 0
+        if session:
+            session.on_pong = self.pong
+        self.timer = timers.schedule(HEARTBEAT_INTERVAL, self.tick)
+
+    def tick(self):
+        self.timer = None
+        if self.missed >= HEARTBEAT_MISSES:
+            expired_counts["heartbeat"] += 1
+            log(f"[{self.replicas[0].tunnel_id}] Cliente sem resposta ao heartbeat. Desconectando.")
+            (self.session or self.writer).close()
+            return
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        self.sent_at = time.monotonic()
+        self.missed += 1
+        try:
+            if self.session:
+                self.session.ping(self.seq)
+            else:
+                self.writer.write(f"PING:{self.seq}\n".encode())
+        except ConnectionResetError:
+            return
+        self.timer = timers.schedule(HEARTBEAT_INTERVAL, self.tick)
+
+    def pong(self, seq):
+        # Qualquer resposta prova que o cliente está vivo; só a do último PING mede o RTT.
+        self.missed = 0
+        if seq == self.seq:
+            rtt = time.monotonic() - self.sent_at
+            control_rtt.observe(rtt)
+            for replica in self.replicas:
+                replica.rtt = rtt
+                replica.observe_latency(rtt)
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+def schedule_tunnel_expiry(tunnel):
+    """Remove o túnel se o cliente não reconectar em DISCONNECTED_TUNNEL_TTL."""
+    if DISCONNECTED_TUNNEL_TTL > 0:
+        tunnel.expiry = timers.schedule(DISCONNECTED_TUNNEL_TTL, expire_tunnel, tunnel.tunnel_id)
+
+def cancel_tunnel_expiry(tunnel):
+    if tunnel.expiry:
+        tunnel.expiry.cancel()
+        tunnel.expiry = None
+
+def expire_tunnel(tunnel_id):
+    tunnel = registry.get(tunnel_id)
+    if tunnel is not None and not tunnel.connected:
+        expired_counts["tunnel_disconnected"] += 1
+        log(f"[{tunnel_id}] Cliente não reconectou a tempo. Removendo túnel.")
+        spawn(remove_tunnel(tunnel_id))
+
+def expire_restored_tunnels(tunnel_ids):
+    for tunnel_id in tunnel_ids:
+        tunnel = registry.get(tunnel_id)
+        # Túneis que reconectaram em algum momento têm (ou tiveram) o próprio prazo.
+        if tunnel is not None and tunnel.expiry is None:
+            expire_tunnel(tunnel_id)
 
-    if tunnel_id not in tunnels:
+def expire_pending(token):
+    pending = registry.pop_pending(token)
+    if pending:
+        expired_counts["pending_token"] += 1
+        log(f"[{pending.tunnel_id}] Token {token[:8]} expirou sem canal de dados.")
+        if pending.channel is None:
+            access(pending.tunnel_id, "timeout", pending.created, visitor=pending.public_writer)
+        abandon_pending(pending)
+
+def fail_pending(token):
+    """
+    O cliente avisou (FAIL) que não alcançou o serviço local: o visitante é
+    respondido já, sem esperar o prazo do token; visitantes HTTP recebem 502.
+    """
+    origin = token_worker(token)
+    if cluster and origin is not None and origin != cluster.index:
+        cluster.route(origin, {"op": "fail", "token": token})
+        return
+    pending = registry.pop_pending(token)
+    if pending is None:
         return
+    if pending.timer:
+        pending.timer.cancel()
+    rejected_counts["local_unreachable"] += 1
+    log(f"[{pending.tunnel_id}] Cliente não alcançou o serviço local (token: {token[:8]}).")
+    if pending.channel is None:
+        access(pending.tunnel_id, "local_unreachable", pending.created, visitor=pending.public_writer)
+        if looks_like_http(pending.initial_data or take_buffered(pending.public_reader)):
+            pending.public_writer.write(error_response(502, "Local Service Unavailable"))
+    abandon_pending(pending)
+
+def looks_like_http(data):
+    """Os primeiros bytes do visitante começam com uma linha de requisição HTTP/1.x."""
+    method, _, rest = data.partition(b"\r\n")[0].partition(b" ")
+    return method.isalpha() and method.isupper() and rest.rpartition(b" ")[2].startswith(b"HTTP/1.")
+
+def abandon_pending(pending):
+    """Desiste de um pareamento: fecha o visitante ou avisa o proxy HTTP que pediu o canal."""
+    if pending.channel is None:
+        release_pending(pending)
+        pending.public_writer.close()
+    elif not pending.channel.done():
+        pending.channel.set_exception(ConnectionError("o canal de dados não chegou"))
+
+# --- Limites de banda e de conexões ---
 
-    tunnel_data = tunnels[tunnel_id]
-    payload = {
-        "tunnel_id": tunnel_id,
-        "user_id": tunnel_data.get("user_id"),
-        "event": "connected"
+def limit_scale(tunnel=None):
+    """
+    Fração de um limite aplicada por este processo. No modo --workers cada
+    worker aplica 1/N dos limites de usuário e de túneis clássicos (cujos
+    visitantes se espalham pelos workers); túneis mux/pool passam todos pelo dono.
+    """
+    if not cluster or cluster.role != "worker":
+        return 1.0
+    if tunnel is not None and tunnel.handoff:
+        return 1.0
+    return 1.0 / cluster.count
+
+def _configured(limits, values, scale):
+    bandwidth = values.get("bandwidth")
+    connections = values.get("connections_per_second")
+    if limits is None:
+        if not (bandwidth or connections):
+            return None
+        limits = Limits()
+    limits.configure(bandwidth, connections, scale)
+    return limits
+
+def configure_limits(tunnel, tunnel_values, user_values):
+    """
+    Atualiza os limites do túnel e do usuário dele. Os valores são dicts com
+    'bandwidth' e 'connections_per_second'; None mantém, 0 remove o limite.
+    Conexões já em andamento passam a respeitar os novos valores na hora.
+    """
+    tunnel.limits = _configured(tunnel.limits, tunnel_values, limit_scale(tunnel))
+    limits = _configured(user_limits.get(tunnel.user_id), user_values, limit_scale())
+    if limits is not None:
+        user_limits[tunnel.user_id] = limits
+
+def limits_message(tunnel):
+    limits = user_limits.get(tunnel.user_id)
+    return {
+        "op": "limits", "tunnel_id": tunnel.tunnel_id,
+        "tunnel": tunnel.limits.to_dict() if tunnel.limits else {},
+        "user": limits.to_dict() if limits else {},
     }
 
-    try:
-        async with httpx.AsyncClient() as client:
-            headers = {"X-API-Key": API_SECRET_KEY}
-            response = await client.post(BOT_CALLBACK_URL, json=payload, headers=headers, timeout=5)
-            if response.status_code == 200:
-                print(f"[{tunnel_id}] Callback para o bot enviado com sucesso.")
-            else:
-                print(f"[{tunnel_id}] Erro ao enviar callback para o bot: {response.status_code} {response.text}")
-    except httpx.RequestError as e:
-        print(f"[{tunnel_id}] Falha ao conectar com o bot para callback: {e}")
+def memory_exhausted():
+    """O processo passou de MEMORY_LIMIT_MB: o visitante novo deve ser recusado."""
+    if memory_guard is None or not memory_guard.exceeded():
+        return False
+    rejected_counts["memory"] += 1
+    return True
 
+def admit_connection(tunnel, public_writer):
+    """Aplica o teto de memória e o limite de conexões novas por segundo do túnel e do usuário."""
+    if memory_exhausted():
+        access(tunnel.tunnel_id, "rejected_memory", visitor=public_writer)
+        public_writer.close()
+        return False
+    if not take_connection(tunnel):
+        access(tunnel.tunnel_id, "rejected_rate", visitor=public_writer)
+        public_writer.close()
+        return False
+    return True
+
+def take_connection(tunnel):
+    """
+    Desconta uma conexão dos baldes do túnel e do usuário, só se os dois
+    tiverem saldo: um visitante recusado não gasta o limite de nenhum deles.
+    """
+    buckets = [limits.connections for limits in (tunnel.limits, user_limits.get(tunnel.user_id)) if limits is not None]
+    if not all(bucket.available() for bucket in buckets):
+        rejected_counts["connection_rate"] += 1
+        return False
+    for bucket in buckets:
+        bucket.try_take()
+    return True
+
+def shaping_flows(tunnel):
+    """Um Flow por sentido, sujeito aos baldes de banda do túnel e do usuário (ou None)."""
+    buckets = [
+        limits.bandwidth for limits in (tunnel.limits, user_limits.get(tunnel.user_id))
+        if limits is not None
+    ]
+    if not buckets:
+        return None
+    return Flow(buckets), Flow(buckets)
+
+async def relay_connection(tunnel, a_reader, a_writer, b_reader, b_writer, early=0):
+    """
+    relay() contabilizado no túnel (A = visitante, B = cliente), com os
+    limites de banda do túnel/usuário e o timeout de inatividade aplicado
+    pela roda de timers. 'early' são os bytes do visitante já enviados ao
+    cliente no pareamento. Ao terminar, gera o registro de acesso da conexão.
+    """
+    meter = RelayMeter()
+    meter.a_to_b.bytes = early
+    flows = shaping_flows(tunnel)
+    if flows:
+        meter.a_to_b.shaper, meter.b_to_a.shaper = flows
+    tunnel.open_meter(meter)
+    timer = None
+    started, reason = time.monotonic(), "closed"
 
-async def forward_data(reader, writer, name):
+    if RELAY_IDLE_TIMEOUT > 0:
+        # Os contadores de bytes já são atualizados por bloco; o relay está
+        # ocioso se eles não mudaram em duas verificações seguidas (a cada
+        # meio prazo), sem precisar de um relógio no caminho dos dados.
+        last_total, quiet = meter.total, 0
+
+        def check_idle():
+            nonlocal timer, last_total, quiet, reason
+            total = meter.total
+            quiet = quiet + 1 if total == last_total else 0
+            last_total = total
+            if quiet >= 2:
+                expired_counts["relay_idle"] += 1
+                reason = "idle"
+                abort_relay(a_writer, b_writer)
+            else:
+                timer = timers.schedule(RELAY_IDLE_TIMEOUT / 2, check_idle)
+
+        timer = timers.schedule(RELAY_IDLE_TIMEOUT / 2, check_idle)
     try:
-        while not reader.at_eof():
-            data = await reader.read(4096)
-            if not data: break
-            writer.write(data)
-            await writer.drain()
-    except (ConnectionResetError, asyncio.IncompleteReadError, BrokenPipeError):
-        pass
+        await relay(a_reader, a_writer, b_reader, b_writer, RELAY_ENGINE, meter)
+    except asyncio.CancelledError:
+        reason = "cancelled"
+        raise
+    except Exception:
+        reason = "error"
+        raise
     finally:
+        if timer:
+            timer.cancel()
+        tunnel.close_meter(meter)
+        access(tunnel.tunnel_id, reason, started, meter, visitor=a_writer)
+
+def access(tunnel_id, reason, started=None, meter=None, visitor=None, **fields):
+    """
+    Registro de acesso (ACCESS_LOG) de uma conexão ou requisição de visitante.
+    'visitor' é o writer da conexão pública: dá o IP de origem e, se ela
+    chegou por HTTP_PORT, o host do túnel.
+    """
+    if not access_log.enabled:
+        return
+    tunnel = registry.get(tunnel_id) if tunnel_id else None
+    record = {"tunnel": tunnel_id, "user": tunnel.user_id if tunnel else None}
+    if visitor is not None:
+        peer = visitor.get_extra_info("peername")
+        if peer:
+            record["peer"] = peer[0]
+        sockname = visitor.get_extra_info("sockname")
+        if tunnel and tunnel.domain and sockname and sockname[1] == HTTP_PORT:
+            record["host"] = tunnel.domain
+    record.update(fields)
+    if meter is not None:
+        record["bytes_in"] = meter.a_to_b.bytes
+        record["bytes_out"] = meter.b_to_a.bytes
+    if started is not None:
+        record["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+    record["reason"] = reason
+    access_log.record(record)
+
+async def relay_mux_stream(tunnel, replica, public_reader, public_writer, initial_data=None):
+    """Abre um stream na sessão mux da réplica e encaminha a conexão pública por ele."""
+    initial_data = early_data(public_reader, initial_data)
+    try:
+        stream = replica.mux_session.open_stream()
+        if replica.multi:
+            # A sessão serve vários túneis: o stream começa com o túnel de destino.
+            stream.write(stream_header(tunnel.tunnel_id))
+        if initial_data:
+            stream.write(initial_data)
+            await stream.drain()
+    except ConnectionResetError:
+        log(f"[{tunnel.tunnel_id}] Sessão mux encerrada, descartando conexão.")
+        access(tunnel.tunnel_id, "mux_closed", visitor=public_writer)
+        public_writer.close()
+        return
+
+    await relay_connection(tunnel, public_reader, public_writer, stream, stream, len(initial_data))
+
+async def relay_data_channel(tunnel, client_reader, client_writer, public_reader, public_writer, initial_data=None):
+    """Encaminha uma conexão pública por um canal de dados já estabelecido com o cliente."""
+    initial_data = early_data(public_reader, initial_data)
+    if initial_data:
+        client_writer.write(initial_data)
+        await client_writer.drain()
+
+    await relay_connection(tunnel, public_reader, public_writer, client_reader, client_writer, len(initial_data))
+
+def early_data(public_reader, initial_data):
+    """O que o visitante mandou antes do pareamento (cabeçalhos HTTP lidos e bytes no buffer), para uma só escrita."""
+    return (initial_data or b"") + take_buffered(public_reader)
+
+def take_pooled_channel(replica):
+    """Retira do pool da réplica um canal ocioso ainda aberto, ou None."""
+    pool = replica.pool
+    while pool:
+        reader, writer, claimed = pool.popleft()
+        if not reader.at_eof() and not writer.is_closing() and not claimed.done():
+            return claimed
+    return None
+
+def close_pool(replica):
+    """Fecha todos os canais ociosos do pool de uma réplica."""
+    pool = replica.pool
+    while pool:
+        _, writer, claimed = pool.popleft()
+        claimed.cancel()
         writer.close()
 
+def new_token():
+    """
+    Token de pareamento (96 bits aleatórios, 16 caracteres); no modo
+    multi-processo leva o índice do worker que o emitiu.
+    """
+    token = secrets.token_urlsafe(12)
+    return f"{cluster.index}.{token}" if cluster else token
+
+def token_worker(token):
+    index, sep, _ = token.partition(".")
+    return int(index) if sep and index.isdigit() else None
+
+def add_pending_connection(tunnel_id, public_reader, public_writer, initial_data, replica=None):
+    token = new_token()
+    pending = PendingConnection(tunnel_id, public_reader, public_writer, initial_data, replica=replica)
+    if replica is not None:
+        replica.active += 1
+    if PENDING_TOKEN_TTL > 0:
+        pending.timer = timers.schedule(PENDING_TOKEN_TTL, expire_pending, token)
+    registry.add_pending(token, pending)
+    return token
+
+def release_pending(pending):
+    """Visitante sinalizado deixou de contar como conexão ativa da réplica."""
+    if pending.replica is not None and pending.channel is None:
+        pending.replica.active -= 1
+        pending.replica = None
+
+def choose_replica(tunnel, signalable=False):
+    return tunnel.pick_replica(LOAD_BALANCING == "latency", signalable)
+
+def redispatch_pending(tunnel, replica):
+    """Sinaliza de novo, para outra réplica, os tokens que a réplica que caiu não atendeu."""
+    for token, pending in registry.pending_for(replica):
+        target = choose_replica(tunnel, signalable=True)
+        if target is None:
+            return  # Só restam réplicas mux: os tokens expiram
+        release_pending(pending)
+        pending.replica = target
+        if pending.channel is None:
+            target.active += 1
+        try:
+            target.control_writer.write(new_connection_signal(target, token))
+        except ConnectionResetError:
+            pass
+
 async def signal_new_connection(tunnel_id, public_reader, public_writer, initial_data=None):
-    if tunnel_id not in tunnels or not tunnels[tunnel_id].get('connected'):
-        print(f"[{tunnel_id}] Sinal ignorado: túnel não conectado.")
+    tunnel = registry.get(tunnel_id)
+    if cluster and tunnel is not None and tunnel.worker not in (None, cluster.index):
+        # Visitantes entregues ao dono passam pela admissão lá.
+        if tunnel.handoff or admit_connection(tunnel, public_writer):
+            cluster.route_visitor(tunnel, public_reader, public_writer, initial_data)
+        return
+
+    if tunnel is None or not tunnel.connected:
+        log(f"[{tunnel_id}] Sinal ignorado: túnel não conectado.")
+        access(tunnel_id, "offline", visitor=public_writer)
         public_writer.close()
         return
 
+    if not admit_connection(tunnel, public_writer):
+        return
+
+    replica = choose_replica(tunnel)
+    if replica.mux_session:
+        replica.active += 1
+        try:
+            await relay_mux_stream(tunnel, replica, public_reader, public_writer, initial_data)
+        finally:
+            replica.active -= 1
+        return
+
+    if replica.pool is not None:
+        claimed = take_pooled_channel(replica)
+        if claimed:
+            tunnel.pool_hits += 1
+            claimed.set_result((public_reader, public_writer, initial_data))
+            return
+        tunnel.pool_misses += 1
+
     try:
-        token = str(uuid.uuid4())
-        pending_connections[token] = {"public_reader": public_reader, "public_writer": public_writer, "initial_data": initial_data}
+        token = add_pending_connection(tunnel_id, public_reader, public_writer, initial_data, replica)
 
-        control_writer = tunnels[tunnel_id]['control_writer']
-        control_writer.write(f"NEW_CONNECTION:{token}\n".encode())
+        control_writer = replica.control_writer
+        control_writer.write(new_connection_signal(replica, token))
         await control_writer.drain()
-        print(f"[{tunnel_id}] Cliente sinalizado para nova conexão (token: {token[:8]})")
+        log(f"[{tunnel_id}] Cliente sinalizado para nova conexão (token: {token[:8]})")
     except Exception as e:
-        print(f"[{tunnel_id}] Erro ao sinalizar cliente: {e}")
+        log(f"[{tunnel_id}] Erro ao sinalizar cliente: {e}")
+        access(tunnel_id, "error", visitor=public_writer)
         public_writer.close()
 
 async def handle_http_connection(public_reader, public_writer):
+    started = time.monotonic()
+    if memory_exhausted():
+        public_writer.write(error_response(503, "Server Busy"))
+        public_writer.close()
+        return
+    header_timer = schedule_deadline(HTTP_HEADER_TIMEOUT, public_writer, "http_header")
     try:
-        http_request_bytes = await public_reader.readuntil(b'\r\n\r\n')
+        try:
+            http_request_bytes = await public_reader.readuntil(b'\r\n\r\n')
+        finally:
+            if header_timer:
+                header_timer.cancel()
         http_request = http_request_bytes.decode('utf-8', errors='ignore')
 
         host_header = next((line for line in http_request.split('\r\n') if line.lower().startswith('host:')), None)
@@ -107,175 +681,2184 @@ async def handle_http_connection(public_reader, public_writer):
             return
 
         host = host_header.split(':', 1)[1].strip().lower()
+        http_header_time.observe(time.monotonic() - started)
 
-        if host not in domain_map:
-            error_response = b"HTTP/1.1 404 Not Found\r\nContent-Length: 26\r\n\r\nCZ7 Host: Tunnel Not Found"
-            public_writer.write(error_response)
+        tunnel = registry.by_domain(host)
+        if tunnel is None:
+            access(None, "not_found", started, visitor=public_writer, host=host, status=404)
+            not_found = b"HTTP/1.1 404 Not Found\r\nContent-Length: 26\r\n\r\nCZ7 Host: Tunnel Not Found"
+            public_writer.write(not_found)
             await public_writer.drain()
             public_writer.close()
             return
 
-        tunnel_id = domain_map[host]
-        await signal_new_connection(tunnel_id, public_reader, public_writer, initial_data=http_request_bytes)
+        await signal_new_connection(tunnel.tunnel_id, public_reader, public_writer, initial_data=http_request_bytes)
 
     except (asyncio.IncompleteReadError, ConnectionResetError):
         pass # Conexão fechada pelo cliente antes de enviar dados completos
     except Exception as e:
-        print(f"[HTTP] Erro: {e}")
+        log(f"[HTTP] Erro: {e}")
         public_writer.close()
 
-async def handle_frp_client(client_reader, client_writer):
+# --- Proxy HTTP/1.1 (HTTP_MODE=proxy) ---
+
+async def handle_http_proxy(public_reader, public_writer):
+    """Atende as requisições de uma conexão, uma por vez, roteando cada uma pelo Host."""
+    reader = HttpReader(public_reader)
+    peer = public_writer.get_extra_info('peername')
+    admitted = set()  # Túneis que já passaram pelo limite de conexões nesta conexão
+    first, handed_off = True, False
+    try:
+        if memory_exhausted():
+            raise HttpError(503, "Server Busy")
+        while True:
+            started = time.monotonic()
+            if first:
+                timer = schedule_deadline(HTTP_HEADER_TIMEOUT, public_writer, "http_header")
+            else:
+                timer = schedule_deadline(HTTP_KEEPALIVE_TIMEOUT, public_writer, "http_keepalive")
+            try:
+                raw = await reader.read_head(HTTP_MAX_HEADER_SIZE)
+            finally:
+                if timer:
+                    timer.cancel()
+            if raw is None:
+                break
+            request = HttpHead.parse(raw, HTTP_MAX_HEADERS)
+            http_header_time.observe(time.monotonic() - started)
+
+            host = (request.get("host") or "").partition(":")[0].lower()
+            tunnel = registry.by_domain(host)
+            if tunnel is None:
+                access(None, "not_found", started, visitor=public_writer, host=host, status=404)
+                raise HttpError(404, "Tunnel Not Found")
+            if cluster and tunnel.worker not in (None, cluster.index) and tunnel.handoff:
+                # Streams mux e canais pré-aquecidos ficam no worker dono: a conexão segue para lá.
+                fd, buffered = detach_connection(public_reader, public_writer)
+                cluster.route(tunnel.worker, {"op": "conn", "kind": "http"}, raw + bytes(reader.buffer) + buffered, [fd])
+                handed_off = True
+                return
+            http_counts["requests"] += 1
+            if tunnel.tunnel_id not in admitted:
+                if not admit_connection(tunnel, public_writer):
+                    return
+                admitted.add(tunnel.tunnel_id)
+            if not await proxy_request(tunnel, request, reader, public_reader, public_writer, peer):
+                break
+            first = False
+    except HttpError as e:
+        http_counts[f"status_{e.status}"] += 1
+        public_writer.write(error_response(e.status, str(e)))
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        if not handed_off:
+            public_writer.close()
+
+async def proxy_request(tunnel, request, reader, public_reader, public_writer, peer):
+    """
+    Encaminha uma requisição ao serviço local do túnel e a resposta ao
+    visitante. Retorna True se a conexão do visitante segue aberta.
+    """
+    started = time.monotonic()
+    fields = {"method": request.first[0], "path": request.first[1][:256]}
+    length = request.body_length()
+    entry = capture = None
+    cached = edge_cache is not None and tunnel.cache
+    if cached:
+        if length or not edge_cache.cacheable_request(request):
+            edge_cache.count(tunnel.tunnel_id, "bypass")
+            cached = False
+        else:
+            entry = edge_cache.lookup(tunnel.tunnel_id, request)
+            if entry and entry.fresh() and not edge_cache.wants_revalidation(request):
+                # Servida sem passar pelo cliente, mesmo com ele offline.
+                edge_cache.count(tunnel.tunnel_id, "hit")
+                keep = await send_cached(entry, request, public_writer, "hit")
+                access(tunnel.tunnel_id, "closed", started, visitor=public_writer, **fields, status=entry.status, cache="hit")
+                return keep
+            if entry and not entry.validators():
+                entry = None  # Vencida e sem validador: só resta buscar de novo
+    if not has_client(tunnel):
+        access(tunnel.tunnel_id, "offline", started, visitor=public_writer, **fields, status=502)
+        raise HttpError(502, "Tunnel Offline")
+    forwarded_for = ", ".join(request.get_all("x-forwarded-for") + [peer[0] if peer else "unknown"])
+    dropped = {"x-forwarded-for"}
+    extra = [("X-Forwarded-For", forwarded_for), ("X-Forwarded-Proto", "http")]
+    if entry:
+        # Revalida a entrada vencida; as condições do visitante são avaliadas contra ela depois.
+        dropped |= {"if-none-match", "if-modified-since"}
+        extra += entry.validators()
+    headers = [(name, value) for name, value in request.headers if name.lower() not in dropped]
+    head = HttpHead(request.first, headers).serialize(extra=extra)
+
+    meter = RelayMeter()
+    flows = shaping_flows(tunnel)
+    if flows:
+        meter.a_to_b.shaper, meter.b_to_a.shaper = flows
+    tunnel.open_meter(meter)
+    upstream = upload = serving = None
+    status, reason = None, "closed"
+    try:
+        for attempt in range(2):
+            try:
+                upstream, reused = await open_upstream(tunnel)
+            except ConnectionError:
+                raise HttpError(502, "Tunnel Unavailable")
+            serving = upstream.replica  # Conta como conexão ativa da réplica até a resposta terminar
+            if serving:
+                serving.active += 1
+            try:
+                upstream.writer.write(head)
+                meter.a_to_b.bytes += len(head)
+                if length:
+                    # O corpo segue em paralelo: o serviço pode responder antes (100-continue, erros).
+                    upload = asyncio.ensure_future(copy_body(reader, upstream.writer, length, meter.a_to_b))
+                else:
+                    await upstream.writer.drain()
+                response = await read_response(upstream, public_writer)
+                status = response.status
+                break
+            except (ConnectionError, HttpError, asyncio.IncompleteReadError):
+                upstream.close()
+                if serving:
+                    serving.active -= 1
+                    serving = None
+                if reused and not length and attempt == 0:
+                    continue  # O serviço local fechou o canal enquanto estava ocioso
+                raise HttpError(502, "Bad Gateway")
+
+        if response.status == 101:
+            # Upgrade (WebSocket): daqui em diante a conexão é um relay de bytes.
+            public_writer.write(response.serialize())
+            upstream.writer.write(bytes(reader.buffer))
+            public_writer.write(bytes(upstream.reader.buffer))
+            await relay(public_reader, public_writer, upstream.reader.source, upstream.writer, RELAY_ENGINE, meter)
+            return False
+
+        body = response.body_length(request.first[0])
+        if entry and response.status == 304:
+            edge_cache.refresh(entry, response)
+            edge_cache.count(tunnel.tunnel_id, "revalidated")
+            keep = await send_cached(entry, request, public_writer, "revalidated")
+        else:
+            keep = request.keep_alive() and body != UNTIL_CLOSE
+            extra = [] if keep else [("Connection", "close")]
+            if cached:
+                edge_cache.count(tunnel.tunnel_id, "miss")
+                capture = edge_cache.capture(tunnel.tunnel_id, request, response)
+                extra.append(("X-Cache", "MISS"))
+            response_head = response.serialize(extra=extra)
+            public_writer.write(response_head)
+            meter.b_to_a.bytes += len(response_head)
+            try:
+                await copy_body(upstream.reader, public_writer, body, meter.b_to_a, capture.write if capture else None)
+            except HttpError as e:
+                raise ConnectionError(f"resposta incompleta do serviço local: {e}")
+            if capture:
+                capture.commit()
+                capture = None
+        reusable = response.keep_alive() and body != UNTIL_CLOSE
+        if upload and (not upload.done() or upload.cancelled() or upload.exception()):
+            # A resposta veio sem o corpo da requisição ter sido todo enviado.
+            keep = reusable = False
+        if reusable:
+            release_upstream(tunnel, upstream)
+            upstream = None
+        return keep
+    except HttpError as e:
+        status, reason = e.status, "error"
+        raise
+    except asyncio.CancelledError:
+        reason = "cancelled"
+        raise
+    except Exception:
+        reason = "error"
+        raise
+    finally:
+        if upload and not upload.done():
+            upload.cancel()
+        if capture:
+            capture.abort()
+        if upstream:
+            upstream.close()
+        if serving:
+            serving.active -= 1
+        tunnel.close_meter(meter)
+        if cached:
+            fields["cache"] = "revalidated" if entry and status == 304 else "miss"
+        access(tunnel.tunnel_id, reason, started, meter, visitor=public_writer, **fields, status=status)
+
+async def send_cached(entry, request, public_writer, result):
+    """Responde com uma entrada do cache (304 se o visitante já a tem). True se a conexão segue aberta."""
+    keep = request.keep_alive()
+    public_writer.write(entry.head(request, result, keep))
+    if request.first[0] == "HEAD" or entry.not_modified(request):
+        await public_writer.drain()
+    else:
+        await edge_cache.send_body(entry, public_writer)
+    return keep
+
+async def read_response(upstream, public_writer):
+    """Cabeçalho da resposta final; respostas 1xx (100 Continue) seguem direto ao visitante."""
+    while True:
+        raw = await upstream.reader.read_head(HTTP_MAX_HEADER_SIZE)
+        if raw is None:
+            raise ConnectionError("canal fechado antes da resposta")
+        response = HttpHead.parse(raw, HTTP_MAX_HEADERS)
+        if response.status < 100:
+            raise HttpError(502, "Bad Status")
+        if response.status >= 200 or response.status == 101:
+            return response
+        public_writer.write(raw)
+
+async def open_upstream(tunnel):
+    """
+    Canal com o serviço local para uma requisição: um ocioso do túnel, um
+    stream mux ou um canal de dados novo (do pool ou pedido com NEW_CONNECTION).
+    Retorna (Upstream, reaproveitado).
+    """
+    idle = tunnel.http_idle
+    while idle:
+        upstream = idle.pop()  # O mais recente tem menos chance de ter sido fechado pelo serviço local
+        if upstream.timer:
+            upstream.timer.cancel()
+            upstream.timer = None
+        if not upstream.closed():
+            http_counts["upstream_reused"] += 1
+            return upstream, True
+        upstream.close()
+    http_counts["upstream_opened"] += 1
+
+    remote = cluster and tunnel.worker not in (None, cluster.index)
+    replica = None if remote else choose_replica(tunnel)
+    if replica is None and not remote:
+        raise ConnectionError("túnel sem cliente conectado")
+    reader, writer = await open_client_channel(tunnel, replica)
+    return Upstream(reader, writer, replica), False
+
+async def open_client_channel(tunnel, replica):
+    """
+    Canal com o serviço local pedido pelo próprio servidor (proxy HTTP, túneis
+    UDP): um stream mux, um canal do pool ou um canal DATA pedido com
+    NEW_CONNECTION. Sem réplica, o túnel está em outro worker, que escolhe uma.
+    """
+    if replica and replica.mux_session:
+        stream = replica.mux_session.open_stream()
+        if replica.multi:
+            stream.write(stream_header(tunnel.tunnel_id))
+        return stream, stream
+
+    channel = asyncio.get_running_loop().create_future()
+    claimed = take_pooled_channel(replica) if replica and replica.pool is not None else None
+    if claimed:
+        tunnel.pool_hits += 1
+        claimed.set_result(channel)
+    else:
+        if replica and replica.pool is not None:
+            tunnel.pool_misses += 1
+        token = new_token()
+        pending = PendingConnection(tunnel.tunnel_id, None, None, channel=channel, replica=replica)
+        if PENDING_TOKEN_TTL > 0:
+            pending.timer = timers.schedule(PENDING_TOKEN_TTL, expire_pending, token)
+        registry.add_pending(token, pending)
+        if replica is None:
+            # O worker dono escolhe a réplica que recebe o NEW_CONNECTION.
+            cluster.route(tunnel.worker, {"op": "signal", "tunnel_id": tunnel.tunnel_id, "token": token})
+        else:
+            replica.control_writer.write(new_connection_signal(replica, token))
+    return await channel
+
+async def deliver_channel(channel, client_reader, client_writer):
+    """
+    Entrega um canal de dados recém-pareado ao proxy HTTP que o pediu e
+    espera o proxy terminar de usá-lo (handle_frp_client fecha o canal ao retornar).
+    """
+    if channel.done():
+        return  # O proxy desistiu (visitante caiu)
+    channel.set_result((client_reader, client_writer))
+    try:
+        await client_writer.wait_closed()
+    except OSError:
+        pass
+
+def release_upstream(tunnel, upstream):
+    """Guarda o canal, após uma resposta completa, para a próxima requisição ao túnel."""
+    if registry.get(tunnel.tunnel_id) is not tunnel or upstream.closed():
+        upstream.close()
+        return
+    if tunnel.http_idle is None:
+        tunnel.http_idle = []
+    if len(tunnel.http_idle) >= HTTP_UPSTREAM_IDLE_MAX:
+        upstream.close()
+        return
+    tunnel.http_idle.append(upstream)
+    if HTTP_UPSTREAM_IDLE_TIMEOUT > 0:
+        upstream.timer = timers.schedule(HTTP_UPSTREAM_IDLE_TIMEOUT, expire_upstream, tunnel, upstream)
+
+def expire_upstream(tunnel, upstream):
+    upstream.timer = None
+    if tunnel.http_idle and upstream in tunnel.http_idle:
+        expired_counts["http_upstream_idle"] += 1
+        tunnel.http_idle.remove(upstream)
+        upstream.close()
+
+def close_http_idle(tunnel):
+    while tunnel.http_idle:
+        tunnel.http_idle.pop().close()
+
+def compress_channel(tunnel, client_reader, client_writer):
+    """Envolve um canal de dados negociado com zlib=1, contabilizando no túnel."""
+    if tunnel.compression is None:
+        tunnel.compression = CompressionStats()
+    return compressed_channel(client_reader, client_writer, COMPRESSION_LEVEL, tunnel.compression)
+
+async def handle_data_channel(token, client_reader, client_writer, compressed=False):
+    """Pareia um canal DATA do cliente com a conexão pública pendente do token."""
+    origin = token_worker(token)
+    if cluster and origin is not None and origin != cluster.index:
+        # O visitante espera em outro worker: a conexão vai até ele.
+        fd, buffered = detach_connection(client_reader, client_writer)
+        msg = {"op": "conn", "kind": "data", "token": token, "zlib": compressed}
+        cluster.route(origin, msg, buffered, [fd])
+        return
+
+    pending = registry.pop_pending(token)
+    if pending is None and upgrade and upgrade.role == "successor":
+        # Durante uma atualização, o visitante pode estar esperando no processo antigo.
+        upgrade.forward_data(token, client_reader, client_writer, compressed)
+        return
+    tunnel = registry.get(pending.tunnel_id) if pending else None
+    if tunnel:
+        pairing = time.monotonic() - pending.created
+        pairing_latency.observe(pairing)
+        if pending.replica is not None:
+            pending.replica.observe_latency(pairing)
+        if pending.timer:
+            pending.timer.cancel()
+        if compressed:
+            client_reader, client_writer = compress_channel(tunnel, client_reader, client_writer)
+        if pending.channel:
+            await deliver_channel(pending.channel, client_reader, client_writer)
+            return
+        try:
+            await relay_data_channel(
+                tunnel, client_reader, client_writer,
+                pending.public_reader, pending.public_writer, pending.initial_data
+            )
+        finally:
+            release_pending(pending)
+    else:
+        if pending:
+            abandon_pending(pending)  # Túnel removido enquanto o token aguardava
+        client_writer.close()
+
+def pool_replica(tunnel, replica_id):
+    """Réplica dona de um canal POOL; clientes antigos não informam a réplica e usam a primeira com pool."""
+    if replica_id is not None:
+        replica = tunnel.replica(replica_id)
+        return replica if replica and replica.pool is not None else None
+    return next((replica for replica in tunnel.replicas if replica.pool is not None), None)
+
+async def handle_pooled_channel(tunnel_id, client_reader, client_writer, compressed=False, replica_id=None):
+    """Canal de dados pré-aquecido: fica ocioso até ser entregue a um visitante."""
+    tunnel = registry.get(tunnel_id)
+    if cluster and tunnel is not None and tunnel.worker not in (None, cluster.index):
+        fd, buffered = detach_connection(client_reader, client_writer)
+        msg = {"op": "conn", "kind": "pool", "tunnel_id": tunnel_id, "zlib": compressed, "replica": replica_id}
+        cluster.route(tunnel.worker, msg, buffered, [fd])
+        return
+    replica = pool_replica(tunnel, replica_id) if tunnel else None
+    if replica is None or len(replica.pool) >= POOL_MAX_PER_TUNNEL:
+        client_writer.close()
+        return
+
+    claimed = asyncio.get_running_loop().create_future()
+    replica.pool.append((client_reader, client_writer, claimed))
+    # Um canal ocioso não recebe nada do cliente; EOF aqui significa que ele caiu.
+    idle_eof = asyncio.ensure_future(client_reader.read(1))
+    idle_timer = None
+    if POOL_IDLE_TIMEOUT > 0:
+        idle_timer = timers.schedule(POOL_IDLE_TIMEOUT, expire_pooled_channel, client_writer, claimed)
+    await asyncio.wait({claimed, idle_eof}, return_when=asyncio.FIRST_COMPLETED)
+    if idle_timer:
+        idle_timer.cancel()
+    if not claimed.done() or claimed.cancelled():
+        claimed.cancel()
+        idle_eof.cancel()
+        client_writer.close()
+        return
+    idle_eof.cancel()
+
+    target = claimed.result()
+    client_writer.write(b"START\n")
+    if compressed:
+        client_reader, client_writer = compress_channel(tunnel, client_reader, client_writer)
+    if isinstance(target, asyncio.Future):
+        await deliver_channel(target, client_reader, client_writer)  # Pedido pelo proxy HTTP
+        return
+    public_reader, public_writer, initial_data = target
+    replica.active += 1
+    try:
+        await relay_data_channel(tunnel, client_reader, client_writer, public_reader, public_writer, initial_data)
+    finally:
+        replica.active -= 1
+
+def parse_handshake(message):
+    """
+    Interpreta '<TIPO>:<argumento> [opção=valor ...]' (CONTROL, DATA ou POOL).
+    Clientes antigos enviam apenas o argumento, sem opções.
+    """
+    tunnel_id, *raw_options = message.split(":", 1)[1].split()
+    options = dict(opt.split("=", 1) for opt in raw_options if "=" in opt)
+    return tunnel_id, options
+
+async def handle_frp_client(client_reader, client_writer, routed=False):
+    """
+    Conexão de um cliente, identificada pela primeira linha. routed: conexão
+    de controle encaminhada por outro worker ao dono do túnel (não volta a ser encaminhada).
+    """
     client_addr = client_writer.get_extra_info('peername')
+    handshake_timer = schedule_deadline(HANDSHAKE_TIMEOUT, client_writer, "handshake")
     try:
-        first_line = await client_reader.readline()
+        try:
+            first_line = await client_reader.readline()
+        finally:
+            if handshake_timer:
+                handshake_timer.cancel()
         message = first_line.decode().strip()
 
         if message.startswith("DATA:"):
-            token = message.split(":", 1)[1]
-            if token in pending_connections:
-                pending = pending_connections.pop(token)
-                public_reader = pending["public_reader"]
-                public_writer = pending["public_writer"]
-
-                if pending["initial_data"]:
-                    client_writer.write(pending["initial_data"])
-                    await client_writer.drain()
-
-                await asyncio.gather(
-                    forward_data(public_reader, client_writer, "pub->cli"),
-                    forward_data(client_reader, public_writer, "cli->pub")
-                )
-            else:
-                client_writer.close()
+            token, options = parse_handshake(message)
+            await handle_data_channel(token, client_reader, client_writer, options.get("zlib") == "1")
+
+        elif message.startswith("POOL:"):
+            tunnel_id, options = parse_handshake(message)
+            await handle_pooled_channel(
+                tunnel_id, client_reader, client_writer, options.get("zlib") == "1", options.get("replica")
+            )
 
         elif message.startswith("CONTROL:"):
-            tunnel_id = message.split(":", 1)[1]
-            if tunnel_id in tunnels and not tunnels[tunnel_id].get('connected'):
-                tunnels[tunnel_id].update({
-                    'control_writer': client_writer,
-                    'connected': True,
-                    'client_addr': client_addr
-                })
-                print(f"[{tunnel_id}] Cliente conectado de {client_addr}")
-                asyncio.create_task(notify_bot_of_connection(tunnel_id))
-                await client_reader.read() # Manter conexão para futuros sinais
-            else:
-                client_writer.close()
+            argument, options = parse_handshake(message)
+            # Com multi=1 o cliente registra vários túneis (separados por vírgula) nesta conexão.
+            multi = options.get("multi") == "1"
+            tunnel_ids = argument.split(",")[:CONTROL_MAX_TUNNELS] if multi else [argument]
+            owner = None if routed else control_owner(tunnel_ids)
+            if owner is not None:
+                # Réplica nova de um túnel atendido por outro worker: todas as réplicas ficam no dono.
+                fd, buffered = detach_connection(client_reader, client_writer)
+                cluster.route(owner, {"op": "conn", "kind": "control"}, first_line + buffered, [fd])
+                return
+            await handle_control_channel(tunnel_ids, options, multi, client_reader, client_writer, client_addr)
         else:
             client_writer.close()
     except (ConnectionResetError, asyncio.IncompleteReadError):
         pass
     finally:
-        # Lógica de Limpeza
-        for tid, data in list(tunnels.items()):
-            if data.get('control_writer') == client_writer:
-                print(f"[{tid}] Cliente desconectado. Limpando túnel.")
-                if 'domain' in data and data['domain'] in domain_map:
-                    del domain_map[data['domain']]
-                tunnels.pop(tid)
-                break
+        # Lógica de Limpeza: O(1) pelo índice de conexões de controle
+        lost = []
+        for tunnel, replica in registry.detach_control(client_writer):
+            close_pool(replica)
+            if tunnel.replicas:
+                # Só esta réplica sai do rodízio; os tokens que ela não atendeu vão para outra.
+                log(f"[{tunnel.tunnel_id}] Réplica {client_addr} desconectada ({len(tunnel.replicas)} restantes).")
+                redispatch_pending(tunnel, replica)
+                if cluster:
+                    cluster.send(attached_message(tunnel))
+                continue
+            # O túnel (e sua porta pública) continua registrado à espera da reconexão.
+            log(f"[{tunnel.tunnel_id}] Cliente desconectado. Aguardando reconexão.")
+            lost.append(tunnel)
+            if not cluster and not retiring:
+                schedule_tunnel_expiry(tunnel)
+                schedule_listener_idle(tunnel)
+                notify_bot(tunnel, "disconnected")
+        if cluster and lost:
+            cluster.send({"op": "detached", "tunnel_ids": [tunnel.tunnel_id for tunnel in lost]})
+        client_writer.close()
+
+def control_owner(tunnel_ids):
+    """Modo multi-processo: worker que já atende um dos túneis, se não for este (ou None)."""
+    if not cluster:
+        return None
+    for tunnel_id in tunnel_ids:
+        tunnel = registry.get(tunnel_id)
+        if tunnel is not None and tunnel.worker not in (None, cluster.index):
+            return tunnel.worker
+    return None
+
+def control_rejection(tunnel):
+    """Motivo para recusar o túnel em uma conexão de controle nova, ou None se ela pode atendê-lo."""
+    if tunnel is None:
+        return "not_found"
+    # No modo multi-processo, outro worker pode já ser o dono do túnel.
+    if len(tunnel.replicas) >= CONTROL_MAX_REPLICAS or (cluster and tunnel.worker not in (None, cluster.index)):
+        return "in_use"
+    return None
+
+def attached_message(tunnel):
+    """Réplicas do túnel neste worker, para o coordenador (op 'attached')."""
+    return {
+        "op": "attached", "tunnel_id": tunnel.tunnel_id, "handoff": tunnel.handoff,
+        "replicas": [replica.to_dict() for replica in tunnel.replicas],
+    }
+
+async def handle_control_channel(tunnel_ids, options, multi, client_reader, client_writer, client_addr):
+    tunnels, rejected = [], {}
+    for tunnel_id in dict.fromkeys(tunnel_ids):
+        tunnel = registry.get(tunnel_id)
+        reason = control_rejection(tunnel)
+        if not reason and tunnel.protocol == "udp" and options.get("udp") != "1":
+            reason = "unsupported"  # Cliente antigo, que não sabe encaminhar datagramas
+        if reason:
+            rejected[tunnel_id] = reason
+        else:
+            tunnels.append(tunnel)
+    details = [f"rejected={','.join(f'{tid}:{reason}' for tid, reason in rejected.items())}"] if multi and rejected else []
+    if not tunnels:
+        # O cliente desiste de um túnel inexistente e tenta de novo se estiver em uso.
+        reason = "in_use" if "in_use" in rejected.values() else next(iter(rejected.values()))
+        client_writer.write(" ".join(["ERR", *details, reason]).encode() + b"\n")
         client_writer.close()
+        return
+
+    use_mux = MUX_ENABLED and options.get("mux") == "1"
+    use_pool = POOL_MAX_PER_TUNNEL > 0 and options.get("pool") == "1" and not use_mux
+    # A compressão vale para canais DATA/POOL; no modo mux não há canais de dados.
+    use_zlib = COMPRESSION_ENABLED and options.get("zlib") == "1" and not use_mux
+    use_heartbeat = HEARTBEAT_INTERVAL > 0 and options.get("heartbeat") == "1"
+    accepted = [name for name, on in (("mux", use_mux), ("pool", use_pool), ("zlib", use_zlib), ("multi", multi)) if on]
+    if use_heartbeat:
+        # O cliente usa o intervalo para perceber um servidor que parou de responder.
+        details.append(f"heartbeat={HEARTBEAT_INTERVAL:g}")
+    udp = [tunnel.tunnel_id for tunnel in tunnels if tunnel.protocol == "udp"]
+    if udp:
+        # Os canais destes túneis levam datagramas em frames (datagram.py).
+        details.append(f"udp={','.join(udp)}")
+    replica_id = uuid.uuid4().hex[:12]
+    if use_pool:
+        # Os canais POOL levam o id para ficar no pool desta réplica.
+        details.append(f"replica={replica_id}")
+    # Confirma as opções aceitas; clientes antigos ignoram esta linha.
+    client_writer.write(" ".join(["OK"] + [f"{name}=1" for name in accepted] + details).encode() + b"\n")
+    await client_writer.drain()
+
+    session = MuxSession(client_reader, client_writer) if use_mux else None
+    replicas = []
+    for tunnel in tunnels:
+        first = not tunnel.replicas
+        replica = Replica(
+            replica_id, tunnel.tunnel_id, client_writer, client_addr, use_mux, session, multi,
+            collections.deque() if use_pool else None,
+        )
+        registry.attach_control(tunnel, replica)
+        replicas.append(replica)
+        cancel_tunnel_expiry(tunnel)
+        if cluster:
+            tunnel.worker = cluster.index
+            tunnel.handoff = any(r.mux or r.pool is not None for r in tunnel.replicas)
+            cluster.send(attached_message(tunnel))
+        elif first and not migrated(tunnel):
+            notify_bot(tunnel, "connected")
+        count = f" (réplica {len(tunnel.replicas)})" if not first else ""
+        log(f"[{tunnel.tunnel_id}] Cliente conectado de {client_addr}{' (mux)' if use_mux else ''}{count}")
+    binding = [tunnel for tunnel in tunnels if listener_wanted(tunnel)]
+    if binding:
+        results = await asyncio.gather(*(bind_public_listener(t) for t in binding), return_exceptions=True)
+        for tunnel, result in zip(binding, results):
+            if isinstance(result, OSError):
+                log(f"[{tunnel.tunnel_id}] Falha ao abrir a porta pública {tunnel.public_port}: {result}")
+
+    heartbeat = ControlHeartbeat(client_writer, replicas, session) if use_heartbeat else None
+    try:
+        if session:
+            await session.run()
+        else:
+            # Manter conexão para futuros sinais; o cliente só envia respostas ao PING
+            # e FAIL para os NEW_CONNECTION cujo serviço local não respondeu.
+            while line := await client_reader.readline():
+                if line.startswith(b"FAIL:"):
+                    fail_pending(line[5:].strip().decode())
+                    continue
+                seq = line[5:].strip()
+                if heartbeat and line.startswith(b"PONG:") and seq.isdigit():
+                    heartbeat.pong(int(seq))
+    finally:
+        if heartbeat:
+            heartbeat.stop()
+
+def new_connection_signal(replica, token):
+    """Linha NEW_CONNECTION; clientes com vários túneis recebem também o túnel de destino."""
+    if replica.multi:
+        return f"NEW_CONNECTION:{token} {replica.tunnel_id}\n".encode()
+    return f"NEW_CONNECTION:{token}\n".encode()
+
+# --- Túneis UDP ---
+
+class UdpSession:
+    """Um endereço de origem na porta pública UDP, atendido por uma réplica do cliente."""
+
+    __slots__ = ("id", "addr", "channel", "seen", "quiet")
+
+    def __init__(self, session_id, addr, channel):
+        self.id = session_id
+        self.addr = addr
+        self.channel = channel
+        self.seen = True   # Houve datagrama desde a última varredura
+        self.quiet = 0     # Varreduras seguidas sem datagramas
+
+class UdpChannel:
+    """Canal de frames com uma réplica, compartilhado pelas sessões atribuídas a ela."""
+
+    def __init__(self, relay, replica):
+        self.relay = relay
+        self.replica = replica
+        self.frames = FrameWriter()
+        self.sessions = set()
+        self.writer = None
+        self.meter = RelayMeter()  # a_to_b = visitantes -> cliente
+        spawn(self.run())
+
+    async def run(self):
+        tunnel = self.relay.tunnel
+        tunnel.open_meter(self.meter)
+        pump = None
+        try:
+            reader, self.writer = await open_client_channel(tunnel, self.replica)
+            pump = spawn(self.frames.run(self.writer))
+            await read_frames(reader, self.to_visitors)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if pump:
+                pump.cancel()
+            if self.writer:
+                self.writer.close()
+            tunnel.close_meter(self.meter)
+            self.relay.channel_closed(self)
+
+    def to_visitors(self, frames):
+        relay = self.relay
+        udp_counts["datagrams_out"] += len(frames)
+        for session_id, payload in frames:
+            session = relay.by_id.get(session_id)
+            if session is None or session.channel is not self:
+                continue
+            if payload is None:
+                relay.close_session(session, notify=False)
+            elif not udp_bandwidth(relay.tunnel, len(payload)):
+                udp_counts["dropped_bandwidth"] += 1
+            elif relay.socket.sendto(payload, session.addr):
+                session.seen = True
+                self.meter.b_to_a.bytes += len(payload)
+            else:
+                udp_counts["dropped_socket"] += 1
+
+    def close(self):
+        self.frames.closed = True
+        if self.writer:
+            self.writer.close()
+
+class UdpRelay:
+    """
+    Porta pública UDP de um túnel (no lugar do asyncio.Server dos túneis TCP).
+    Cada endereço de origem vira uma sessão atribuída a uma réplica pelo
+    balanceamento; os datagramas seguem em frames pelo canal da réplica, aberto
+    no primeiro datagrama. Sessões sem tráfego por UDP_SESSION_IDLE expiram.
+    """
+
+    def __init__(self, tunnel, sock):
+        self.tunnel = tunnel
+        self.socket = DatagramSocket(sock, self.from_visitors)
+        self.sessions = {}   # {endereço: UdpSession}
+        self.by_id = {}      # {id: UdpSession}
+        self.channels = {}   # {Replica: UdpChannel}
+        self.next_id = 0
+        self.sweeper = None
+        if UDP_SESSION_IDLE > 0:
+            self.sweeper = timers.schedule(UDP_SESSION_IDLE / 2, self.sweep)
+
+    def from_visitors(self, batch):
+        tunnel = self.tunnel
+        udp_counts["datagrams_in"] += len(batch)
+        for data, addr in batch:
+            session = self.sessions.get(addr) or self.open_session(addr)
+            if session is None:
+                continue
+            session.seen = True
+            if not udp_bandwidth(tunnel, len(data)):
+                udp_counts["dropped_bandwidth"] += 1
+            elif session.channel.frames.send(session.id, data):
+                session.channel.meter.a_to_b.bytes += len(data)
+            else:
+                udp_counts["dropped_channel"] += 1
+
+    def open_session(self, addr):
+        tunnel = self.tunnel
+        replica = choose_replica(tunnel)
+        if replica is None:
+            udp_counts["dropped_offline"] += 1
+            return None
+        if memory_exhausted():
+            return None
+        if not take_connection(tunnel):
+            return None
+        channel = self.channels.get(replica)
+        if channel is None:
+            channel = self.channels[replica] = UdpChannel(self, replica)
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        session = UdpSession(self.next_id, addr, channel)
+        self.sessions[addr] = self.by_id[session.id] = session
+        channel.sessions.add(session)
+        replica.active += 1
+        udp_counts["sessions_opened"] += 1
+        return session
+
+    def close_session(self, session, notify=True):
+        del self.sessions[session.addr]
+        del self.by_id[session.id]
+        session.channel.sessions.discard(session)
+        session.channel.replica.active -= 1
+        if notify:
+            session.channel.frames.close_session(session.id)
+
+    def channel_closed(self, channel):
+        """Canal caiu: suas sessões recomeçam (em outra réplica, se preciso) no próximo datagrama."""
+        if self.channels.get(channel.replica) is channel:
+            del self.channels[channel.replica]
+        for session in list(channel.sessions):
+            self.close_session(session, notify=False)
+
+    def sweep(self):
+        for session in list(self.sessions.values()):
+            session.quiet = 0 if session.seen else session.quiet + 1
+            session.seen = False
+            if session.quiet >= 2:
+                expired_counts["udp_session_idle"] += 1
+                self.close_session(session)
+        for channel in list(self.channels.values()):
+            if not channel.sessions:
+                channel.close()
+        self.sweeper = timers.schedule(UDP_SESSION_IDLE / 2, self.sweep)
+
+    def close(self):
+        if self.sweeper:
+            self.sweeper.cancel()
+            self.sweeper = None
+        self.socket.close()
+        for channel in list(self.channels.values()):
+            channel.close()
+
+    async def wait_closed(self):
+        pass
+
+def udp_bandwidth(tunnel, size):
+    """Limite de banda de túneis UDP: com o balde do túnel ou do usuário em dívida o datagrama é descartado."""
+    buckets = [limits.bandwidth for limits in (tunnel.limits, user_limits.get(tunnel.user_id)) if limits is not None]
+    if any(bucket.in_debt() for bucket in buckets):
+        return False
+    for bucket in buckets:
+        bucket.take(size)
+    return True
+
+def listener_wanted(tunnel):
+    """A porta pública do túnel deve estar aberta neste processo."""
+    if tunnel.protocol == "udp" and cluster:
+        # Datagramas não passam entre workers: só o dono do túnel abre a porta UDP.
+        return tunnel.worker == cluster.index
+    if PUBLIC_LISTENER_MODE == "lazy" or (PUBLIC_LISTENER_MODE == "single" and tunnel.protocol == "udp"):
+        # O socket único só recebe TCP; no modo single as portas UDP se comportam como no lazy.
+        return has_client(tunnel)
+    return PUBLIC_LISTENER_MODE == "eager"
+
+async def open_public_listener(tunnel):
+    """
+    Torna o túnel alcançável pela porta pública. No coordenador, anuncia o
+    túnel aos workers; no modo lazy, a porta só abre com um cliente conectado.
+    """
+    if cluster and cluster.role == "coordinator":
+        cluster.broadcast(tunnel_message(tunnel))
+        return
+    if listener_wanted(tunnel):
+        await bind_public_listener(tunnel)
+
+def has_client(tunnel):
+    """Há um cliente conectado ao túnel (neste processo ou, no modo multi-processo, em algum worker)."""
+    return tunnel.connected or tunnel.worker is not None
+
+async def bind_public_listener(tunnel):
+    """Abre a porta pública do túnel neste processo, se ainda não estiver aberta."""
+    cancel_listener_idle(tunnel)
+    if tunnel.public_server is not None or tunnel.tunnel_id in binding_listeners:
+        return
+    registered = registry.get(tunnel.tunnel_id) is tunnel
+    # Numa atualização, a porta já aberta pelo processo antigo é reaproveitada.
+    sock = adopted_listeners.pop(tunnel.tunnel_id, None)
+    binding_listeners.add(tunnel.tunnel_id)
+    try:
+        if tunnel.protocol == "udp":
+            server = UdpRelay(tunnel, sock or bind_udp(SERVER_IP, tunnel.public_port, reuse_port=cluster is not None))
+        else:
+            # Handler para conexões TCP diretas na porta pública
+            handler = lambda r, w: signal_new_connection(tunnel.tunnel_id, r, w)
+            address = {"sock": sock} if sock else {"host": SERVER_IP, "port": tunnel.public_port, "reuse_port": cluster is not None}
+            server = await asyncio.start_server(handler, limit=early_data_limit(), **address)
+    finally:
+        binding_listeners.discard(tunnel.tunnel_id)
+    if registered and registry.get(tunnel.tunnel_id) is not tunnel:
+        server.close()  # Removido enquanto a porta abria
+        return
+    tunnel.public_server = server
+
+def schedule_listener_idle(tunnel):
+    """Modo lazy: fecha a porta pública se o cliente não voltar em PUBLIC_LISTENER_IDLE."""
+    if tunnel.public_server is None or listener_wanted(tunnel):
+        return
+    cancel_listener_idle(tunnel)
+    tunnel.listener_idle = timers.schedule(PUBLIC_LISTENER_IDLE, close_idle_listener, tunnel.tunnel_id)
+
+def cancel_listener_idle(tunnel):
+    if tunnel.listener_idle:
+        tunnel.listener_idle.cancel()
+        tunnel.listener_idle = None
+
+def close_idle_listener(tunnel_id):
+    tunnel = registry.get(tunnel_id)
+    if tunnel is None or listener_wanted(tunnel) or tunnel.public_server is None:
+        return
+    tunnel.listener_idle = None
+    expired_counts["public_listener_idle"] += 1
+    tunnel.public_server.close()
+    tunnel.public_server = None
+
+# Opção de socket do Linux (netfilter) com o destino original de uma conexão redirecionada.
+SO_ORIGINAL_DST = 80
+IP_TRANSPARENT = 19
+
+def original_destination_port(writer):
+    """Porta que o visitante tentou acessar antes do redirect (ou, com TPROXY, a porta local)."""
+    sock = writer.get_extra_info("socket")
+    try:
+        if sock.family == socket.AF_INET6:
+            raw = sock.getsockopt(socket.IPPROTO_IPV6, SO_ORIGINAL_DST, 28)
+        else:
+            raw = sock.getsockopt(socket.SOL_IP, SO_ORIGINAL_DST, 16)
+        return struct.unpack_from("!H", raw, 2)[0]
+    except OSError:
+        # Sem NAT (TPROXY ou conexão direta), o endereço local é o destino original.
+        return writer.get_extra_info("sockname")[1]
+
+async def handle_redirected_connection(public_reader, public_writer):
+    """Modo single: identifica o túnel pela porta de destino original do visitante."""
+    tunnel = registry.by_port(original_destination_port(public_writer))
+    if tunnel is None:
+        rejected_counts["unknown_port"] += 1
+        public_writer.close()
+        return
+    await signal_new_connection(tunnel.tunnel_id, public_reader, public_writer)
+
+async def start_redirect_listener(sock=None):
+    """
+    Socket único do modo single (ou 'sock', recebido numa atualização).
+    IP_TRANSPARENT só é necessário com TPROXY (exige CAP_NET_ADMIN).
+    """
+    if sock is None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if cluster:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            sock.setsockopt(socket.SOL_IP, IP_TRANSPARENT, 1)
+        except OSError:
+            pass
+        sock.bind((SERVER_IP, PUBLIC_LISTENER_PORT))
+    return await asyncio.start_server(handle_redirected_connection, sock=sock, limit=early_data_limit())
+
+def early_data_limit():
+    """'limit' dos StreamReaders públicos: eles param de ler do socket acima de 2 * limit (EARLY_DATA_MAX)."""
+    return max(EARLY_DATA_MAX // 2, 1)
+
+async def release_tunnel(tunnel):
+    """Libera os recursos de um túnel já removido do registro."""
+    if not registry.by_user(tunnel.user_id):
+        user_limits.pop(tunnel.user_id, None)
+    cancel_listener_idle(tunnel)
+    if not cluster or cluster.role == "coordinator":
+        # Devolve a porta ao pool (reusada só depois da quarentena)
+        ports.release(tunnel.public_port)
+        log(f"Porta {tunnel.public_port} devolvida ao pool.")
+    if cluster and cluster.role == "coordinator":
+        cluster.broadcast({"op": "delete", "tunnel_id": tunnel.tunnel_id})
+        return
+
+    # Para o servidor público
+    if tunnel.public_server:
+        tunnel.public_server.close()
+        await tunnel.public_server.wait_closed()
+
+    # Fecha as conexões das réplicas ativas
+    close_http_idle(tunnel)
+    if edge_cache:
+        edge_cache.forget(tunnel.tunnel_id)
+    for replica in tunnel.replicas:
+        close_pool(replica)
+        if replica.multi and registry.by_control(replica.control_writer):
+            # Os outros túneis da conexão continuam; o cliente só deixa de servir este.
+            # No modo mux não há linhas de comando: o servidor só para de abrir streams dele.
+            if not replica.mux:
+                replica.control_writer.write(f"REMOVED:{tunnel.tunnel_id}\n".encode())
+        else:
+            replica.control_writer.close()
 
 # --- Endpoints da API ---
 
+# Máximo de túneis por página de GET /tunnels e por requisição em lote.
+LIST_LIMIT_MAX = 1000
+BATCH_MAX = 1000
+
+class TunnelSpec(BaseModel):
+    """Um túnel de POST /tunnels/batch; limites omitidos seguem as regras de POST /tunnels."""
+    user_id: str
+    local_port: int
+    protocol: Literal["tcp", "udp"] = "tcp"
+    bandwidth: Optional[int] = None
+    connections_per_second: Optional[float] = None
+    user_bandwidth: Optional[int] = None
+    user_connections_per_second: Optional[float] = None
+
+def new_tunnel(spec: TunnelSpec):
+    """Reserva uma porta pública e monta o túnel com seus limites (ainda fora do registro)."""
+    tunnel = Tunnel(str(uuid.uuid4()), spec.user_id, spec.local_port, ports.allocate(), protocol=spec.protocol)
+    # Limites omitidos usam os padrões; os do usuário só se ele ainda não tiver limites.
+    first = spec.user_id not in user_limits
+    configure_limits(tunnel, {
+        "bandwidth": TUNNEL_BANDWIDTH_LIMIT if spec.bandwidth is None else spec.bandwidth,
+        "connections_per_second": TUNNEL_CONNECTION_LIMIT if spec.connections_per_second is None else spec.connections_per_second,
+    }, {
+        "bandwidth": USER_BANDWIDTH_LIMIT if spec.user_bandwidth is None and first else spec.user_bandwidth,
+        "connections_per_second": USER_CONNECTION_LIMIT if spec.user_connections_per_second is None and first else spec.user_connections_per_second,
+    })
+    return tunnel
+
+def discard_tunnel(tunnel):
+    """Desfaz new_tunnel() para um túnel cuja porta não abriu: devolve a porta e os limites do usuário."""
+    ports.release(tunnel.public_port, busy=True)
+    if not registry.by_user(tunnel.user_id):
+        user_limits.pop(tunnel.user_id, None)
+
+def register_tunnel(tunnel):
+    """Registra um túnel cuja porta pública já está aberta."""
+    registry.add(tunnel)
+    persist(tunnel_message(tunnel))
+    schedule_tunnel_expiry(tunnel)
+    log(f"API criou o túnel {tunnel.tunnel_id} (pública: {tunnel.public_port}) para o usuário {tunnel.user_id}")
+
 @api.post("/tunnels", summary="Cria um novo túnel", dependencies=[Depends(get_api_key)])
-async def create_tunnel(user_id: str, local_port: int):
-    if not available_ports:
+async def create_tunnel(
+    user_id: str, local_port: int, protocol: Literal["tcp", "udp"] = "tcp",
+    bandwidth: Optional[int] = None, connections_per_second: Optional[float] = None,
+    user_bandwidth: Optional[int] = None, user_connections_per_second: Optional[float] = None,
+):
+    if not ports:
         raise HTTPException(status_code=503, detail="No available public ports. Please try again later.")
 
-    public_port = available_ports.pop()
-    tunnel_id = str(uuid.uuid4())
+    tunnel = new_tunnel(TunnelSpec(
+        user_id=user_id, local_port=local_port, protocol=protocol, bandwidth=bandwidth, connections_per_second=connections_per_second,
+        user_bandwidth=user_bandwidth, user_connections_per_second=user_connections_per_second,
+    ))
+    try:
+        await open_public_listener(tunnel)
+    except OSError as e:
+        log(f"Falha ao abrir a porta {tunnel.public_port} para o usuário {user_id}: {e}")
+        discard_tunnel(tunnel)
+        raise HTTPException(status_code=503, detail=f"Could not open public port {tunnel.public_port}. Please try again.")
+    register_tunnel(tunnel)
+    return {"tunnel_id": tunnel.tunnel_id, "public_port": tunnel.public_port, "protocol": tunnel.protocol}
 
-    # Handler para conexões TCP diretas na porta pública
-    handler = lambda r, w: signal_new_connection(tunnel_id, r, w)
-    public_server = await asyncio.start_server(handler, SERVER_IP, public_port)
+@api.get("/tunnels", summary="Lista túneis, com paginação por cursor", dependencies=[Depends(get_api_key)])
+async def list_tunnels(
+    user_id: Optional[str] = None, connected: Optional[bool] = None,
+    cursor: Optional[str] = None, limit: int = 100,
+):
+    """Túneis em ordem de ID. Para a próxima página, repita a consulta com cursor=next_cursor."""
+    if not 1 <= limit <= LIST_LIMIT_MAX:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {LIST_LIMIT_MAX}")
 
-    tunnels[tunnel_id] = {
-        "user_id": user_id,
-        "local_port": local_port,
-        "public_port": public_port,
-        "public_server": public_server,
-        "connected": False,
-        "domain": None,
+    tunnels, next_cursor = registry.page(cursor, limit, user_id, connected)
+    return {
+        "tunnels": [{"tunnel_id": tunnel.tunnel_id, **tunnel.to_dict()} for tunnel in tunnels],
+        "next_cursor": next_cursor,
     }
-    print(f"API criou o túnel {tunnel_id} (pública: {public_port}) para o usuário {user_id}")
-    return {"tunnel_id": tunnel_id, "public_port": public_port}
+
+@api.post("/tunnels/batch", summary="Cria vários túneis", dependencies=[Depends(get_api_key)])
+async def create_tunnels(specs: list[TunnelSpec]):
+    """As portas públicas são abertas em paralelo; um túnel que falha não impede os demais."""
+    if len(specs) > BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX} tunnels per batch")
+    if len(specs) > len(ports):
+        raise HTTPException(status_code=503, detail="No available public ports. Please try again later.")
+
+    tunnels = [new_tunnel(spec) for spec in specs]
+    results = await asyncio.gather(*(open_public_listener(t) for t in tunnels), return_exceptions=True)
+    created, failed = [], []
+    for tunnel, result in zip(tunnels, results):
+        if isinstance(result, Exception):
+            log(f"Falha ao abrir a porta {tunnel.public_port} para o usuário {tunnel.user_id}: {result}")
+            created.append({"error": f"Could not open public port {tunnel.public_port}"})
+            failed.append(tunnel)
+            continue
+        register_tunnel(tunnel)
+        created.append({"tunnel_id": tunnel.tunnel_id, "public_port": tunnel.public_port})
+    # Depois dos registros: os limites do usuário ficam se outro túnel dele entrou no lote.
+    for tunnel in failed:
+        discard_tunnel(tunnel)
+    return {"tunnels": created}
+
+@api.delete("/tunnels/batch", summary="Deleta vários túneis", dependencies=[Depends(get_api_key)])
+async def delete_tunnels(tunnel_ids: list[str]):
+    """Os recursos dos túneis são liberados em paralelo. IDs desconhecidos voltam em 'not_found'."""
+    if len(tunnel_ids) > BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX} tunnels per batch")
+
+    removed = await asyncio.gather(*(remove_tunnel(tunnel_id) for tunnel_id in tunnel_ids))
+    deleted = [tunnel.tunnel_id for tunnel in removed if tunnel]
+    log(f"API deletou {len(deleted)} túneis em lote")
+    return {"deleted": deleted, "not_found": [tid for tid, tunnel in zip(tunnel_ids, removed) if not tunnel]}
 
 @api.get("/tunnels/{tunnel_id}", summary="Obtém detalhes de um túnel específico", dependencies=[Depends(get_api_key)])
 async def get_tunnel_details(tunnel_id: str):
-    if tunnel_id not in tunnels:
+    tunnel = registry.get(tunnel_id)
+    if tunnel is None:
         raise HTTPException(status_code=404, detail="Tunnel not found")
 
-    data = tunnels[tunnel_id]
-    # Clean data for JSON response
-    clean_data = {k: v for k, v in data.items() if not asyncio.iscoroutine(v) and not isinstance(v, (asyncio.StreamWriter, asyncio.base_events.Server))}
-    return clean_data
+    return tunnel.to_dict()
 
 
 @api.put("/tunnels/{tunnel_id}/domain", summary="Aponta um subdomínio para um túnel", dependencies=[Depends(get_api_key)])
 async def map_domain(tunnel_id: str, subdomain: str):
-    if tunnel_id not in tunnels:
+    tunnel = registry.get(tunnel_id)
+    if tunnel is None:
         raise HTTPException(status_code=404, detail="Tunnel not found")
+    if tunnel.protocol != "tcp":
+        raise HTTPException(status_code=409, detail="Domains can only point to TCP tunnels")
 
     full_domain = f"{subdomain.lower()}.{BASE_DOMAIN}"
-    if full_domain in domain_map and domain_map[full_domain] != tunnel_id:
+    owner = registry.by_domain(full_domain)
+    if owner is not None and owner is not tunnel:
         raise HTTPException(status_code=409, detail=f"Domain '{full_domain}' is already in use.")
 
-    # Remove mapeamento antigo se o túnel já tinha um
-    if tunnels[tunnel_id].get('domain') and tunnels[tunnel_id]['domain'] in domain_map:
-        del domain_map[tunnels[tunnel_id]['domain']]
-
-    domain_map[full_domain] = tunnel_id
-    tunnels[tunnel_id]["domain"] = full_domain
-    print(f"API mapeou {full_domain} para {tunnel_id}")
+    # Substitui o mapeamento antigo se o túnel já tinha um
+    registry.set_domain(tunnel, full_domain)
+    message = {"op": "domain", "tunnel_id": tunnel_id, "domain": full_domain}
+    persist(message)
+    if cluster:
+        cluster.broadcast(message)
+    log(f"API mapeou {full_domain} para {tunnel_id}")
     return {"message": "Domain mapped successfully", "domain": full_domain}
 
+@api.put("/tunnels/{tunnel_id}/limits", summary="Altera os limites de banda e de conexões de um túnel", dependencies=[Depends(get_api_key)])
+async def set_tunnel_limits(
+    tunnel_id: str,
+    bandwidth: Optional[int] = None, connections_per_second: Optional[float] = None,
+    user_bandwidth: Optional[int] = None, user_connections_per_second: Optional[float] = None,
+):
+    """Banda em bytes/s; parâmetros omitidos ficam como estão e 0 remove o limite."""
+    tunnel = registry.get(tunnel_id)
+    if tunnel is None:
+        raise HTTPException(status_code=404, detail="Tunnel not found")
+
+    configure_limits(
+        tunnel,
+        {"bandwidth": bandwidth, "connections_per_second": connections_per_second},
+        {"bandwidth": user_bandwidth, "connections_per_second": user_connections_per_second},
+    )
+    message = limits_message(tunnel)
+    persist(message)
+    if cluster:
+        cluster.broadcast(message)
+    log(f"API alterou os limites do túnel {tunnel_id}")
+    return {"tunnel": message["tunnel"], "user": message["user"]}
+
+@api.put("/tunnels/{tunnel_id}/cache", summary="Ativa ou desativa o cache de borda do domínio de um túnel", dependencies=[Depends(get_api_key)])
+async def set_tunnel_cache(tunnel_id: str, enabled: bool):
+    tunnel = registry.get(tunnel_id)
+    if tunnel is None:
+        raise HTTPException(status_code=404, detail="Tunnel not found")
+    if enabled and (HTTP_MODE != "proxy" or CACHE_MEMORY_MAX <= 0):
+        raise HTTPException(status_code=409, detail="The edge cache requires HTTP_MODE=proxy and CACHE_MEMORY_MAX > 0")
+
+    message = {"op": "cache", "tunnel_id": tunnel_id, "enabled": enabled}
+    configure_cache(tunnel, enabled)
+    persist(message)
+    if cluster:
+        cluster.broadcast(message)
+    log(f"API {'ativou' if enabled else 'desativou'} o cache do túnel {tunnel_id}")
+    return {"cache": enabled, "domain": tunnel.domain}
+
+@api.delete("/tunnels/{tunnel_id}/cache", summary="Remove do cache de borda as respostas de um túnel", dependencies=[Depends(get_api_key)])
+async def purge_tunnel_cache(tunnel_id: str, path: Optional[str] = None):
+    """Sem 'path', todas as respostas do túnel; com ele, as daquele caminho (qualquer query string)."""
+    tunnel = registry.get(tunnel_id)
+    if tunnel is None:
+        raise HTTPException(status_code=404, detail="Tunnel not found")
+
+    purge_cache(tunnel_id, path)
+    return {"message": "Cache purged", "domain": tunnel.domain, "path": path}
+
+@api.delete("/cache", summary="Esvazia o cache de borda", dependencies=[Depends(get_api_key)])
+async def purge_all_cache():
+    purge_cache()
+    return {"message": "Cache purged"}
+
+def configure_cache(tunnel, enabled):
+    tunnel.cache = enabled
+    if not enabled and edge_cache:
+        edge_cache.purge(tunnel.tunnel_id)
+
+def purge_cache(tunnel_id=None, path=None):
+    if cluster:
+        cluster.broadcast({"op": "purge", "tunnel_id": tunnel_id, "path": path})
+    elif edge_cache:
+        edge_cache.purge(tunnel_id, path)
+    log("API purgou o cache" + (f" do túnel {tunnel_id}" if tunnel_id else "") + (f" em {path}" if path else ""))
+
 @api.delete("/tunnels/{tunnel_id}", summary="Deleta um túnel", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(get_api_key)])
 async def delete_tunnel(tunnel_id: str):
-    if tunnel_id not in tunnels:
+    if not await remove_tunnel(tunnel_id):
         raise HTTPException(status_code=404, detail="Tunnel not found")
 
-    tunnel = tunnels.pop(tunnel_id)
+    log(f"API deletou o túnel {tunnel_id}")
+    return {}
 
-    # Devolve a porta ao pool
-    if 'public_port' in tunnel:
-        available_ports.add(tunnel['public_port'])
-        print(f"Porta {tunnel['public_port']} devolvida ao pool.")
+async def remove_tunnel(tunnel_id):
+    """Remove o túnel do registro e do estado persistente e libera seus recursos."""
+    tunnel = registry.remove(tunnel_id)
+    if tunnel is None:
+        return None
+    cancel_tunnel_expiry(tunnel)
+    persist({"op": "delete", "tunnel_id": tunnel_id})
+    if upgrade and upgrade.role == "successor":
+        # O processo antigo ainda pode estar atendendo o túnel.
+        upgrade.send({"op": "delete", "tunnel_id": tunnel_id})
+    await release_tunnel(tunnel)
+    return tunnel
 
-    # Para o servidor público
-    if 'public_server' in tunnel and tunnel['public_server']:
-        tunnel['public_server'].close()
-        await tunnel['public_server'].wait_closed()
+@api.get("/stats", summary="Contadores internos do servidor", dependencies=[Depends(get_api_key)])
+async def get_stats():
+    stats = cluster.stats() if cluster else {
+        "tunnels": len(registry),
+        "timers_active": timers.active,
+        "expired": dict(expired_counts),
+        "rejected": dict(rejected_counts),
+        "http": dict(http_counts),
+        "udp": udp_stats(),
+        "cache": edge_cache.stats() if edge_cache else {},
+        "memory": memory_stats(),
+        "access_log": access_log.stats(),
+    }
+    stats["cache"] = cache_report(stats["cache"])
+    stats["callbacks"] = callbacks.stats() if callbacks else {}
+    return stats
 
-    # Remove o mapeamento de domínio
-    if tunnel.get('domain') and tunnel['domain'] in domain_map:
-        del domain_map[tunnel['domain']]
+def memory_stats():
+    return {"rss_bytes": process_rss() or 0, "limit_bytes": MEMORY_LIMIT_MB * 1024 * 1024}
 
-    # Fecha a conexão do cliente se estiver ativa
-    if tunnel.get('connected'):
-        tunnel['control_writer'].close()
+def udp_stats():
+    sessions = sum(len(t.public_server.sessions) for t in registry if t.protocol == "udp" and t.public_server)
+    return {**udp_counts, "sessions": sessions}
 
-    print(f"API deletou o túnel {tunnel_id}")
-    return {}
+def cache_report(stats):
+    """Contadores do cache por domínio, com a fração servida sem transferir o corpo pelo cliente."""
+    domains = {}
+    for tunnel_id, counts in stats.pop("tunnels", {}).items():
+        tunnel = registry.get(tunnel_id)
+        if tunnel is None or tunnel.domain is None:
+            continue
+        lookups = sum(counts.get(result, 0) for result in ("hit", "revalidated", "miss"))
+        hits = counts.get("hit", 0) + counts.get("revalidated", 0)
+        domains[tunnel.domain] = {**counts, "hit_ratio": round(hits / lookups, 4) if lookups else 0.0}
+    stats["domains"] = domains
+    return stats
+
+TUNNEL_METRICS = (
+    ("frp_tunnel_bytes_in_total", "counter", "Bytes encaminhados do visitante para o cliente", "bytes_in"),
+    ("frp_tunnel_bytes_out_total", "counter", "Bytes encaminhados do cliente para o visitante", "bytes_out"),
+    ("frp_tunnel_connections_active", "gauge", "Conexões de visitantes sendo encaminhadas", "connections_active"),
+    ("frp_tunnel_connections_total", "counter", "Conexões de visitantes encaminhadas desde a criação", "connections_total"),
+    ("frp_tunnel_pool_hits_total", "counter", "Visitantes atendidos por um canal pré-aquecido", "pool_hits"),
+    ("frp_tunnel_pool_misses_total", "counter", "Visitantes que precisaram de NEW_CONNECTION com pool ativo", "pool_misses"),
+)
+
+@api.get("/metrics", summary="Métricas no formato Prometheus", dependencies=[Depends(get_api_key)])
+async def get_metrics():
+    out = MetricsWriter()
+    tunnels = [(tunnel, tunnel.to_dict()) for tunnel in registry]
+    out.metric("frp_tunnels", "gauge", "Túneis registrados", len(tunnels))
+    out.metric("frp_tunnels_connected", "gauge", "Túneis com cliente conectado", sum(t.connected for t, _ in tunnels))
+    for name, kind, help, key in TUNNEL_METRICS:
+        out.family(name, kind, help)
+        for tunnel, values in tunnels:
+            out.sample(name, values[key], {"tunnel_id": tunnel.tunnel_id, "user_id": tunnel.user_id})
+
+    out.family("frp_tunnel_rtt_seconds", "gauge", "RTT do último heartbeat na conexão de controle")
+    for tunnel, values in tunnels:
+        if "rtt_ms" in values:
+            out.sample("frp_tunnel_rtt_seconds", tunnel.rtt, {"tunnel_id": tunnel.tunnel_id, "user_id": tunnel.user_id})
+
+    out.family("frp_tunnel_replicas", "gauge", "Conexões de controle (réplicas do cliente) servindo o túnel")
+    for tunnel, _ in tunnels:
+        out.sample("frp_tunnel_replicas", len(tunnel.replicas), {"tunnel_id": tunnel.tunnel_id, "user_id": tunnel.user_id})
+    for name, help, key in (
+        ("frp_replica_connections_active", "Visitantes sendo atendidos por uma réplica", "active"),
+        ("frp_replica_latency_seconds", "Latência média (EWMA) de uma réplica", "latency"),
+    ):
+        out.family(name, "gauge", help)
+        for tunnel, _ in tunnels:
+            for replica in tunnel.replicas:
+                value = getattr(replica, key)
+                if value is not None:
+                    out.sample(name, value, {"tunnel_id": tunnel.tunnel_id, "replica": replica.id})
+
+    compressed = [(tunnel, values["compression"]) for tunnel, values in tunnels if "compression" in values]
+    for name, help, key in (
+        ("frp_tunnel_compression_plain_bytes_total", "Bytes antes da compressão zlib nos canais de dados", "plain_bytes"),
+        ("frp_tunnel_compression_wire_bytes_total", "Bytes trafegados nos canais de dados comprimidos", "wire_bytes"),
+    ):
+        out.family(name, "counter", help)
+        for tunnel, values in compressed:
+            out.sample(name, values[key], {"tunnel_id": tunnel.tunnel_id, "user_id": tunnel.user_id})
+
+    stats = await get_stats()
+    out.metric("frp_timers_active", "gauge", "Prazos agendados na roda de timers", stats["timers_active"])
+    out.family("frp_expired_total", "counter", "Conexões encerradas por prazo vencido")
+    for kind, count in sorted(stats["expired"].items()):
+        out.sample("frp_expired_total", count, {"kind": kind})
+    out.family("frp_rejected_total", "counter", "Visitantes recusados pelos limites do túnel ou do usuário")
+    for reason, count in sorted(stats["rejected"].items()):
+        out.sample("frp_rejected_total", count, {"reason": reason})
+    out.family("frp_http_proxy_total", "counter", "Modo proxy HTTP: requisições, canais reaproveitados/abertos e respostas de erro")
+    for kind, count in sorted(stats["http"].items()):
+        out.sample("frp_http_proxy_total", count, {"kind": kind})
+    out.metric("frp_resident_memory_bytes", "gauge", "Memória residente dos processos que atendem visitantes", stats["memory"]["rss_bytes"])
+    udp = dict(stats["udp"])
+    out.metric("frp_udp_sessions", "gauge", "Sessões UDP (endereços de origem) ativas", udp.pop("sessions", 0))
+    out.family("frp_udp_total", "counter", "Túneis UDP: datagramas, sessões abertas e datagramas descartados")
+    for kind, count in sorted(udp.items()):
+        out.sample("frp_udp_total", count, {"kind": kind})
+    cache = stats["cache"]
+    out.metric("frp_http_cache_entries", "gauge", "Respostas guardadas no cache de borda", cache.get("entries", 0))
+    out.family("frp_http_cache_bytes", "gauge", "Bytes de corpos guardados no cache de borda")
+    out.sample("frp_http_cache_bytes", cache.get("memory_bytes", 0), {"store": "memory"})
+    out.sample("frp_http_cache_bytes", cache.get("disk_bytes", 0), {"store": "disk"})
+    out.family("frp_http_cache_requests_total", "counter", "Requisições a domínios com cache por resultado (hit, revalidated, miss, bypass)")
+    for domain, counts in sorted(cache["domains"].items()):
+        for result in ("hit", "revalidated", "miss", "bypass"):
+            out.sample("frp_http_cache_requests_total", counts.get(result, 0), {"domain": domain, "result": result})
+    out.family("frp_http_cache_hit_ratio", "gauge", "Fração das requisições cacheáveis atendidas sem o corpo passar pelo cliente")
+    for domain, counts in sorted(cache["domains"].items()):
+        out.sample("frp_http_cache_hit_ratio", counts["hit_ratio"], {"domain": domain})
+    access_stats = dict(stats["access_log"])
+    out.metric("frp_access_log_queued", "gauge", "Mensagens e registros de acesso aguardando a thread escritora", access_stats.pop("queued", 0))
+    access_stats.pop("sample", None)
+    out.family("frp_access_log_records_total", "counter", "Registros de acesso por destino (accepted, sampled_out, dropped, written, errors)")
+    for result, count in sorted(access_stats.items()):
+        out.sample("frp_access_log_records_total", count, {"result": result})
+    callback_stats = dict(stats["callbacks"])
+    out.metric("frp_callback_queue", "gauge", "Eventos aguardando envio ao bot", callback_stats.pop("pending", 0))
+    out.metric("frp_callback_retries_total", "counter", "Lotes de eventos reenviados ao bot", callback_stats.pop("retries", 0))
+    out.family("frp_callback_events_total", "counter", "Eventos para o bot por resultado (sent, coalesced, dropped, failed)")
+    for result, count in sorted(callback_stats.items()):
+        out.sample("frp_callback_events_total", count, {"result": result})
+    for histogram in (cluster.histograms() if cluster else HISTOGRAMS):
+        out.histogram(histogram)
+    return Response(out.render(), media_type=MetricsWriter.CONTENT_TYPE)
+
+# --- Perfil do Event Loop ---
+
+async def run_profile(mode, seconds, interval, threshold):
+    """Perfil do loop deste processo: amostras da pilha (sample) ou callbacks lentos (slow)."""
+    if mode == "sample":
+        return await sample_stacks(seconds, interval)
+    return await slow_callbacks(seconds, threshold, forward=log)
+
+@api.post("/admin/profile", summary="Perfila o event loop por uma janela limitada", dependencies=[Depends(get_api_key)])
+async def profile_event_loop(
+    mode: Literal["sample", "slow"] = "sample", seconds: float = 10, interval_ms: float = 5, threshold_ms: float = 50
+):
+    """
+    sample amostra a pilha do loop a cada interval_ms; slow lista os callbacks
+    que passaram de threshold_ms. Responde ao fim da janela; com --workers,
+    todos os workers são perfilados ao mesmo tempo.
+    """
+    global profile_running
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {PROFILE_MAX_SECONDS:g}")
+    if interval_ms < 1 or threshold_ms <= 0:
+        raise HTTPException(status_code=400, detail="interval_ms must be at least 1 and threshold_ms positive")
+    if profile_running:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    profile_running = True
+    try:
+        params = (mode, seconds, interval_ms / 1000, threshold_ms / 1000)
+        if cluster:
+            return {"mode": mode, "seconds": seconds, "workers": await cluster.profile(*params)}
+        return await run_profile(*params)
+    finally:
+        profile_running = False
+
+# --- Estado Persistente ---
+#
+# Os registros do journal são as mesmas mensagens enviadas aos workers
+# (tunnel_message, limits_message, domain, cache, delete), com o estado final de
+# cada alteração; reaplicá-los em ordem reconstrói a tabela.
+
+def persist(record):
+    if upgrade and upgrade.role == "predecessor":
+        # A tabela já foi entregue ao processo novo, que mantém o journal.
+        upgrade.send({"op": "record", "record": record})
+        return
+    if store is None:
+        return
+    store.append(record)
+    if store.entries >= SNAPSHOT_JOURNAL_MAX:
+        compact_state()
+
+def apply_record(msg):
+    op = msg["op"]
+    if op == "tunnel":
+        registry.remove(msg["tunnel_id"])
+        tunnel = Tunnel(msg["tunnel_id"], msg["user_id"], msg["local_port"], msg["public_port"], protocol=msg.get("protocol", "tcp"))
+        registry.add(tunnel)
+        registry.set_domain(tunnel, msg["domain"])
+        tunnel.cache = msg.get("cache", False)
+        if msg["limits"] or msg["user_limits"]:
+            configure_limits(tunnel, msg["limits"], msg["user_limits"])
+        return
+    tunnel = registry.get(msg["tunnel_id"])
+    if tunnel is None:
+        return
+    if op == "domain":
+        registry.set_domain(tunnel, msg["domain"])
+    elif op == "limits":
+        configure_limits(tunnel, msg["tunnel"], msg["user"])
+    elif op == "cache":
+        tunnel.cache = msg["enabled"]
+    elif op == "delete":
+        registry.remove(tunnel.tunnel_id)
+        if not registry.by_user(tunnel.user_id):
+            user_limits.pop(tunnel.user_id, None)
+
+async def restore_state():
+    """Carrega snapshot + journal e reabre as portas públicas em paralelo."""
+    global store
+    started = time.monotonic()
+    store = StateStore(STATE_DIR, log)
+    # Os registros e túneis criados aqui vivem até o fim do processo: sem coletas
+    # no meio da carga (que varreriam a tabela inteira a cada poucos milhares de
+    # objetos) e, depois, fora das coletas seguintes (gc.freeze).
+    gc.disable()
+    try:
+        for record in store.load():
+            apply_record(record)
+    finally:
+        gc.enable()
+    gc.freeze()
+    for tunnel in registry:
+        ports.reserve(tunnel.public_port)
+    if DISCONNECTED_TUNNEL_TTL > 0:
+        # Um único prazo para todos os túneis restaurados, que começam sem cliente.
+        timers.schedule(DISCONNECTED_TUNNEL_TTL, expire_restored_tunnels, [tunnel.tunnel_id for tunnel in registry])
+    if not cluster:
+        # No modo multi-processo os workers recebem a tabela ao iniciar. Sem
+        # cliente conectado, só o modo eager abre portas: os demais nem criam tarefas.
+        tunnels = [tunnel for tunnel in registry if listener_wanted(tunnel)]
+        results = await asyncio.gather(*(open_public_listener(t) for t in tunnels), return_exceptions=True)
+        for tunnel, result in zip(tunnels, results):
+            if isinstance(result, Exception):
+                log(f"[{tunnel.tunnel_id}] Falha ao reabrir a porta {tunnel.public_port}: {result}")
+    log(f"Estado restaurado de {STATE_DIR}: {len(registry)} túneis em {time.monotonic() - started:.2f}s")
+    spawn(compact_state_loop())
+
+def compact_state():
+    if not store.compacting:
+        store.compact([tunnel_message(tunnel) for tunnel in registry])
+
+async def compact_state_loop():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        if store and store.entries:
+            compact_state()
+
+# --- Modo Multi-processo (--workers N) ---
+#
+# O coordenador mantém a tabela de túneis e a API; os workers compartilham
+# FRP_PORT, HTTP_PORT e as portas públicas via SO_REUSEPORT. O worker que
+# recebe a conexão de controle de um túnel é o seu dono. Um visitante que cai
+# em outro worker:
+#  - túneis clássicos: o dono apenas envia NEW_CONNECTION; o token carrega o
+#    índice do worker do visitante, e o canal DATA (que pode cair em qualquer
+#    worker) é entregue a ele. O relay roda onde o visitante chegou.
+#  - túneis mux/pool: o socket do visitante é entregue ao dono (SCM_RIGHTS).
+
+STATS_INTERVAL = 2.0
+STATS_BATCH = 200  # Túneis por mensagem tunnel_stats (cada um ocupa algumas centenas de bytes)
+
+def tunnel_message(tunnel):
+    limits = limits_message(tunnel)
+    return {
+        "op": "tunnel", "tunnel_id": tunnel.tunnel_id, "user_id": tunnel.user_id,
+        "local_port": tunnel.local_port, "public_port": tunnel.public_port, "protocol": tunnel.protocol,
+        "domain": tunnel.domain, "cache": tunnel.cache, "worker": tunnel.worker, "handoff": tunnel.handoff,
+        "limits": limits["tunnel"], "user_limits": limits["user"],
+    }
+
+def compression_counters(tunnel):
+    stats = tunnel.compression
+    if stats is None:
+        return {}
+    return {"compressed_plain": stats.plain, "compressed_wire": stats.wire, "compression_bypasses": stats.bypasses}
+
+def tunnel_counters(tunnel):
+    return {"pool_hits": tunnel.pool_hits, "pool_misses": tunnel.pool_misses, **tunnel.traffic(), **compression_counters(tunnel)}
+
+class Coordinator:
+    role = "coordinator"
+
+    def __init__(self, count):
+        self.count = count
+        self.channels = {}      # {índice: IpcChannel}
+        self.worker_stats = {}  # {índice: último relatório de contadores}
+        self.worker_tunnels = {}  # {índice: {tunnel_id: Counter}}, somados dos deltas de tunnel_stats
+        self.profiles = {}      # {índice: Future} do perfil pedido a cada worker
+
+    async def start(self):
+        for index in range(self.count):
+            await self.start_worker(index)
+
+    async def start_worker(self, index):
+        process, sock = await spawn_worker(index, self.count, os.path.abspath(__file__))
+        channel = IpcChannel(sock, lambda msg, payload, fds: self.on_message(index, msg, payload, fds), log=log)
+        self.channels[index] = channel
+        # Um worker novo (ou reiniciado) recebe a tabela atual.
+        for tunnel in registry:
+            channel.send(tunnel_message(tunnel))
+        spawn(self.watch(index, process))
+
+    async def watch(self, index, process):
+        code = await process.wait()
+        log(f"[COORD] Worker {index} encerrou (código {code}). Reiniciando.")
+        self.channels.pop(index).close()
+        self.worker_stats.pop(index, None)
+        self.worker_tunnels.pop(index, None)
+        # As conexões de controle daquele processo se perderam junto com ele;
+        # os clientes reconectam a outro worker.
+        for tunnel in registry:
+            if tunnel.worker == index:
+                self.detach(tunnel)
+        await asyncio.sleep(1)
+        await self.start_worker(index)
+
+    def send(self, index, msg, payload=b"", fds=()):
+        channel = self.channels.get(index)
+        if channel:
+            channel.send(msg, payload, fds)
+        else:
+            for fd in fds:
+                os.close(fd)
+
+    def broadcast(self, msg):
+        for channel in self.channels.values():
+            channel.send(msg)
+
+    def on_message(self, index, msg, payload, fds):
+        op = msg["op"]
+        if op == "route":
+            self.send(msg["to"], msg["msg"], payload, fds)
+        elif op == "attached":
+            tunnel = registry.get(msg["tunnel_id"])
+            if tunnel is None or tunnel.worker not in (None, index):
+                # Duas conexões de controle simultâneas em workers diferentes: fica a primeira.
+                self.send(index, {"op": "kick", "tunnel_id": msg["tunnel_id"]})
+                return
+            # Também chega quando uma réplica entra ou sai de um túnel que segue conectado.
+            first = tunnel.worker is None
+            tunnel.worker = index
+            cancel_tunnel_expiry(tunnel)
+            tunnel.replicas = [Replica.from_dict(tunnel.tunnel_id, data) for data in msg["replicas"]]
+            if first or tunnel.handoff != msg["handoff"]:
+                tunnel.handoff = msg["handoff"]
+                self.broadcast({"op": "owner", "tunnel_id": tunnel.tunnel_id, "worker": index, "handoff": tunnel.handoff})
+            if first:
+                notify_bot(tunnel, "connected")
+        elif op == "profile":
+            future = self.profiles.pop(index, None)
+            if future and not future.done():
+                future.set_result(msg["result"])
+        elif op == "detached":
+            for tunnel_id in msg["tunnel_ids"]:
+                tunnel = registry.get(tunnel_id)
+                if tunnel is not None and tunnel.worker == index:
+                    self.detach(tunnel)
+        elif op == "stats":
+            # Os histogramas só vêm quando mudaram desde o relatório anterior.
+            previous = self.worker_stats.get(index)
+            if "histograms" not in msg:
+                msg["histograms"] = previous["histograms"] if previous else {}
+            self.worker_stats[index] = msg
+        elif op == "tunnel_stats":
+            reported = self.worker_tunnels.setdefault(index, {})
+            for tunnel_id, delta in msg["tunnels"].items():
+                tunnel = registry.get(tunnel_id)
+                if tunnel is None:
+                    reported.pop(tunnel_id, None)
+                    continue
+                replicas = delta.pop("replicas", None)
+                counters = reported.setdefault(tunnel_id, collections.Counter())
+                counters.update(delta)
+                if tunnel.worker == index:
+                    tunnel.pool_hits = counters["pool_hits"]
+                    tunnel.pool_misses = counters["pool_misses"]
+                    if replicas is not None:
+                        tunnel.replicas = [Replica.from_dict(tunnel_id, data) for data in replicas]
+                # No modo clássico o tráfego de um túnel se espalha pelos workers.
+                totals = collections.Counter()
+                for tunnels in self.worker_tunnels.values():
+                    totals.update(tunnels.get(tunnel_id, {}))
+                tunnel.bytes_in = totals["bytes_in"]
+                tunnel.bytes_out = totals["bytes_out"]
+                tunnel.connections_active = totals["connections_active"]
+                tunnel.connections_total = totals["connections_total"]
+                if totals["compressed_plain"]:
+                    tunnel.compression = CompressionStats(
+                        totals["compressed_plain"], totals["compressed_wire"], totals["compression_bypasses"]
+                    )
+
+    async def profile(self, mode, seconds, interval, threshold):
+        """Perfila todos os workers na mesma janela; {índice: resultado} (None se o worker não respondeu)."""
+        loop = asyncio.get_running_loop()
+        for index in self.channels:
+            self.profiles[index] = loop.create_future()
+        futures = dict(self.profiles)
+        self.broadcast({"op": "profile", "mode": mode, "seconds": seconds, "interval": interval, "threshold": threshold})
+        await asyncio.wait(futures.values(), timeout=seconds + 5)
+        for index, future in futures.items():
+            if self.profiles.get(index) is future:
+                del self.profiles[index]
+        return {index: future.result() if future.done() else None for index, future in futures.items()}
+
+    def detach(self, tunnel):
+        """O cliente do túnel caiu: o túnel fica sem dono até ele reconectar."""
+        tunnel.worker = None
+        tunnel.replicas = []
+        tunnel.handoff = False
+        self.broadcast({"op": "owner", "tunnel_id": tunnel.tunnel_id, "worker": None, "handoff": False})
+        schedule_tunnel_expiry(tunnel)
+        notify_bot(tunnel, "disconnected")
+
+    def histograms(self):
+        return [
+            histogram.merged(report["histograms"][histogram.name] for report in self.worker_stats.values())
+            for histogram in HISTOGRAMS
+        ]
+
+    def stats(self):
+        expired = collections.Counter()
+        rejected = collections.Counter()
+        http = collections.Counter()
+        udp = collections.Counter()
+        cache = collections.Counter()
+        cache_tunnels = collections.defaultdict(collections.Counter)
+        access_stats = collections.Counter()
+        for report in self.worker_stats.values():
+            access_stats.update(report["access_log"])
+            expired.update(report["expired"])
+            rejected.update(report["rejected"])
+            http.update(report["http"])
+            udp.update(report["udp"])
+            counts = dict(report["cache"])
+            for tunnel_id, results in counts.pop("tunnels", {}).items():
+                cache_tunnels[tunnel_id].update(results)
+            cache.update(counts)
+        return {
+            "tunnels": len(registry),
+            "workers": len(self.channels),
+            "timers_active": sum(report["timers_active"] for report in self.worker_stats.values()),
+            "expired": dict(expired),
+            "rejected": dict(rejected),
+            "http": dict(http),
+            "udp": dict(udp),
+            "memory": {
+                "rss_bytes": sum(report["memory"]["rss_bytes"] for report in self.worker_stats.values()),
+                "limit_bytes": MEMORY_LIMIT_MB * 1024 * 1024,
+            },
+            "cache": {**cache, "tunnels": {tunnel_id: dict(counts) for tunnel_id, counts in cache_tunnels.items()}},
+            "access_log": {
+                **access_stats, "sample": max((report["access_log"]["sample"] for report in self.worker_stats.values()), default=1),
+            },
+        }
+
+class WorkerNode:
+    role = "worker"
+
+    def __init__(self, index, count, ipc_fd):
+        self.index = index
+        self.count = count
+        self.stopped = asyncio.Event()
+        self.channel = IpcChannel(socket.socket(fileno=ipc_fd), self.on_message, self.stopped.set, log=log)
+        self._updates = asyncio.Queue()
+        self._reported = {}  # {tunnel_id: (contadores, réplicas)} do último relatório
+        self._histograms = None  # Contagens dos histogramas no último relatório
+        spawn(self._apply_updates())
+        spawn(self._report_stats())
+
+    def send(self, msg, payload=b"", fds=()):
+        self.channel.send(msg, payload, fds)
+
+    def route(self, index, msg, payload=b"", fds=()):
+        """Envia uma mensagem (e fds) a outro worker, via coordenador."""
+        self.send({"op": "route", "to": index, "msg": msg}, payload, fds)
+
+    def route_visitor(self, tunnel, public_reader, public_writer, initial_data):
+        """Visitante chegou a um worker que não é o dono do túnel."""
+        if tunnel.handoff:
+            fd, buffered = detach_connection(public_reader, public_writer)
+            msg = {"op": "conn", "kind": "public", "tunnel_id": tunnel.tunnel_id}
+            self.route(tunnel.worker, msg, (initial_data or b"") + buffered, [fd])
+            return
+        token = add_pending_connection(tunnel.tunnel_id, public_reader, public_writer, initial_data)
+        self.route(tunnel.worker, {"op": "signal", "tunnel_id": tunnel.tunnel_id, "token": token})
+
+    def on_message(self, msg, payload, fds):
+        op = msg["op"]
+        if op == "conn":
+            spawn(self._adopt(msg, payload, fds[0]))
+        elif op == "signal":
+            tunnel = registry.get(msg["tunnel_id"])
+            replica = choose_replica(tunnel, signalable=True) if tunnel is not None else None
+            if replica is not None:
+                replica.control_writer.write(new_connection_signal(replica, msg["token"]))
+        elif op == "fail":
+            fail_pending(msg["token"])
+        elif op == "purge":
+            if edge_cache:
+                edge_cache.purge(msg["tunnel_id"], msg["path"])
+        elif op == "profile":
+            spawn(self._profile(msg))
+        else:
+            # Mudanças na tabela são aplicadas em ordem por uma única tarefa.
+            self._updates.put_nowait(msg)
+
+    async def _apply_updates(self):
+        while True:
+            msg = await self._updates.get()
+            op = msg["op"]
+            tunnel = registry.get(msg["tunnel_id"])
+            try:
+                if op == "tunnel" and tunnel is None:
+                    tunnel = Tunnel(msg["tunnel_id"], msg["user_id"], msg["local_port"], msg["public_port"], protocol=msg["protocol"])
+                    tunnel.worker = msg["worker"]
+                    tunnel.handoff = msg["handoff"]
+                    registry.add(tunnel)
+                    registry.set_domain(tunnel, msg["domain"])
+                    tunnel.cache = msg["cache"]
+                    configure_limits(tunnel, msg["limits"], msg["user_limits"])
+                    await open_public_listener(tunnel)
+                elif tunnel is None:
+                    continue
+                elif op == "owner":
+                    tunnel.worker = msg["worker"]
+                    tunnel.handoff = msg["handoff"]
+                    if tunnel.limits is not None:
+                        tunnel.limits.configure(scale=limit_scale(tunnel))
+                    if listener_wanted(tunnel):
+                        await bind_public_listener(tunnel)
+                    elif tunnel.protocol == "udp" and tunnel.public_server:
+                        # A porta UDP segue o dono do túnel.
+                        tunnel.public_server.close()
+                        tunnel.public_server = None
+                    else:
+                        schedule_listener_idle(tunnel)
+                elif op == "limits":
+                    configure_limits(tunnel, msg["tunnel"], msg["user"])
+                elif op == "domain":
+                    registry.set_domain(tunnel, msg["domain"])
+                elif op == "cache":
+                    configure_cache(tunnel, msg["enabled"])
+                elif op == "kick":
+                    for replica in tunnel.replicas:
+                        replica.control_writer.close()
+                elif op == "delete":
+                    registry.remove(tunnel.tunnel_id)
+                    await release_tunnel(tunnel)
+            except OSError as e:
+                log(f"[WORKER {self.index}] Falha ao aplicar '{op}' em {msg['tunnel_id']}: {e}")
+
+    async def _adopt(self, msg, payload, fd):
+        """Assume uma conexão entregue por outro worker."""
+        reader, writer = await attach_connection(fd, payload if msg["kind"] != "public" else b"")
+        kind = msg["kind"]
+        if kind == "public":
+            await signal_new_connection(msg["tunnel_id"], reader, writer, initial_data=payload or None)
+        elif kind == "http":
+            await handle_http_proxy(reader, writer)
+        elif kind == "data":
+            await handle_data_channel(msg["token"], reader, writer, msg["zlib"])
+        elif kind == "pool":
+            tunnel = registry.get(msg["tunnel_id"])
+            if tunnel is None or tunnel.worker != self.index:
+                writer.close()  # Dono mudou no caminho; o cliente repõe o pool
+                return
+            await handle_pooled_channel(msg["tunnel_id"], reader, writer, msg["zlib"], msg.get("replica"))
+        elif kind == "control":
+            await handle_frp_client(reader, writer, routed=True)
+
+    async def _profile(self, msg):
+        result = await run_profile(msg["mode"], msg["seconds"], msg["interval"], msg["threshold"])
+        self.send({"op": "profile", "result": result})
+
+    async def _report_stats(self):
+        while not self.stopped.is_set():
+            await asyncio.sleep(STATS_INTERVAL)
+            # Só os túneis cujos contadores mudaram, como deltas do relatório
+            # anterior, em mensagens de até STATS_BATCH túneis.
+            changed = self._tunnel_deltas()
+            for start in range(0, len(changed), STATS_BATCH):
+                self.send({"op": "tunnel_stats", "tunnels": dict(changed[start:start + STATS_BATCH])})
+            report = {
+                "op": "stats", "expired": dict(expired_counts), "rejected": dict(rejected_counts),
+                "http": dict(http_counts), "udp": udp_stats(), "memory": memory_stats(),
+                "cache": edge_cache.stats() if edge_cache else {}, "timers_active": timers.active,
+                "access_log": access_log.stats(),
+            }
+            counts = [histogram.count for histogram in HISTOGRAMS]
+            if counts != self._histograms:
+                self._histograms = counts
+                report["histograms"] = {histogram.name: histogram.state() for histogram in HISTOGRAMS}
+            self.send(report)
+
+    def _tunnel_deltas(self):
+        changed = []
+        reported = {}
+        for tunnel in registry:
+            if tunnel.worker != self.index and not tunnel.connections_total and tunnel.tunnel_id not in self._reported:
+                continue  # Nunca passou por este worker
+            counters = tunnel_counters(tunnel)
+            replicas = [replica.to_dict() for replica in tunnel.replicas] if tunnel.worker == self.index else None
+            last_counters, last_replicas = self._reported.get(tunnel.tunnel_id, ({}, None))
+            delta = {key: value - last_counters.get(key, 0) for key, value in counters.items() if value != last_counters.get(key, 0)}
+            if replicas is not None and replicas != last_replicas:
+                delta["replicas"] = replicas
+            if delta:
+                changed.append((tunnel.tunnel_id, delta))
+            if any(counters.values()) or replicas:
+                reported[tunnel.tunnel_id] = (counters, replicas)
+        # Túneis removidos (ou sem nenhum contador) saem do estado guardado.
+        self._reported = reported
+        return changed
+
+# --- Atualização sem interrupção ---
+#
+# SIGUSR2 ou POST /admin/upgrade inicia a versão do script que está em disco
+# com --upgrade-fd, ligada a este processo por um socketpair (IpcChannel):
+#  1. o antigo entrega os sockets de escuta (FRP, HTTP, API e o socket único)
+#     e a tabela de túneis, cada um com sua porta pública (SCM_RIGHTS); daí em
+#     diante o journal é do novo e o antigo só repassa alterações;
+#  2. o novo aceita em FRP_PORT e na API; o antigo para de aceitar nelas e pede
+#     aos clientes (UPGRADE, ou GO_AWAY no mux) uma sessão no novo. A sessão
+#     antiga segue atendendo quem chega ao antigo, e a porta pública de um túnel
+#     passa a ser aceita também no novo assim que o cliente dele migra;
+#  3. com todos os túneis migrados (ou em UPGRADE_MIGRATE_TIMEOUT), o novo
+#     aceita em HTTP_PORT e nas portas restantes e o antigo fecha as suas cópias;
+#  4. o antigo espera os relays em andamento (até UPGRADE_DRAIN_TIMEOUT) e sai.
+# Os sockets de escuta nunca fecham, então nenhum visitante é recusado; canais
+# DATA de visitantes que esperam no antigo voltam a ele pelo socketpair.
+
+DRAIN_CHECK_INTERVAL = 0.1
+
+def listener_socket(tunnel):
+    """Socket da porta pública do túnel neste processo, ou None."""
+    server = tunnel.public_server
+    if server is None:
+        return None
+    return server.socket.sock if isinstance(server, UdpRelay) else server.sockets[0]
+
+async def stop_accepting(server):
+    """
+    Fecha um asyncio.Server sem perder conexões já aceitas: com close() logo
+    após um accept, o asyncio descarta em silêncio as que ainda não viraram transporte.
+    """
+    loop = asyncio.get_running_loop()
+    for sock in server.sockets:
+        loop.remove_reader(sock.fileno())
+    await asyncio.sleep(0)
+    server.close()
+
+def in_flight():
+    """Visitantes ainda sendo atendidos (ou esperando o canal de dados) neste processo."""
+    return sum(tunnel.connections_active for tunnel in registry) + registry.pending_count
+
+def migrated(tunnel):
+    """O túnel estava conectado no processo antigo: para o bot, ele nunca caiu."""
+    return upgrade is not None and upgrade.role == "successor" and upgrade.arrived(tunnel)
+
+class Predecessor:
+    """Processo antigo: entrega sockets e túneis ao novo, drena e sai."""
+    role = "predecessor"
+
+    def __init__(self, pid, sock):
+        self.pid = pid
+        self.adopted = False
+        self.finished = asyncio.Event()
+        self.channel = IpcChannel(sock, self.on_message, self.on_close, log=log)
+
+    def send(self, msg, payload=b"", fds=()):
+        self.channel.send(msg, payload, fds)
+
+    def hand_over(self):
+        global store
+        if store:
+            store.close()
+            store = None
+        names = list(servers)
+        fds = [os.dup(servers[name].sockets[0].fileno()) for name in names] + [os.dup(api_socket.fileno())]
+        self.send({"op": "listeners", "names": names + ["api"]}, fds=fds)
+        for tunnel in registry:
+            listener = listener_socket(tunnel)
+            fds = [os.dup(listener.fileno())] if listener else []
+            self.send({**tunnel_message(tunnel), "connected": tunnel.connected}, fds=fds)
+        self.send({"op": "sent"})
+
+    def on_message(self, msg, payload, fds):
+        op = msg["op"]
+        if op == "adopted":
+            self.adopted = True
+            spawn(self.invite_clients())
+        elif op == "conn":
+            spawn(self._adopt(msg, payload, fds[0]))
+        elif op == "delete":
+            tunnel = registry.remove(msg["tunnel_id"])
+            if tunnel is not None:
+                spawn(release_tunnel(tunnel))
+        elif op == "serving":
+            spawn(self.drain())
+
+    async def invite_clients(self):
+        """O novo já aceita clientes e a API: este para de aceitá-los e pede às sessões que migrem."""
+        api_server.should_exit = True
+        await stop_accepting(servers.pop("frp"))
+        sessions = {}
+        for tunnel in registry:
+            for replica in tunnel.replicas:
+                sessions[replica.control_writer] = replica
+        for writer, replica in sessions.items():
+            if replica.mux_session is None:
+                writer.write(b"UPGRADE\n")
+            elif not replica.mux_session.closed:
+                replica.mux_session.go_away()
+        log(f"[ATUALIZAÇÃO] Processo novo (pid {self.pid}) aceitando clientes; {len(sessions)} sessões avisadas.")
+
+    async def _adopt(self, msg, payload, fd):
+        reader, writer = await attach_connection(fd, payload)
+        await handle_data_channel(msg["token"], reader, writer, msg["zlib"])
+
+    async def drain(self):
+        """O novo atende todas as portas: fecha as cópias daqui e espera os relays em andamento."""
+        listeners = list(servers.values())
+        servers.clear()
+        for tunnel in registry:
+            if tunnel.public_server:
+                listeners.append(tunnel.public_server)
+                tunnel.public_server = None
+        for server in listeners:
+            if isinstance(server, UdpRelay):
+                server.close()
+            else:
+                await stop_accepting(server)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + UPGRADE_DRAIN_TIMEOUT
+        log(f"[ATUALIZAÇÃO] Drenando {in_flight()} conexões (até {UPGRADE_DRAIN_TIMEOUT:g}s).")
+        while in_flight() and loop.time() < deadline:
+            await asyncio.sleep(DRAIN_CHECK_INTERVAL)
+        remaining = in_flight()
+        log("[ATUALIZAÇÃO] Processo antigo encerrando" + (f" ({remaining} conexões interrompidas)." if remaining else "."))
+        # Os clientes já têm sessão no novo: as antigas terminam antes de o loop cancelar as tarefas.
+        for tunnel in registry:
+            for replica in tunnel.replicas:
+                (replica.mux_session or replica.control_writer).close()
+        await asyncio.sleep(DRAIN_CHECK_INTERVAL)
+        self.finished.set()
+        self.channel.close()
+
+    def on_close(self):
+        global upgrade, retiring, store
+        if self.adopted:
+            if not self.finished.is_set():
+                log("[ATUALIZAÇÃO] O processo novo caiu no meio da atualização.")
+            return
+        # O processo novo falhou antes de assumir: este continua sendo o servidor.
+        log(f"[ATUALIZAÇÃO] O processo novo (pid {self.pid}) falhou ao iniciar; atualização cancelada.")
+        upgrade = None
+        retiring = False
+        if STATE_DIR:
+            store = StateStore(STATE_DIR, log)
+            store.load()
+
+class Successor:
+    """Processo novo: recebe sockets e túneis do antigo e assume as portas quando os clientes migram."""
+    role = "successor"
+
+    def __init__(self, ipc_fd):
+        self.listeners = {}     # {"frp" | "http" | "redirect" | "api": socket}
+        self.migrating = set()  # tunnel_ids conectados no antigo e ainda sem cliente aqui
+        self.received = asyncio.Event()
+        self.serving = False
+        self.timer = None
+        self.channel = IpcChannel(socket.socket(fileno=ipc_fd), self.on_message, self.on_close, log=log)
+
+    def send(self, msg, payload=b"", fds=()):
+        self.channel.send(msg, payload, fds)
+
+    def on_message(self, msg, payload, fds):
+        op = msg["op"]
+        if op == "listeners":
+            self.listeners = {name: socket.socket(fileno=fd) for name, fd in zip(msg["names"], fds)}
+        elif op == "tunnel":
+            self.add_tunnel(msg, fds)
+        elif op == "record":
+            # Alteração feita no processo antigo depois da entrega da tabela.
+            record = msg["record"]
+            if record["op"] == "tunnel" and record["tunnel_id"] not in registry:
+                self.add_tunnel(record)
+            else:
+                apply_record(record)
+            persist(record)
+        elif op == "sent":
+            self.open_store()
+            self.received.set()
+
+    def add_tunnel(self, msg, fds=()):
+        apply_record(msg)
+        tunnel = registry.get(msg["tunnel_id"])
+        ports.reserve(tunnel.public_port)
+        if fds:
+            adopted_listeners[tunnel.tunnel_id] = socket.socket(fileno=fds[0])
+        if msg.get("connected"):
+            self.migrating.add(tunnel.tunnel_id)
+        else:
+            schedule_tunnel_expiry(tunnel)
+
+    def open_store(self):
+        """O antigo fechou o journal ao entregar a tabela; daqui em diante ele é deste processo."""
+        global store
+        if STATE_DIR:
+            store = StateStore(STATE_DIR, log)
+            store.load()
+            spawn(compact_state_loop())
+
+    def start(self):
+        """FRP e API já aceitam aqui: o antigo pode chamar os clientes."""
+        self.send({"op": "adopted"})
+        if self.migrating:
+            self.timer = timers.schedule(UPGRADE_MIGRATE_TIMEOUT, self.serve)
+        else:
+            self.serve()
+
+    def arrived(self, tunnel):
+        if tunnel.tunnel_id not in self.migrating:
+            return False
+        self.migrating.discard(tunnel.tunnel_id)
+        if not self.migrating:
+            self.serve()
+        return True
+
+    def forward_data(self, token, client_reader, client_writer, compressed):
+        fd, buffered = detach_connection(client_reader, client_writer)
+        self.send({"op": "conn", "kind": "data", "token": token, "zlib": compressed}, buffered, [fd])
+
+    def serve(self):
+        if self.serving:
+            return
+        self.serving = True
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        spawn(self._take_over())
+
+    async def _take_over(self):
+        """Passa a aceitar em HTTP_PORT e nas portas públicas restantes; o antigo fecha as suas."""
+        servers["http"] = await asyncio.start_server(http_handler(), sock=self.listeners.pop("http"))
+        if "redirect" in self.listeners:
+            servers["redirect"] = await start_redirect_listener(self.listeners.pop("redirect"))
+        for tunnel_id in list(adopted_listeners):
+            tunnel = registry.get(tunnel_id)
+            if tunnel is None:
+                adopted_listeners.pop(tunnel_id).close()
+                continue
+            try:
+                await bind_public_listener(tunnel)
+            except OSError as e:
+                log(f"[{tunnel_id}] Falha ao assumir a porta pública {tunnel.public_port}: {e}")
+            schedule_listener_idle(tunnel)
+        for tunnel_id in self.migrating:
+            tunnel = registry.get(tunnel_id)
+            if tunnel is not None and not tunnel.connected:
+                # O cliente não migrou a tempo (ou não conhece UPGRADE): segue o caminho da desconexão.
+                schedule_tunnel_expiry(tunnel)
+                notify_bot(tunnel, "disconnected")
+        self.migrating.clear()
+        self.send({"op": "serving"})
+        log("[ATUALIZAÇÃO] Processo novo atendendo todas as portas.")
+
+    def on_close(self):
+        global upgrade
+        # O antigo terminou (ou caiu): tudo passa a ser atendido aqui.
+        self.serve()
+        upgrade = None
+        log("[ATUALIZAÇÃO] Processo antigo encerrado.")
+
+async def start_upgrade():
+    """Inicia a versão nova do servidor e lhe entrega sockets e túneis. Retorna o pid dela."""
+    global upgrade, retiring
+    retiring = True
+    try:
+        pid, sock = spawn_successor(os.path.abspath(__file__))
+    except OSError:
+        retiring = False
+        raise
+    upgrade = Predecessor(pid, sock)
+    upgrade.hand_over()
+    log(f"[ATUALIZAÇÃO] Processo novo iniciado (pid {pid}); {len(registry)} túneis entregues.")
+    return pid
+
+def upgrade_signal():
+    if cluster or upgrade or retiring:
+        log("[ATUALIZAÇÃO] SIGUSR2 ignorado: atualização indisponível ou já em andamento.")
+        return
+    spawn(start_upgrade())
+
+@api.post("/admin/upgrade", summary="Troca o servidor pela versão em disco sem derrubar conexões", status_code=status.HTTP_202_ACCEPTED, dependencies=[Depends(get_api_key)])
+async def upgrade_server():
+    if cluster:
+        raise HTTPException(status_code=409, detail="Upgrade is only supported in single-process mode")
+    if upgrade or retiring:
+        raise HTTPException(status_code=409, detail="Upgrade already in progress")
+    try:
+        pid = await start_upgrade()
+    except OSError as e:
+        raise HTTPException(status_code=500, detail=f"Could not start the new server: {e}")
+    return {"status": "upgrading", "pid": pid}
 
 # --- Ponto de Entrada Principal ---
 
-async def main():
-    config = uvicorn.Config(app, host=SERVER_IP, port=API_PORT, log_level="info")
+async def main(workers=1, upgrade_fd=None):
+    global cluster, api_server, api_socket, upgrade
+    config = uvicorn.Config(api, host=SERVER_IP, port=API_PORT, log_level="info")
     api_server = uvicorn.Server(config)
+    route_library_logs()
+
+    log("--- CZ7 Host FRP Server ---")
+    log(f"API de Gerenciamento em http://{SERVER_IP}:{API_PORT}")
+    log(f"Servidor de Clientes FRP em {SERVER_IP}:{FRP_PORT}")
+    log(f"Proxy HTTP em {SERVER_IP}:{HTTP_PORT} para *.{BASE_DOMAIN} (modo {HTTP_MODE})")
+    log(f"Portas públicas {PUBLIC_PORT_START}-{PUBLIC_PORT_END} (modo {PUBLIC_LISTENER_MODE}"
+          + (f", socket único em {PUBLIC_LISTENER_PORT})" if PUBLIC_LISTENER_MODE == "single" else ")"))
+    if memory_guard and not memory_guard.available:
+        log("[AVISO] MEMORY_LIMIT_MB ignorado: não foi possível medir a memória do processo (/proc).")
+    spawn(monitor_loop_lag())
 
-    tcp_server = await asyncio.start_server(handle_frp_client, SERVER_IP, FRP_PORT)
-    http_server = await asyncio.start_server(handle_http_connection, SERVER_IP, HTTP_PORT)
+    if workers > 1:
+        cluster = Coordinator(workers)
+    if upgrade_fd is not None:
+        upgrade = Successor(upgrade_fd)
+        await upgrade.received.wait()
+        log(f"[ATUALIZAÇÃO] {len(registry)} túneis recebidos do processo antigo.")
+    elif STATE_DIR:
+        await restore_state()
 
-    print(f"--- CZ7 Host FRP Server ---")
-    print(f"API de Gerenciamento em http://{SERVER_IP}:{API_PORT}")
-    print(f"Servidor de Clientes FRP em {SERVER_IP}:{FRP_PORT}")
-    print(f"Proxy HTTP em {SERVER_IP}:{HTTP_PORT} para *.{BASE_DOMAIN}")
+    if workers > 1:
+        await cluster.start()
+        log(f"Modo multi-processo: {workers} workers com SO_REUSEPORT")
+        await api_server.serve()
+        return
+
+    open_edge_cache(CACHE_DIR)
+    if upgrade:
+        # Processo novo: HTTP e as portas públicas esperam os clientes migrarem.
+        api_socket = upgrade.listeners.pop("api")
+        servers["frp"] = await asyncio.start_server(handle_frp_client, sock=upgrade.listeners.pop("frp"))
+        upgrade.start()
+    else:
+        api_socket = config.bind_socket()
+        servers["frp"] = await asyncio.start_server(handle_frp_client, SERVER_IP, FRP_PORT)
+        servers["http"] = await asyncio.start_server(http_handler(), SERVER_IP, HTTP_PORT)
+        if PUBLIC_LISTENER_MODE == "single":
+            servers["redirect"] = await start_redirect_listener()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, upgrade_signal)
+
+    await api_server.serve(sockets=[api_socket])
+    if retiring:
+        # A API passou ao processo novo; este só termina os relays em andamento.
+        await upgrade.finished.wait()
+
+async def worker_main(index, count, ipc_fd):
+    """Processo worker: serve FRP, HTTP e portas públicas; a API fica no coordenador."""
+    global cluster
+    if access_log.enabled:
+        access_log.path = f"{ACCESS_LOG}.{index}"
+    cluster = WorkerNode(index, count, ipc_fd)
+    open_edge_cache(os.path.join(CACHE_DIR, f"worker-{index}") if CACHE_DIR else "")
+    spawn(monitor_loop_lag())
+    await asyncio.start_server(handle_frp_client, SERVER_IP, FRP_PORT, reuse_port=True)
+    await asyncio.start_server(http_handler(), SERVER_IP, HTTP_PORT, reuse_port=True)
+    if PUBLIC_LISTENER_MODE == "single":
+        await start_redirect_listener()
+    await cluster.stopped.wait()
+
+def route_library_logs():
+    """O logging do uvicorn (configurado por uvicorn.Config) também sai pela thread do access_log."""
+    for name in ("uvicorn", "uvicorn.access"):
+        logger = logging.getLogger(name)
+        for handler in list(logger.handlers):
+            if isinstance(handler, logging.StreamHandler):
+                replacement = access_log.handler()
+                replacement.setFormatter(handler.formatter)
+                logger.removeHandler(handler)
+                logger.addHandler(replacement)
 
-    await asyncio.gather(api_server.serve(), tcp_server.serve_forever(), http_server.serve_forever())
+def http_handler():
+    return handle_http_proxy if HTTP_MODE == "proxy" else handle_http_connection
+
+def open_edge_cache(directory):
+    """Cria o cache de borda do processo (modo proxy); sem diretório ou CACHE_DISK_MAX, só memória."""
+    global edge_cache
+    if HTTP_MODE == "proxy" and CACHE_MEMORY_MAX > 0:
+        edge_cache = EdgeCache(CACHE_MEMORY_MAX, CACHE_OBJECT_MAX, directory or None, CACHE_DISK_MAX)
+
+async def monitor_loop_lag():
+    """Mede quanto o loop se atrasa para acordar uma tarefa agendada."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag.observe(max(0.0, loop.time() - expected))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CZ7 Host FRP Server")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="processos worker (SO_REUSEPORT); 1 = processo único")
+    parser.add_argument("--worker-index", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--ipc-fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--upgrade-fd", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
 
 if __name__ == "__main__":
+    args = parse_args()
     try:
-        asyncio.run(main())
+        if args.worker_index is not None:
+            asyncio.run(worker_main(args.worker_index, args.workers, args.ipc_fd))
+        else:
+            asyncio.run(main(args.workers, args.upgrade_fd))
     except KeyboardInterrupt:
-        print("\nServidor desligando.")
\ No newline at end of file
+        log("\nServidor desligando.")
+    finally:
+        if store:
+            store.close()
\ No newline at end of file
@@ -0,0 +1,177 @@
+"""
+Limites de banda e de conexões por segundo com token buckets.
+
+Um bloco já lido do socket é sempre encaminhado: ele é descontado do balde,
+que pode ficar negativo (em dívida). Enquanto houver dívida, o sentido do
+relay que a causou para de ler do socket (backpressure) até o balde se
+recuperar. Não há laços com sleep: cada balde usa no máximo um timer do loop.
+
+Sentidos que esperam pelo mesmo balde são acordados um por vez, em ordem de
+chegada, então túneis de um mesmo usuário se revezam de forma justa na banda
+do usuário.
+"""
+import asyncio
+import collections
+import time
+
+# Após acordar um sentido, espera o equivalente a este volume antes de acordar o próximo.
+FAIR_QUANTUM = 64 * 1024
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp", "waiters", "_handle")
+
+    def __init__(self, rate, burst=None):
+        self.rate = 0.0
+        self.burst = 0.0
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.waiters = collections.deque()
+        self._handle = None
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """Altera o limite (0 = ilimitado) sem perder quem já espera."""
+        self._refill()
+        was_limited = bool(self.rate)
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        # Um limite novo começa com o balde cheio; um alterado mantém o saldo.
+        self.tokens = min(self.tokens if was_limited else self.burst, self.burst)
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+        if self.waiters:
+            self._wake()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, amount):
+        """Desconta 'amount'; retorna False se o balde ficou em dívida."""
+        if not self.rate:
+            return True
+        self._refill()
+        self.tokens -= amount
+        return self.tokens >= 0
+
+    def available(self, amount=1):
+        """Há saldo para 'amount', sem descontar."""
+        if not self.rate:
+            return True
+        self._refill()
+        return self.tokens >= amount
+
+    def try_take(self, amount=1):
+        """Desconta apenas se houver saldo (para admissão de conexões)."""
+        if not self.rate:
+            return True
+        self._refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def in_debt(self):
+        if not self.rate:
+            return False
+        self._refill()
+        return self.tokens < 0
+
+    def wait(self, callback):
+        """Chama callback() quando chegar a vez dele e o balde não estiver em dívida."""
+        self.waiters.append(callback)
+        if self._handle is None:
+            self._wake()
+
+    def _wake(self):
+        self._handle = None
+        loop = asyncio.get_running_loop()
+        if self.in_debt():
+            self._handle = loop.call_later(-self.tokens / self.rate, self._wake)
+            return
+        if not self.rate:
+            # Limite removido: libera todos.
+            while self.waiters:
+                self.waiters.popleft()()
+            return
+        self.waiters.popleft()()
+        if self.waiters:
+            self._handle = loop.call_later(min(self.burst, FAIR_QUANTUM) / self.rate, self._wake)
+
+
+class Flow:
+    """Um sentido de um relay, sujeito a um ou mais baldes (túnel e usuário)."""
+
+    __slots__ = ("buckets",)
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    def charge(self, amount, resume):
+        """
+        Desconta 'amount' de todos os baldes. Se algum ficou em dívida, retorna
+        True e chama resume() quando todos tiverem saldo; quem chamou deve parar
+        de ler até lá.
+        """
+        if self._take(amount):
+            return False
+        return self._hold(resume)
+
+    def _take(self, amount):
+        ok = True
+        for bucket in self.buckets:
+            ok = bucket.take(amount) and ok
+        return ok
+
+    def _hold(self, resume):
+        for bucket in self.buckets:
+            if bucket.in_debt():
+                bucket.wait(lambda: self._hold(resume) or resume())
+                return True
+        return False
+
+    async def throttle(self, amount):
+        """charge() para laços com await (motores stream e splice)."""
+        if self._take(amount):
+            return
+        future = asyncio.get_running_loop().create_future()
+        if self._hold(lambda: future.done() or future.set_result(None)):
+            await future
+
+
+class Limits:
+    """Limites de um túnel ou de um usuário: banda (bytes/s) e conexões novas por segundo."""
+
+    __slots__ = ("bandwidth", "connections", "scale")
+
+    def __init__(self):
+        self.bandwidth = TokenBucket(0)
+        self.connections = TokenBucket(0)
+        self.scale = 1.0  # Fração do limite aplicada neste processo (modo --workers)
+
+    def configure(self, bandwidth=None, connections=None, scale=None):
+        """Atualiza os limites; None mantém o valor atual, 0 remove o limite."""
+        if scale is not None and scale != self.scale:
+            current = self.to_dict()
+            self.scale = scale
+            bandwidth = current["bandwidth"] if bandwidth is None else bandwidth
+            connections = current["connections_per_second"] if connections is None else connections
+        if bandwidth is not None:
+            self.bandwidth.set_rate(bandwidth * self.scale)
+        if connections is not None:
+            rate = connections * self.scale
+            self.connections.set_rate(rate, max(1.0, rate))
+
+    @property
+    def active(self):
+        return bool(self.bandwidth.rate or self.connections.rate)
+
+    def to_dict(self):
+        return {
+            "bandwidth": self.bandwidth.rate / self.scale,
+            "connections_per_second": self.connections.rate / self.scale,
+        }
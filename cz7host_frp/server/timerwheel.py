@@ -0,0 +1,90 @@
+"""
+Roda de timers com hash (hashed timing wheel) para prazos de conexões.
+
+Um único callback periódico no loop avança a roda; agendar e cancelar são O(1),
+então centenas de milhares de prazos custam apenas um objeto Timer cada, em vez
+de uma tarefa asyncio.wait_for por socket. A precisão é de um tick.
+"""
+import asyncio
+import math
+
+
+class Timer:
+    __slots__ = ("wheel", "slot", "rounds", "callback", "args")
+
+    def __init__(self, wheel, slot, rounds, callback, args):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        if self.slot is not None:
+            self.wheel._remove(self)
+
+    @property
+    def active(self):
+        return self.slot is not None
+
+
+class TimerWheel:
+    def __init__(self, tick=0.1, size=512, log=print):
+        self.tick = tick
+        self.size = size
+        self.active = 0
+        self._slots = [{} for _ in range(size)]
+        self._cursor = 0
+        self._loop = None
+        self._handle = None
+        self._next_tick_at = 0.0
+        self._log = log
+
+    def schedule(self, delay, callback, *args):
+        """Chama callback(*args) após 'delay' segundos (arredondado para cima ao tick)."""
+        if self._handle is None:
+            self._start()
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self._cursor + ticks) % self.size
+        timer = Timer(self, slot, (ticks - 1) // self.size, callback, args)
+        self._slots[slot][timer] = None
+        self.active += 1
+        return timer
+
+    def _remove(self, timer):
+        del self._slots[timer.slot][timer]
+        timer.slot = None
+        self.active -= 1
+
+    def _start(self):
+        self._loop = asyncio.get_running_loop()
+        self._next_tick_at = self._loop.time() + self.tick
+        self._handle = self._loop.call_at(self._next_tick_at, self._advance)
+
+    def _advance(self):
+        now = self._loop.time()
+        # Processa todos os ticks vencidos, caso o loop tenha atrasado.
+        while self._next_tick_at <= now:
+            self._cursor = (self._cursor + 1) % self.size
+            self._next_tick_at += self.tick
+            slot = self._slots[self._cursor]
+            if not slot:
+                continue
+            due = []
+            for timer in slot:
+                if timer.rounds:
+                    timer.rounds -= 1
+                else:
+                    due.append(timer)
+            for timer in due:
+                self._remove(timer)
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    self._log(f"[TIMER] Erro em callback: {e}")
+
+        if self.active:
+            self._handle = self._loop.call_at(self._next_tick_at, self._advance)
+        else:
+            # Roda vazia: para de acordar o loop até o próximo agendamento.
+            self._handle = None
@@ -0,0 +1,219 @@
+"""
+Infraestrutura do modo multi-processo (--workers N) e da atualização sem
+interrupção, em que o processo antigo entrega seus sockets ao novo.
+
+O coordenador e cada worker conversam por um socketpair AF_UNIX/SOCK_SEQPACKET.
+Cada mensagem é: tamanho do cabeçalho (4 bytes) + cabeçalho JSON + payload
+bruto, com descritores de arquivo opcionais anexados via SCM_RIGHTS. É assim
+que uma conexão aceita num worker é entregue a outro sem interromper o cliente.
+
+O kernel recusa pacotes SEQPACKET maiores que o buffer de envio (~208 KiB).
+Mensagens de até CHUNK bytes vão num pacote só; as maiores são divididas em
+pacotes de CHUNK bytes, cada um com uma palavra de 4 bytes de flags no lugar do
+tamanho do cabeçalho (bit CHUNKED, que nenhum cabeçalho real usa) e os fds no
+primeiro pedaço.
+"""
+import asyncio
+import collections
+import errno
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+
+from relay import take_buffered
+
+HEADER_LEN = struct.Struct("!I")
+MAX_PACKET = 256 * 1024
+MAX_FDS = 4
+CHUNK = 64 * 1024
+# Flags da palavra inicial de um pedaço de mensagem dividida.
+CHUNKED = 0x80000000
+FIRST = 0x40000000
+LAST = 0x20000000
+
+
+class IpcChannel:
+    """
+    Canal de mensagens sobre um socket SEQPACKET não bloqueante.
+
+    on_message(msg, payload, fds) é chamado no loop para cada pacote recebido;
+    quem o recebe passa a ser dono dos fds. on_close() é chamado quando o outro
+    lado desaparece.
+    """
+
+    def __init__(self, sock, on_message, on_close=None, log=print):
+        self.sock = sock
+        self.on_message = on_message
+        self.on_close = on_close
+        self.log = log
+        self.closed = False
+        self._outbox = collections.deque()  # [pacotes ainda não enviados, fds], uma entrada por mensagem
+        self._partial = None  # (pedaços recebidos, fds) da mensagem dividida em andamento
+        self._loop = asyncio.get_running_loop()
+        sock.setblocking(False)
+        self._loop.add_reader(sock.fileno(), self._read_ready)
+
+    def send(self, msg, payload=b"", fds=()):
+        """Enfileira uma mensagem. Os fds passam a pertencer ao canal e são fechados após o envio."""
+        if self.closed:
+            for fd in fds:
+                os.close(fd)
+            return
+        header = json.dumps(msg).encode()
+        data = HEADER_LEN.pack(len(header)) + header + payload
+        if len(data) <= CHUNK:
+            packets = collections.deque([data])
+        else:
+            packets = collections.deque()
+            for offset in range(0, len(data), CHUNK):
+                flags = CHUNKED | (FIRST if offset == 0 else 0) | (LAST if offset + CHUNK >= len(data) else 0)
+                packets.append(HEADER_LEN.pack(flags) + data[offset:offset + CHUNK])
+        self._outbox.append([packets, list(fds)])
+        if len(self._outbox) == 1:
+            self._flush()
+
+    def _flush(self):
+        while self._outbox:
+            packets, fds = self._outbox[0]
+            try:
+                socket.send_fds(self.sock, [packets[0]], fds)
+            except BlockingIOError:
+                self._loop.add_writer(self.sock.fileno(), self._flush)
+                return
+            except OSError as e:
+                if e.errno != errno.EMSGSIZE:
+                    self.close()
+                    return
+                # Erro de quem enviou, não do par: só esta mensagem se perde.
+                self.log(f"[IPC] Mensagem descartada: pacote de {len(packets[0])} bytes recusado ({e})")
+                packets.clear()
+            else:
+                packets.popleft()
+            for fd in fds:
+                os.close(fd)
+            fds.clear()  # Os fds vão só com o primeiro pacote
+            if not packets:
+                self._outbox.popleft()
+        self._loop.remove_writer(self.sock.fileno())
+
+    def _read_ready(self):
+        while not self.closed:
+            try:
+                data, fds, _, _ = socket.recv_fds(self.sock, MAX_PACKET, MAX_FDS)
+            except BlockingIOError:
+                return
+            except OSError:
+                data, fds = b"", []
+            if not data:
+                self.close()
+                return
+            (header_len,) = HEADER_LEN.unpack_from(data)
+            if header_len & CHUNKED:
+                data, fds = self._reassemble(header_len, data[HEADER_LEN.size:], fds)
+                if data is None:
+                    continue
+                (header_len,) = HEADER_LEN.unpack_from(data)
+            elif self._partial is not None:
+                self._drop_partial()
+            msg = json.loads(data[HEADER_LEN.size:HEADER_LEN.size + header_len])
+            self.on_message(msg, data[HEADER_LEN.size + header_len:], fds)
+
+    def _reassemble(self, flags, piece, fds):
+        """Junta os pedaços de uma mensagem dividida; retorna (mensagem, fds) no último, ou (None, None)."""
+        if flags & FIRST:
+            if self._partial is not None:
+                self._drop_partial()
+            self._partial = ([], fds)
+        elif self._partial is None:
+            # Pedaço de uma mensagem cujo início foi descartado pelo remetente.
+            for fd in fds:
+                os.close(fd)
+            return None, None
+        self._partial[0].append(piece)
+        if not flags & LAST:
+            return None, None
+        pieces, fds = self._partial
+        self._partial = None
+        return b"".join(pieces), fds
+
+    def _drop_partial(self):
+        self.log("[IPC] Mensagem dividida incompleta descartada")
+        for fd in self._partial[1]:
+            os.close(fd)
+        self._partial = None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._loop.remove_reader(self.sock.fileno())
+        self._loop.remove_writer(self.sock.fileno())
+        for _, fds in self._outbox:
+            for fd in fds:
+                os.close(fd)
+        self._outbox.clear()
+        if self._partial is not None:
+            for fd in self._partial[1]:
+                os.close(fd)
+            self._partial = None
+        self.sock.close()
+        if self.on_close:
+            self.on_close()
+
+
+def detach_connection(reader, writer):
+    """
+    Tira uma conexão do loop deste processo para entregá-la a outro.
+    Retorna (fd duplicado, bytes já lidos e ainda não consumidos).
+    """
+    transport = writer.transport
+    transport.pause_reading()
+    buffered = take_buffered(reader)
+    fd = os.dup(transport.get_extra_info("socket").fileno())
+    # Fechar o fd original não encerra a conexão: o duplicado a mantém viva.
+    transport.abort()
+    return fd, buffered
+
+
+async def attach_connection(fd, buffered=b""):
+    """Adota neste loop uma conexão recebida de outro processo."""
+    sock = socket.socket(fileno=fd)
+    reader, writer = await asyncio.open_connection(sock=sock)
+    if buffered:
+        reader.feed_data(buffered)
+    return reader, writer
+
+
+async def spawn_worker(index, count, script):
+    """Inicia 'script' como worker 'index' de 'count'. Retorna (processo, socket do lado do coordenador)."""
+    parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, script, "--worker-index", str(index), "--ipc-fd", str(child_sock.fileno()),
+        "--workers", str(count),
+        pass_fds=(child_sock.fileno(),),
+    )
+    child_sock.close()
+    return process, parent_sock
+
+
+def spawn_successor(script):
+    """
+    Inicia 'script' (a versão nova) para assumir este servidor. Retorna (pid,
+    socket do lado deste processo). Usa subprocess direto: um processo do
+    asyncio seria morto quando o loop deste processo terminasse.
+    """
+    parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        process = subprocess.Popen(
+            [sys.executable, script, "--workers", "1", "--upgrade-fd", str(child_sock.fileno())],
+            pass_fds=(child_sock.fileno(),),
+        )
+    except OSError:
+        parent_sock.close()
+        raise
+    finally:
+        child_sock.close()
+    return process.pid, parent_sock